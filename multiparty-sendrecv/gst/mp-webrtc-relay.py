@@ -0,0 +1,315 @@
+import random
+import sys
+import os
+import argparse
+
+"""
+Media relay for rooms, a selective forwarding unit
+
+Joins a room like any other peer and receives the audio and video of every
+participant once, then forwards it to all the others without decoding it, so
+that each participant only sends its media once instead of once per peer.
+"""
+import gi
+gi.require_version('Soup', '2.4')
+from gi.repository import Soup, GLib
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+gi.require_version('GstSdp', '1.0')
+from gi.repository import GstSdp
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
+
+# Message parsing and formatting is shared with the other clients
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'signalling'))
+import signalling_protocol as protocol
+
+# What participants are asked to send
+RECV_CAPS = [
+    'application/x-rtp,media=video,encoding-name=VP8,payload=97,clock-rate=90000',
+    'application/x-rtp,media=audio,encoding-name=OPUS,payload=96,clock-rate=48000',
+]
+
+# How each encoding is depayloaded and payloaded again for forwarding, which
+# gives every outgoing stream its own sequence numbers and timestamps while
+# leaving the encoded media as it is
+FORWARD = {
+    'VP8': 'rtpvp8depay ! rtpvp8pay ! application/x-rtp,media=video,encoding-name=VP8,payload=97',
+    'VP9': 'rtpvp9depay ! rtpvp9pay ! application/x-rtp,media=video,encoding-name=VP9,payload=98',
+    'H264': 'rtph264depay ! rtph264pay config-interval=-1 ! application/x-rtp,media=video,encoding-name=H264,payload=99',
+    'OPUS': 'rtpopusdepay ! rtpopuspay ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96',
+}
+
+class Participant:
+    '''
+    A peer in the room and the webrtcbin the relay talks to it with
+    '''
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.webrtc = Gst.ElementFactory.make('webrtcbin')
+        self.webrtc.set_property('bundle-policy', GstWebRTC.WebRTCBundlePolicy.MAX_BUNDLE)
+        # What this participant sends, once it arrives
+        # Format: {encoding: tee}
+        self.tees = {}
+        # What is forwarded to this participant
+        # Format: {(publisher peer_id, encoding): queue}
+        self.subscribed = {}
+        # Elements for incoming streams, removed with the webrtcbin
+        self.elements = []
+
+class MediaRelay:
+    def __init__(self, id_, room_id, server):
+        self.id_ = id_
+        self.room_id = room_id
+        self.server = server
+        self.conn = None
+        self.session = Soup.Session()
+        self.mainloop = None
+        self.pipe = Gst.Pipeline.new('relay')
+        bus = self.pipe.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self.on_live_message)
+        self.pipe.set_state(Gst.State.PLAYING)
+        # Format: {peer_id: Participant}
+        self.participants = {}
+
+    def on_live_message(self, bus, msg):
+        if msg.type == Gst.MessageType.ERROR:
+            print('---')
+            print(msg.parse_error())
+            print('---')
+
+    def connect(self):
+        request = self.session.request(self.server)
+        msg = request.get_message()
+        self.session.websocket_connect_async(msg, None, None, None, self.connect_result)
+
+    def connect_result(self, source, result):
+        self.conn = source.websocket_connect_finish(result)
+        self.conn.connect('message', self.on_message)
+        self.conn.connect('closed', self.on_close)
+        self.conn.send_text(protocol.hello(self.id_))
+
+    def run(self):
+        self.mainloop = GLib.MainLoop()
+        self.mainloop.run()
+
+    def on_close(self, ws):
+        print('Socket is closed')
+        self.mainloop.quit()
+
+    def on_message(self, ws, type, msg):
+        message = msg.get_data()
+        if isinstance(message, bytes):
+            message = message.decode()
+        msg = protocol.parse(message)
+        if isinstance(msg, protocol.Hello):
+            print('Registered with server, joining room %s' % self.room_id)
+            self.conn.send_text(protocol.room(self.room_id))
+        elif isinstance(msg, protocol.RoomOk):
+            print('Joined room %s, with %d peers' % (self.room_id, len(msg.peer_ids)))
+            for peer_id in msg.peer_ids:
+                self.add_participant(peer_id)
+        elif isinstance(msg, protocol.RoomPeerJoined):
+            self.add_participant(msg.peer_id)
+        elif isinstance(msg, protocol.RoomPeerLeft):
+            self.remove_participant(msg.peer_id)
+        elif isinstance(msg, protocol.RoomPeerMsg):
+            if msg.peer_id in self.participants:
+                self.handle_peer_msg(self.participants[msg.peer_id], protocol.parse_payload(msg.data))
+        elif isinstance(msg, protocol.Error):
+            print(message)
+            self.mainloop.quit()
+
+    def send_peer_msg(self, participant, data):
+        self.conn.send_text(protocol.room_peer_msg(participant.peer_id, data))
+
+    def add_participant(self, peer_id):
+        '''
+        Start a call with a participant: receive what it sends, and send it
+        what everyone else sends. The relay is always the one making offers.
+        '''
+        print('Adding participant %s' % peer_id)
+        p = Participant(peer_id)
+        self.participants[peer_id] = p
+        p.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed, p)
+        p.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message, p)
+        p.webrtc.connect('pad-added', self.on_incoming_stream, p)
+        self.pipe.add(p.webrtc)
+        for caps in RECV_CAPS:
+            p.webrtc.emit('add-transceiver', GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY,
+                          Gst.Caps.from_string(caps))
+        for other in list(self.participants.values()):
+            if other is p:
+                continue
+            for encoding in list(other.tees):
+                self.subscribe(p, other, encoding)
+        p.webrtc.sync_state_with_parent()
+
+    def remove_participant(self, peer_id):
+        p = self.participants.pop(peer_id, None)
+        if not p:
+            return
+        print('Removing participant %s' % peer_id)
+        for other in self.participants.values():
+            for encoding in list(p.tees):
+                self.unsubscribe(other, p, encoding)
+        for tee in p.tees.values():
+            tee.set_state(Gst.State.NULL)
+            self.pipe.remove(tee)
+        for key in list(p.subscribed):
+            publisher = self.participants.get(key[0])
+            queue = p.subscribed.pop(key)
+            if publisher and key[1] in publisher.tees:
+                tee = publisher.tees[key[1]]
+                tee.release_request_pad(queue.get_static_pad('sink').get_peer())
+            queue.set_state(Gst.State.NULL)
+            self.pipe.remove(queue)
+        for element in p.elements + [p.webrtc]:
+            element.set_state(Gst.State.NULL)
+            self.pipe.remove(element)
+
+    def subscribe(self, subscriber, publisher, encoding):
+        '''
+        Forward what @publisher sends with @encoding to @subscriber, which
+        renegotiates its call
+        '''
+        # A participant joining as a stream starts can get here twice
+        if (publisher.peer_id, encoding) in subscriber.subscribed:
+            return
+        tee = publisher.tees[encoding]
+        queue = Gst.ElementFactory.make('queue')
+        self.pipe.add(queue)
+        tee.get_request_pad('src_%u').link(queue.get_static_pad('sink'))
+        queue.get_static_pad('src').link(subscriber.webrtc.get_request_pad('sink_%u'))
+        queue.sync_state_with_parent()
+        subscriber.subscribed[(publisher.peer_id, encoding)] = queue
+        if encoding != 'OPUS':
+            # Get the publisher to send a keyframe for the new subscriber
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            queue.get_static_pad('sink').send_event(event)
+
+    def unsubscribe(self, subscriber, publisher, encoding):
+        queue = subscriber.subscribed.pop((publisher.peer_id, encoding), None)
+        if not queue:
+            return
+        tee = publisher.tees[encoding]
+        tee.release_request_pad(queue.get_static_pad('sink').get_peer())
+        sinkpad = queue.get_static_pad('src').get_peer()
+        queue.set_state(Gst.State.NULL)
+        self.pipe.remove(queue)
+        subscriber.webrtc.release_request_pad(sinkpad)
+
+    def on_incoming_stream(self, _, pad, p):
+        if pad.direction != Gst.PadDirection.SRC:
+            return
+
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        encoding = caps.get_structure(0).get_value('encoding-name')
+        if encoding not in FORWARD or encoding in p.tees:
+            print('Not forwarding %s from %s' % (encoding, p.peer_id))
+            sink = Gst.ElementFactory.make('fakesink')
+            sink.set_property('async', False)
+            self.pipe.add(sink)
+            p.elements.append(sink)
+            sink.sync_state_with_parent()
+            pad.link(sink.get_static_pad('sink'))
+            return
+
+        bin_ = Gst.parse_bin_from_description('queue ! ' + FORWARD[encoding], True)
+        tee = Gst.ElementFactory.make('tee')
+        tee.set_property('allow-not-linked', True)
+        self.pipe.add(bin_)
+        self.pipe.add(tee)
+        p.elements.append(bin_)
+        bin_.link(tee)
+        tee.sync_state_with_parent()
+        bin_.sync_state_with_parent()
+        pad.link(bin_.get_static_pad('sink'))
+        p.tees[encoding] = tee
+        # Renegotiating with everyone else is done from the main loop, this
+        # is a streaming thread
+        GLib.idle_add(self.publish, p, encoding)
+
+    def publish(self, publisher, encoding):
+        if self.participants.get(publisher.peer_id) is publisher:
+            print('Forwarding %s from %s to %d peers' % (encoding, publisher.peer_id, len(self.participants) - 1))
+            for p in list(self.participants.values()):
+                if p is not publisher:
+                    self.subscribe(p, publisher, encoding)
+        # Don't call again
+        return False
+
+    def on_negotiation_needed(self, element, p):
+        promise = Gst.Promise.new_with_change_func(self.on_offer_created, element, p)
+        element.emit('create-offer', None, promise)
+
+    def on_offer_created(self, promise, element, p):
+        promise.wait()
+        offer = promise.get_reply().get_value('offer')
+        promise = Gst.Promise.new()
+        element.emit('set-local-description', offer, promise)
+        promise.interrupt()
+        self.send_peer_msg(p, protocol.sdp_payload('offer', offer.sdp.as_text()))
+
+    def on_answer_created(self, promise, element, p):
+        promise.wait()
+        answer = promise.get_reply().get_value('answer')
+        promise = Gst.Promise.new()
+        element.emit('set-local-description', answer, promise)
+        promise.interrupt()
+        self.send_peer_msg(p, protocol.sdp_payload('answer', answer.sdp.as_text()))
+
+    def send_ice_candidate_message(self, _, mlineindex, candidate, p):
+        self.send_peer_msg(p, protocol.ice_payload([{'candidate': candidate, 'sdpMLineIndex': mlineindex}]))
+
+    def handle_peer_msg(self, p, msg):
+        if isinstance(msg, protocol.Sdp):
+            res, sdpmsg = GstSdp.SDPMessage.new()
+            GstSdp.sdp_message_parse_buffer(bytes(msg.sdp.encode()), sdpmsg)
+            if msg.type == 'answer':
+                sdp_type = GstWebRTC.WebRTCSDPType.ANSWER
+            else:
+                sdp_type = GstWebRTC.WebRTCSDPType.OFFER
+            desc = GstWebRTC.WebRTCSessionDescription.new(sdp_type, sdpmsg)
+            promise = Gst.Promise.new()
+            p.webrtc.emit('set-remote-description', desc, promise)
+            promise.interrupt()
+            # Peers that don't know about the relay may offer to it anyway
+            if msg.type == 'offer':
+                promise = Gst.Promise.new_with_change_func(self.on_answer_created, p.webrtc, p)
+                p.webrtc.emit('create-answer', None, promise)
+        elif isinstance(msg, protocol.Ice):
+            for ice in msg.candidates:
+                p.webrtc.emit('add-ice-candidate', ice['sdpMLineIndex'], ice['candidate'])
+
+
+def check_plugins():
+    needed = ["opus", "vpx", "nice", "webrtc", "dtls", "srtp", "rtp",
+              "rtpmanager", "coreelements"]
+    missing = list(filter(lambda p: Gst.Registry.get().find_plugin(p) is None, needed))
+    if len(missing):
+        print('Missing gstreamer plugins:', missing)
+        return False
+    return True
+
+
+if __name__=='__main__':
+    Gst.init(None)
+    if not check_plugins():
+        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('room', help='Room to relay media for')
+    parser.add_argument('--server', default='wss://webrtc.nirbheek.in:8443',
+                        help='Signalling server to connect to, eg "wss://127.0.0.1:8443"')
+    parser.add_argument('--id', default='relay-%d' % random.randrange(10, 10000),
+                        help='Peer id of the relay in the room')
+    args = parser.parse_args()
+    relay = MediaRelay(args.id, args.room, args.server)
+    relay.connect()
+    relay.run()
+    relay.pipe.set_state(Gst.State.NULL)
+    sys.exit(0)
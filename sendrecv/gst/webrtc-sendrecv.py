@@ -2,8 +2,9 @@ import random
 import ssl
 import os
 import sys
-import json
+import time
 import argparse
+import threading
 
 """
 Port of original gstwebrtc-demo with backward compatibility for python 2.7
@@ -21,13 +22,93 @@ from gi.repository import GstWebRTC
 gi.require_version('GstSdp', '1.0')
 from gi.repository import GstSdp
 
+# Message parsing and formatting is shared with the other clients
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'signalling'))
+import signalling_protocol as protocol
+
+# Encoders for the test sources, filled in from a profile. vcaps and venc are
+# what BitrateController adjusts.
+MEDIA_DESC = '''
+ videotestsrc is-live=true pattern=ball ! videoscale ! capsfilter name=vcaps caps=video/x-raw,width={width},height={height} !
+ videoconvert ! queue ! vp8enc name=venc target-bitrate={bitrate} {vp8enc} ! rtpvp8pay !
+ queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 ! {video_sink}.
+ audiotestsrc is-live=true wave=red-noise ! audioconvert ! audioresample ! queue ! opusenc {opusenc} ! rtpopuspay !
+ queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 ! {audio_sink}.
+'''
+
 PIPELINE_DESC = '''
 webrtcbin name=sendrecv bundle-policy=max-bundle
- videotestsrc is-live=true pattern=ball ! videoconvert ! queue ! vp8enc deadline=1 ! rtpvp8pay !
- queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 ! sendrecv.
- audiotestsrc is-live=true wave=red-noise ! audioconvert ! audioresample ! queue ! opusenc ! rtpopuspay !
- queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 ! sendrecv.
-'''
+''' + MEDIA_DESC
+
+# Same encoders, encoding only once for all calls. Each call gets its own
+# webrtcbin fed from the tees, see SharedMedia. The selectors switch the tees
+# over to media forwarded from a call.
+SHARED_PIPELINE_DESC = '''
+input-selector name=videosel sync-streams=false ! tee name=videotee allow-not-linked=true ! queue ! fakesink
+input-selector name=audiosel sync-streams=false ! tee name=audiotee allow-not-linked=true ! queue ! fakesink
+''' + MEDIA_DESC
+
+# How incoming media is handled without decoding it. Depayloaders come with a
+# parser where the muxer needs one.
+DEPAYLOADERS = {
+    'VP8': 'rtpvp8depay',
+    'VP9': 'rtpvp9depay',
+    'H264': 'rtph264depay ! h264parse',
+    'OPUS': 'rtpopusdepay',
+}
+# What can be forwarded to the shared media's calls, as the selector to use
+# and how to payload it again, with the caps they negotiated
+FORWARD = {
+    'VP8': ('videosel', 'rtpvp8pay ! application/x-rtp,media=video,encoding-name=VP8,payload=97'),
+    'OPUS': ('audiosel', 'rtpopuspay ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96'),
+}
+# What the call being forwarded is asked to send, since it is sent nothing
+RECV_CAPS = [
+    'application/x-rtp,media=video,encoding-name=VP8,payload=97,clock-rate=90000',
+    'application/x-rtp,media=audio,encoding-name=OPUS,payload=96,clock-rate=48000',
+]
+MUXERS = {'webm': 'webmmux', 'mkv': 'matroskamux'}
+
+TEES = ['videotee', 'audiotee']
+
+# Encoder settings, the bitrate (in bits/s) and resolution being where
+# BitrateController starts and the most it goes up to.
+PROFILES = {
+    # What this demo always used
+    'default': {
+        'width': 320, 'height': 240, 'bitrate': 256000,
+        'vp8enc': 'deadline=1',
+        'opusenc': '',
+    },
+    # Fastest VP8 speed on a single thread, long opus frames for fewer packets
+    'low-cpu': {
+        'width': 320, 'height': 240, 'bitrate': 200000,
+        'vp8enc': 'deadline=1 cpu-used=16 threads=1 keyframe-max-dist=300 end-usage=cbr',
+        'opusenc': 'frame-size=60',
+    },
+    # No lookahead, frequent keyframes for quick recovery, short opus frames
+    'low-latency': {
+        'width': 640, 'height': 480, 'bitrate': 600000,
+        'vp8enc': 'deadline=1 cpu-used=8 threads=2 lag-in-frames=0 keyframe-max-dist=60 end-usage=cbr',
+        'opusenc': 'frame-size=10',
+    },
+    # Slower VP8 speed with more threads, for more quality per bit
+    'high-quality': {
+        'width': 1280, 'height': 720, 'bitrate': 1500000,
+        'vp8enc': 'deadline=33000 cpu-used=4 threads=4 keyframe-max-dist=150',
+        'opusenc': 'frame-size=20 bitrate=64000',
+    },
+}
+
+# Resolutions stepped down to as the bitrate drops, as (width, height, least
+# bitrate)
+RESOLUTIONS = [(1280, 720, 1000000), (640, 480, 400000), (320, 240, 0)]
+MIN_BITRATE = 100000
+# Seconds between bitrate adjustments
+ADAPT_INTERVAL = 1
+
+def pipeline_desc(desc, profile, video_sink, audio_sink):
+    return desc.format(video_sink=video_sink, audio_sink=audio_sink, **PROFILES[profile])
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -53,8 +134,225 @@ AppState = enum(
   'PEER_CALL_ERROR',
 )
 
+class SharedMedia:
+    '''
+    Pipeline that encodes audio and video once for any number of concurrent
+    calls, each of which adds its own webrtcbin fed from the encoders' tees
+    '''
+    def __init__(self, profile):
+        self.pipe = Gst.parse_launch(pipeline_desc(SHARED_PIPELINE_DESC, profile, 'videosel', 'audiosel'))
+        self.bus = self.pipe.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message', self.on_live_message)
+        # Format: {selector sink pad: forwarding bin}
+        self.forwarded = {}
+        # Webrtcbins of calls that only receive, not linked to the tees
+        self.receivers = set()
+        self.pipe.set_state(Gst.State.PLAYING)
+
+    def on_live_message(self, bus, msg):
+        if msg.type == Gst.MessageType.ERROR:
+            print('---')
+            print(msg.parse_error())
+            print('---')
+
+    def new_webrtcbin(self):
+        '''
+        Create a webrtcbin for a future call, already in READY so that it can
+        be kept in a PipelinePool
+        '''
+        webrtc = Gst.ElementFactory.make('webrtcbin')
+        webrtc.set_property('bundle-policy', GstWebRTC.WebRTCBundlePolicy.MAX_BUNDLE)
+        webrtc.set_state(Gst.State.READY)
+        return webrtc
+
+    def add_call(self, webrtc, send=True):
+        '''
+        Add @webrtc to the pipeline, linked to the tees, or only receiving
+        if not @send, as the call that is forwarded to the others does. Its
+        signals must be connected before it is started with start_call().
+        '''
+        self.pipe.add(webrtc)
+        if not send:
+            self.receivers.add(webrtc)
+            for caps in RECV_CAPS:
+                webrtc.emit('add-transceiver', GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY,
+                            Gst.Caps.from_string(caps))
+            return webrtc
+        for tee_name in TEES:
+            q = Gst.ElementFactory.make('queue', '%s-%s' % (tee_name, webrtc.get_name()))
+            self.pipe.add(q)
+            srcpad = self.pipe.get_by_name(tee_name).get_request_pad('src_%u')
+            srcpad.link(q.get_static_pad('sink'))
+            q.get_static_pad('src').link(webrtc.get_request_pad('sink_%u'))
+        return webrtc
+
+    def start_call(self, webrtc):
+        if webrtc not in self.receivers:
+            for tee_name in TEES:
+                self.pipe.get_by_name('%s-%s' % (tee_name, webrtc.get_name())).sync_state_with_parent()
+        webrtc.sync_state_with_parent()
+
+    def forward(self, bin_, selector_name):
+        '''
+        Send what @bin_ outputs to all calls, in place of the test source
+        going into selector @selector_name
+        '''
+        selector = self.pipe.get_by_name(selector_name)
+        sinkpad = selector.get_request_pad('sink_%u')
+        self.pipe.add(bin_)
+        bin_.get_static_pad('src').link(sinkpad)
+        bin_.sync_state_with_parent()
+        self.forwarded[sinkpad] = bin_
+        selector.set_property('active-pad', sinkpad)
+
+    def remove_call(self, webrtc, elements):
+        '''
+        Remove the webrtcbin of a call that ended, along with its queues and
+        the other @elements added for it
+        '''
+        # Back to the test sources if it was forwarding
+        for sinkpad, bin_ in list(self.forwarded.items()):
+            if bin_ in elements:
+                selector = sinkpad.get_parent_element()
+                selector.set_property('active-pad', selector.get_static_pad('sink_0'))
+                selector.release_request_pad(sinkpad)
+                del self.forwarded[sinkpad]
+        if webrtc in self.receivers:
+            self.receivers.remove(webrtc)
+        else:
+            for tee_name in TEES:
+                q = self.pipe.get_by_name('%s-%s' % (tee_name, webrtc.get_name()))
+                srcpad = q.get_static_pad('sink').get_peer()
+                self.pipe.get_by_name(tee_name).release_request_pad(srcpad)
+                elements.append(q)
+        elements.append(webrtc)
+        for element in elements:
+            element.set_state(Gst.State.NULL)
+            self.pipe.remove(element)
+
+def new_pipeline(profile):
+    '''
+    Build the pipeline for one call, in READY so that it can be kept in a
+    PipelinePool. It goes to PLAYING, and starts negotiating, once claimed.
+    '''
+    pipe = Gst.parse_launch(pipeline_desc(PIPELINE_DESC, profile, 'sendrecv', 'sendrecv'))
+    pipe.set_state(Gst.State.READY)
+    return pipe
+
+def remote_inbound_stats(stats):
+    '''
+    Fraction of packets lost and round trip time, in seconds, from each of
+    the remote-inbound-rtp entries of @stats, ie. from the peer's RTCP
+    receiver reports
+    '''
+    found = []
+    def check(field_id, value, _):
+        if isinstance(value, Gst.Structure) and \
+           value.get_value('type') == GstWebRTC.WebRTCStatsType.REMOTE_INBOUND_RTP:
+            found.append((value.get_value('fraction-lost') or 0,
+                          value.get_value('round-trip-time') or 0))
+        return True
+    stats.foreach(check, None)
+    return found
+
+class BitrateController:
+    '''
+    Adjusts the video bitrate, and resolution, of the encoder in @pipe from
+    the loss and round trip time the receivers report. With shared media all
+    calls get the same stream, so the worst one decides.
+    '''
+    def __init__(self, pipe, profile):
+        self.venc = pipe.get_by_name('venc')
+        self.vcaps = pipe.get_by_name('vcaps')
+        self.max_bitrate = PROFILES[profile]['bitrate']
+        self.max_width = PROFILES[profile]['width']
+        self.bitrate = self.max_bitrate
+        self.resolution = (PROFILES[profile]['width'], PROFILES[profile]['height'])
+        # Format: {webrtcbin: [(fraction_lost, round_trip_time)]}
+        self.reports = {}
+        GLib.timeout_add_seconds(ADAPT_INTERVAL, self.update)
+
+    def add(self, webrtc):
+        self.reports[webrtc] = []
+
+    def remove(self, webrtc):
+        self.reports.pop(webrtc, None)
+
+    def on_stats(self, promise, webrtc, _):
+        # Called from webrtcbin's thread, so only store the result
+        stats = promise.get_reply()
+        if stats and webrtc in self.reports:
+            self.reports[webrtc] = remote_inbound_stats(stats)
+
+    def update(self):
+        reports = [r for rs in list(self.reports.values()) for r in rs]
+        for webrtc in list(self.reports):
+            promise = Gst.Promise.new_with_change_func(self.on_stats, webrtc, None)
+            webrtc.emit('get-stats', None, promise)
+        if not reports:
+            return True
+
+        lost = max(r[0] for r in reports)
+        rtt = max(r[1] for r in reports)
+        bitrate = self.bitrate
+        if lost > 0.1:
+            bitrate *= 1 - lost / 2
+        elif rtt > 0.5:
+            # Queues are building up somewhere on the path
+            bitrate *= 0.85
+        elif lost < 0.02:
+            bitrate *= 1.08
+        bitrate = int(max(MIN_BITRATE, min(self.max_bitrate, bitrate)))
+        if bitrate != self.bitrate:
+            self.bitrate = bitrate
+            self.venc.set_property('target-bitrate', bitrate)
+            print('Video bitrate now %d (loss %.1f%%, rtt %dms)' % (bitrate, lost * 100, rtt * 1000))
+
+        for width, height, least in RESOLUTIONS:
+            if width <= self.max_width and bitrate >= least:
+                break
+        if (width, height) != self.resolution:
+            self.resolution = (width, height)
+            print('Video resolution now %dx%d' % self.resolution)
+            self.vcaps.set_property('caps', Gst.Caps.from_string(
+                'video/x-raw,width=%d,height=%d' % self.resolution))
+        return True
+
+class PipelinePool:
+    '''
+    Pipelines (or webrtcbins, for shared media) built ahead of the calls that
+    use them, to keep plugin loading and element setup out of the time between
+    SESSION_OK and the offer. Claimed ones are replaced from the main loop when
+    @refill is set.
+    '''
+    def __init__(self, build, size, refill=True):
+        self.build = build
+        self.size = size
+        self.refill = refill
+        self.ready = []
+        self.filling = False
+        self.fill()
+
+    def fill(self):
+        while len(self.ready) < self.size:
+            self.ready.append(self.build())
+        self.filling = False
+        # Don't call again
+        return False
+
+    def claim(self):
+        if not self.ready:
+            return self.build()
+        item = self.ready.pop(0)
+        if self.refill and not self.filling:
+            self.filling = True
+            GLib.idle_add(self.fill, priority=GLib.PRIORITY_LOW)
+        return item
+
 class WebRTCClient:
-    def __init__(self, id_, peer_id, server):
+    def __init__(self, id_, peer_id, server, ice_batch_window=0, ice_batch_size=8,
+                 media=None, on_done=None, pool=None, profile='default', controller=None):
         self.id_ = id_
         self.conn = None
         self.pipe = None
@@ -64,6 +362,40 @@ class WebRTCClient:
         self.state = AppState.APP_STATE_UNKNOWN
         self.server = server or 'https://webrtc.nirbheek.in:8443'
         self.session = Soup.Session()
+        # When ice_batch_window (in ms) is set, candidates are sent in batches
+        # of up to ice_batch_size instead of one message each
+        self.ice_batch_window = ice_batch_window
+        self.ice_batch_size = ice_batch_size
+        # on-ice-candidate is emitted from a streaming thread
+        self.ice_lock = threading.Lock()
+        self.ice_pending = []
+        # Set when this is one of several calls sharing encoders, in which
+        # case on_done is called instead of quitting the main loop when the
+        # call ends
+        self.media = media
+        self.on_done = on_done
+        # Set once cleaned up, which errors and the close that follows them
+        # may both ask for
+        self.done = False
+        # Elements added to a shared pipeline for incoming streams
+        self.incoming = []
+        # Where the pipeline, or webrtcbin with shared media, comes from
+        self.pool = pool
+        # To time call setup
+        self.session_ok_time = None
+        # Encoding profile, and the BitrateController of the shared media. A
+        # call with its own pipeline creates its own, unless adapt is False.
+        self.profile = profile
+        self.controller = controller
+        self.adapt = True
+        # What to do with incoming media: decode and play it, or one of
+        # record, appsink, forward or discard, which don't decode
+        self.incoming_mode = 'decode'
+        # With record, the file to write to
+        self.record_path = None
+        self.muxer = None
+        # With appsink, how much was received
+        self.received_bytes = 0
 
 
     def on_error(self, ws, error):
@@ -72,11 +404,17 @@ class WebRTCClient:
     def on_close(self, ws):
         print('Socket is closed')
         self.state = AppState.SERVER_CLOSED
+        # The server closes the connection when the call ends
+        if self.media:
+            self.cleanup_and_quit_loop()
 
     def on_message(self, ws, type, msg):
         message = msg.get_data()
+        if isinstance(message, bytes):
+            message = message.decode()
         print('Socket got message:', message)
-        if message == 'HELLO':
+        msg = protocol.parse(message)
+        if isinstance(msg, protocol.Hello):
             if self.state != AppState.SERVER_REGISTERING:
                 print('ERROR: Received HELLO when not registering')
                 self.cleanup_and_quit_loop()
@@ -88,18 +426,19 @@ class WebRTCClient:
             # Ask signalling server to connect us with a specific peer
             self.setup_call()
 
-        elif message == 'SESSION_OK':
+        elif isinstance(msg, protocol.SessionOk):
             if self.state != AppState.PEER_CONNECTING:
                 print('ERROR: Received SESSION_OK when not calling')
                 self.cleanup_and_quit_loop()
                 return
 
             self.state = AppState.PEER_CONNECTED;
+            self.session_ok_time = time.time()
 
             # Start negotiation (exchange SDP and ICE candidates)
             self.start_pipeline()
 
-        elif message.startswith('ERROR'):
+        elif isinstance(msg, protocol.Error):
             if self.state == AppState.SERVER_CONNECTING:
                 self.state = AppState.SERVER_CONNECTION_ERROR;
             if self.state == AppState.SERVER_REGISTERING:
@@ -114,16 +453,33 @@ class WebRTCClient:
             print(message)
             self.cleanup_and_quit_loop()
 
-        else:
+        elif isinstance(msg, protocol.PeerMsg):
             # Look for JSON messages containing SDP and ICE candidates
-            self.handle_sdp(message)
+            self.handle_sdp(msg.data)
 
     def run(self):
         self.mainloop = GLib.MainLoop()
         self.mainloop.run()
 
     def cleanup_and_quit_loop(self):
-        self.mainloop.quit()
+        if self.done:
+            return
+        self.done = True
+        # On errors the server hasn't closed it, and would otherwise keep the
+        # session until the keepalive gives up on it
+        if self.conn and self.conn.get_state() == Soup.WebsocketState.OPEN:
+            self.conn.close(Soup.WebsocketCloseCode.NORMAL, None)
+        if self.incoming_mode == 'appsink':
+            print('Received %d bytes of media from %s' % (self.received_bytes, self.peer_id))
+        if self.media:
+            if self.webrtc:
+                if self.controller:
+                    self.controller.remove(self.webrtc)
+                self.media.remove_call(self.webrtc, self.incoming)
+                self.webrtc = None
+            self.on_done(self)
+        else:
+            self.mainloop.quit()
 
 
     def connect_result(self, source, result):
@@ -135,7 +491,7 @@ class WebRTCClient:
         self.conn.connect('closed', self.on_close)
 
         self.state = AppState.SERVER_REGISTERING
-        self.conn.send_text('HELLO %d' % self.id_)
+        self.conn.send_text(protocol.hello(self.id_))
 
 
     def connect(self):
@@ -147,7 +503,7 @@ class WebRTCClient:
 
     def setup_call(self):
         self.state = AppState.PEER_CONNECTING
-        self.conn.send_text('SESSION {}'.format(self.peer_id))
+        self.conn.send_text(protocol.session(self.peer_id))
 
     def send_sdp_offer(self, offer):
         if self.state != AppState.PEER_CALL_NEGOTIATING:
@@ -157,8 +513,10 @@ class WebRTCClient:
 
         text = offer.sdp.as_text()
         print ('Sending offer:\n%s' % text)
-        msg = json.dumps({'sdp': {'type': 'offer', 'sdp': text}})
-        self.conn.send_text(msg)
+        self.conn.send_text(protocol.sdp_payload('offer', text))
+        if self.session_ok_time is not None:
+            print('Sent offer %.1fms after SESSION_OK' % ((time.time() - self.session_ok_time) * 1000))
+            self.session_ok_time = None
 
     def on_offer_created(self, promise, _, __):
         if self.state != AppState.PEER_CALL_NEGOTIATING:
@@ -185,8 +543,32 @@ class WebRTCClient:
             self.cleanup_and_quit_loop()
             return
 
-        icemsg = json.dumps({'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}})
-        self.conn.send_text(icemsg)
+        ice = {'candidate': candidate, 'sdpMLineIndex': mlineindex}
+        if not self.ice_batch_window:
+            self.conn.send_text(protocol.ice_payload([ice]))
+            return
+
+        with self.ice_lock:
+            self.ice_pending.append(ice)
+            if len(self.ice_pending) >= self.ice_batch_size:
+                GLib.idle_add(self.flush_ice_candidates)
+            elif len(self.ice_pending) == 1:
+                GLib.timeout_add(self.ice_batch_window, self.flush_ice_candidates)
+
+    def flush_ice_candidates(self, end=False):
+        with self.ice_lock:
+            pending, self.ice_pending = self.ice_pending, []
+        if pending or end:
+            self.conn.send_text(protocol.ice_payload(pending, end))
+        # Don't call again
+        return False
+
+    def on_ice_gathering_state_notify(self, element, _):
+        state = element.get_property('ice-gathering-state')
+        if state == GstWebRTC.WebRTCICEGatheringState.COMPLETE:
+            print('ICE gathering complete')
+            if self.ice_batch_window:
+                GLib.idle_add(self.flush_ice_candidates, True)
 
     def on_incoming_decodebin_stream(self, _, pad):
         if not pad.has_current_caps():
@@ -204,6 +586,7 @@ class WebRTCClient:
             self.pipe.add(q)
             self.pipe.add(conv)
             self.pipe.add(sink)
+            self.incoming += [q, conv, sink]
             self.pipe.sync_children_states()
             pad.link(q.get_static_pad('sink'))
             q.link(conv)
@@ -217,19 +600,85 @@ class WebRTCClient:
             self.pipe.add(conv)
             self.pipe.add(resample)
             self.pipe.add(sink)
+            self.incoming += [q, conv, resample, sink]
             self.pipe.sync_children_states()
             pad.link(q.get_static_pad('sink'))
             q.link(conv)
             conv.link(resample)
             resample.link(sink)
 
+    def on_incoming_sample(self, sink):
+        '''
+        Called from a streaming thread with each depayloaded frame when
+        incoming_mode is appsink. Replace to do something with them.
+        '''
+        sample = sink.emit('pull-sample')
+        self.received_bytes += sample.get_buffer().get_size()
+        return Gst.FlowReturn.OK
+
+    def add_incoming_bin(self, desc):
+        bin_ = Gst.parse_bin_from_description(desc, True)
+        self.pipe.add(bin_)
+        self.incoming.append(bin_)
+        bin_.sync_state_with_parent()
+        return bin_
+
+    def handle_encoded_stream(self, pad):
+        '''
+        Handle an incoming stream without decoding it, as set by incoming_mode
+        '''
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        encoding = caps.get_structure(0).get_value('encoding-name')
+        if self.incoming_mode == 'discard' or encoding not in DEPAYLOADERS:
+            if self.incoming_mode != 'discard':
+                print('Discarding incoming %s stream, no depayloader for it' % encoding)
+            bin_ = self.add_incoming_bin('fakesink async=false')
+        elif self.incoming_mode == 'record':
+            if not self.muxer:
+                # Streamable, so that the file can be played without being
+                # finalized when the call ends
+                fmt = os.path.splitext(self.record_path)[1][1:]
+                self.muxer = Gst.ElementFactory.make(MUXERS[fmt])
+                self.muxer.set_property('streamable', True)
+                filesink = Gst.ElementFactory.make('filesink')
+                filesink.set_property('location', self.record_path)
+                self.pipe.add(self.muxer)
+                self.pipe.add(filesink)
+                self.incoming += [self.muxer, filesink]
+                self.muxer.link(filesink)
+                self.muxer.sync_state_with_parent()
+                filesink.sync_state_with_parent()
+                print('Recording to %s' % self.record_path)
+            bin_ = self.add_incoming_bin('queue ! %s' % DEPAYLOADERS[encoding])
+            bin_.link(self.muxer)
+        elif self.incoming_mode == 'appsink':
+            bin_ = self.add_incoming_bin('queue ! %s ! appsink name=sink emit-signals=true sync=false'
+                                         % DEPAYLOADERS[encoding])
+            bin_.get_by_name('sink').connect('new-sample', self.on_incoming_sample)
+        elif self.incoming_mode == 'forward':
+            if encoding not in FORWARD or not self.media:
+                print('Discarding incoming %s stream, it can only be forwarded as is' % encoding)
+                bin_ = self.add_incoming_bin('fakesink async=false')
+            else:
+                selector_name, payloader = FORWARD[encoding]
+                bin_ = Gst.parse_bin_from_description('queue ! %s ! %s' % (DEPAYLOADERS[encoding], payloader), True)
+                self.incoming.append(bin_)
+                self.media.forward(bin_, selector_name)
+                print('Forwarding %s from %s to the other calls' % (encoding, self.peer_id))
+        pad.link(bin_.get_static_pad('sink'))
+
     def on_incoming_stream(self, _, pad):
         if pad.direction != Gst.PadDirection.SRC:
             return
 
+        if self.incoming_mode != 'decode':
+            self.handle_encoded_stream(pad)
+            return
+
         decodebin = Gst.ElementFactory.make('decodebin')
         decodebin.connect('pad-added', self.on_incoming_decodebin_stream)
         self.pipe.add(decodebin)
+        self.incoming.append(decodebin)
         decodebin.sync_state_with_parent()
         self.webrtc.link(decodebin)
 
@@ -240,24 +689,45 @@ class WebRTCClient:
             print('---')
 
     def start_pipeline(self):
-        print('Starting pipeline')
-        self.pipe = Gst.parse_launch(PIPELINE_DESC)
-        self.bus = self.pipe.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect("message", self.on_live_message)
-        self.webrtc = self.pipe.get_by_name('sendrecv')
+        if self.media:
+            print('Adding call to %s to the shared pipeline' % self.peer_id)
+            self.pipe = self.media.pipe
+            if self.pool:
+                self.webrtc = self.pool.claim()
+            else:
+                self.webrtc = self.media.new_webrtcbin()
+            if self.controller:
+                self.controller.add(self.webrtc)
+            # The call forwarded to the others isn't sent its own media back
+            self.media.add_call(self.webrtc, send=self.incoming_mode != 'forward')
+        else:
+            print('Starting pipeline')
+            if self.pool:
+                self.pipe = self.pool.claim()
+            else:
+                self.pipe = Gst.parse_launch(pipeline_desc(PIPELINE_DESC, self.profile, 'sendrecv', 'sendrecv'))
+            self.bus = self.pipe.get_bus()
+            self.bus.add_signal_watch()
+            self.bus.connect("message", self.on_live_message)
+            self.webrtc = self.pipe.get_by_name('sendrecv')
+            if self.adapt:
+                self.controller = BitrateController(self.pipe, self.profile)
+                self.controller.add(self.webrtc)
         self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
         self.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
+        self.webrtc.connect('notify::ice-gathering-state', self.on_ice_gathering_state_notify)
         self.webrtc.connect('pad-added', self.on_incoming_stream)
-        self.pipe.set_state(Gst.State.PLAYING)
+        if self.media:
+            self.media.start_call(self.webrtc)
+        else:
+            self.pipe.set_state(Gst.State.PLAYING)
 
     def handle_sdp(self, message):
         assert (self.webrtc)
-        msg = json.loads(message)
-        if 'sdp' in msg:
-            sdp = msg['sdp']
-            assert(sdp['type'] == 'answer')
-            sdp = sdp['sdp']
+        msg = protocol.parse_payload(message)
+        if isinstance(msg, protocol.Sdp):
+            assert(msg.type == 'answer')
+            sdp = msg.sdp
             print ('Received answer:\n%s' % sdp)
             res, sdpmsg = GstSdp.SDPMessage.new()
             GstSdp.sdp_message_parse_buffer(bytes(sdp.encode()), sdpmsg)
@@ -265,11 +735,13 @@ class WebRTCClient:
             promise = Gst.Promise.new()
             self.webrtc.emit('set-remote-description', answer, promise)
             promise.interrupt()
-        elif 'ice' in msg:
-            ice = msg['ice']
-            candidate = ice['candidate']
-            sdpmlineindex = ice['sdpMLineIndex']
-            self.webrtc.emit('add-ice-candidate', sdpmlineindex, candidate)
+        elif isinstance(msg, protocol.Ice):
+            for ice in msg.candidates:
+                candidate = ice['candidate']
+                sdpmlineindex = ice['sdpMLineIndex']
+                self.webrtc.emit('add-ice-candidate', sdpmlineindex, candidate)
+            if msg.end:
+                print('Peer is done sending ICE candidates')
 
 
 def check_plugins():
@@ -287,11 +759,73 @@ if __name__=='__main__':
     if not check_plugins():
         sys.exit(1)
     parser = argparse.ArgumentParser()
-    parser.add_argument('peerid', help='String ID of the peer to connect to')
+    parser.add_argument('peerid', nargs='+',
+                        help='String ID of the peer to connect to. With several, all calls are made '
+                             'concurrently, sharing the same encoders.')
     parser.add_argument('--server', help='Signalling server to connect to, eg "wss://127.0.0.1:8443"')
+    parser.add_argument('--ice-batch-window', type=int, default=0,
+                        help='Send ICE candidates in batches gathered over this many ms, 0 to send each one right away')
+    parser.add_argument('--ice-batch-size', type=int, default=8,
+                        help='Maximum number of ICE candidates in a batch')
+    parser.add_argument('--pool-size', type=int, default=1,
+                        help='Number of pipelines built before they are needed, 0 to build each one on SESSION_OK')
+    parser.add_argument('--profile', default='default', choices=sorted(PROFILES),
+                        help='Encoder settings to use')
+    parser.add_argument('--no-adapt', dest='adapt', action='store_false',
+                        help="Don't adjust the video bitrate and resolution to the peers' loss and round trip time")
+    parser.add_argument('--incoming', default='decode', choices=['decode', 'record', 'appsink', 'forward', 'discard'],
+                        help='What to do with incoming media. Only decode decodes it. forward sends the media of '
+                             'the first peer to the others, in place of the test sources.')
+    parser.add_argument('--record-dir', default='.', help='Where to write recordings with --incoming=record')
+    parser.add_argument('--record-format', default='webm', choices=sorted(MUXERS),
+                        help='Container for recordings, mkv also takes H264')
     args = parser.parse_args()
+    if args.incoming == 'forward' and len(args.peerid) < 2:
+        parser.error('--incoming=forward needs peers to forward to')
+
+    def set_incoming(c, mode):
+        c.incoming_mode = mode
+        c.record_path = os.path.join(args.record_dir, '%s-%d.%s' % (c.peer_id, time.time(), args.record_format))
+
     our_id = random.randrange(10, 10000)
-    c = WebRTCClient(our_id, args.peerid, args.server)
-    c.connect()
-    c.run()
+    if len(args.peerid) == 1:
+        # Nothing to refill for, there is only one call
+        pool = None
+        if args.pool_size:
+            pool = PipelinePool(lambda: new_pipeline(args.profile), args.pool_size, refill=False)
+        c = WebRTCClient(our_id, args.peerid[0], args.server, args.ice_batch_window, args.ice_batch_size,
+                         pool=pool, profile=args.profile)
+        c.adapt = args.adapt
+        set_incoming(c, args.incoming)
+        c.connect()
+        c.run()
+        sys.exit(0)
+
+    # One connection to the server per call, since each can only be in one
+    # session, but a single pipeline and main loop for all of them
+    media = SharedMedia(args.profile)
+    controller = BitrateController(media.pipe, args.profile) if args.adapt else None
+    pool = PipelinePool(media.new_webrtcbin, args.pool_size) if args.pool_size else None
+    mainloop = GLib.MainLoop()
+    calls = []
+    def on_done(call):
+        if call not in calls:
+            return
+        calls.remove(call)
+        print('Call to %s ended, %d left' % (call.peer_id, len(calls)))
+        if not calls:
+            mainloop.quit()
+    for i, peer_id in enumerate(args.peerid):
+        c = WebRTCClient(our_id + i * 10000, peer_id, args.server, args.ice_batch_window,
+                         args.ice_batch_size, media, on_done, pool, args.profile, controller)
+        c.mainloop = mainloop
+        # The first peer is the one forwarded to the others
+        if args.incoming == 'forward' and i > 0:
+            set_incoming(c, 'discard')
+        else:
+            set_incoming(c, args.incoming)
+        calls.append(c)
+        c.connect()
+    mainloop.run()
+    media.pipe.set_state(Gst.State.NULL)
     sys.exit(0)
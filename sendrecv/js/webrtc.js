@@ -99,10 +99,15 @@ function onLocalDescription(desc) {
     });
 }
 
-// ICE candidate received from peer, add it to the peer connection
+// ICE candidate received from peer, add it to the peer connection. Peers
+// batching their candidates, or a server coalescing them, send a list.
 function onIncomingICE(ice) {
-    var candidate = new RTCIceCandidate(ice);
-    peer_connection.addIceCandidate(candidate).catch(setError);
+    if (!Array.isArray(ice))
+        ice = [ice];
+    for (var i = 0; i < ice.length; i++) {
+        var candidate = new RTCIceCandidate(ice[i]);
+        peer_connection.addIceCandidate(candidate).catch(setError);
+    }
 }
 
 function onServerMessage(event) {
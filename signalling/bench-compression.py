@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Benchmark of websocket compression for signalling messages
+#
+# Compresses the messages of a call the way permessage-deflate does, for a
+# range of window sizes and memory levels, and reports the bandwidth saved
+# against the CPU time spent and the memory kept per connection. The call is
+# an SDP offer and answer as webrtcbin and a browser write them, with trickled
+# ICE candidates, or SDPs saved from real calls with --sdp.
+#
+
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--sdp', action='append', default=[], help='File with an SDP to use instead of the built-in ones, may be repeated')
+parser.add_argument('--candidates', default=10, type=int, help='Number of ICE candidates sent in a call')
+parser.add_argument('--calls', default=500, type=int, help='Number of calls to compress, for timing')
+
+options = parser.parse_args(sys.argv[1:])
+
+# What permessage-deflate strips from the end of each compressed message
+EMPTY_BLOCK = b'\x00\x00\xff\xff'
+
+def rand_token(n, alphabet='abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'):
+    return ''.join(random.choice(alphabet) for _ in range(n))
+
+def fingerprint():
+    return ':'.join('{:02X}'.format(random.randrange(256)) for _ in range(32))
+
+def webrtcbin_offer():
+    '''
+    An offer laid out like the ones webrtcbin creates for webrtc-sendrecv.py
+    '''
+    ufrag, pwd, fp = rand_token(32), rand_token(32), fingerprint()
+    cname = 'user{}@host-{:08x}'.format(random.randrange(2 ** 31), random.randrange(2 ** 32))
+    lines = ['v=0', 'o=- {} 0 IN IP4 0.0.0.0'.format(random.randrange(2 ** 63)), 's=-', 't=0 0',
+             'a=ice-options:trickle', 'a=group:BUNDLE video0 audio1']
+    for mid, media, pt, rtpmap, extra in [
+            ('video0', 'video', 97, 'VP8/90000', ['a=rtcp-fb:97 nack', 'a=rtcp-fb:97 nack pli', 'a=framerate:30']),
+            ('audio1', 'audio', 96, 'OPUS/48000/2', ['a=rtcp-fb:96 nack pli',
+                                                     'a=fmtp:96 sprop-maxcapturerate=48000;sprop-stereo=0'])]:
+        ssrc = random.randrange(2 ** 32)
+        lines += ['m={} 9 UDP/TLS/RTP/SAVPF {}'.format(media, pt), 'c=IN IP4 0.0.0.0', 'a=setup:actpass',
+                  'a=ice-ufrag:' + ufrag, 'a=ice-pwd:' + pwd, 'a=rtcp-mux', 'a=rtcp-rsize', 'a=sendrecv',
+                  'a=rtpmap:{} {}'.format(pt, rtpmap)] + extra + \
+                 ['a=ssrc:{} msid:{} webrtctransceiver{}'.format(ssrc, cname, mid[-1]),
+                  'a=ssrc:{} cname:{}'.format(ssrc, cname), 'a=mid:' + mid,
+                  'a=fingerprint:sha-256 ' + fp]
+    return '\r\n'.join(lines) + '\r\n'
+
+def browser_answer():
+    '''
+    An answer laid out like the ones browsers send back to webrtcbin
+    '''
+    ufrag, pwd, fp = rand_token(4), rand_token(24), fingerprint()
+    stream = rand_token(36)
+    lines = ['v=0', 'o=- {} 2 IN IP4 127.0.0.1'.format(random.randrange(2 ** 63)), 's=-', 't=0 0',
+             'a=group:BUNDLE video0 audio1', 'a=msid-semantic: WMS ' + stream]
+    for mid, media, pt, rtpmap, extmaps, extra in [
+            ('video0', 'video', 97, 'VP8/90000',
+             ['urn:ietf:params:rtp-hdrext:toffset',
+              'http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time',
+              'urn:3gpp:video-orientation',
+              'http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01',
+              'http://www.webrtc.org/experiments/rtp-hdrext/playout-delay',
+              'http://www.webrtc.org/experiments/rtp-hdrext/video-content-type',
+              'http://www.webrtc.org/experiments/rtp-hdrext/video-timing',
+              'urn:ietf:params:rtp-hdrext:sdes:mid'],
+             ['a=rtcp-fb:97 nack', 'a=rtcp-fb:97 nack pli', 'a=rtcp-fb:97 goog-remb',
+              'a=rtcp-fb:97 transport-cc', 'a=rtcp-fb:97 ccm fir']),
+            ('audio1', 'audio', 96, 'opus/48000/2',
+             ['urn:ietf:params:rtp-hdrext:ssrc-audio-level',
+              'http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01',
+              'urn:ietf:params:rtp-hdrext:sdes:mid'],
+             ['a=rtcp-fb:96 transport-cc', 'a=fmtp:96 minptime=10;useinbandfec=1'])]:
+        ssrc, track = random.randrange(2 ** 32), rand_token(36)
+        lines += ['m={} 9 UDP/TLS/RTP/SAVPF {}'.format(media, pt), 'c=IN IP4 0.0.0.0', 'a=rtcp:9 IN IP4 0.0.0.0',
+                  'a=ice-ufrag:' + ufrag, 'a=ice-pwd:' + pwd, 'a=ice-options:trickle',
+                  'a=fingerprint:sha-256 ' + fp, 'a=setup:active', 'a=mid:' + mid] + \
+                 ['a=extmap:{} {}'.format(i + 1, uri) for i, uri in enumerate(extmaps)] + \
+                 ['a=sendrecv', 'a=msid:{} {}'.format(stream, track), 'a=rtcp-mux', 'a=rtcp-rsize',
+                  'a=rtpmap:{} {}'.format(pt, rtpmap)] + extra + \
+                 ['a=ssrc:{} cname:{}'.format(ssrc, rand_token(16)),
+                  'a=ssrc:{} msid:{} {}'.format(ssrc, stream, track),
+                  'a=ssrc:{} mslabel:{}'.format(ssrc, stream),
+                  'a=ssrc:{} label:{}'.format(ssrc, track)]
+    return '\r\n'.join(lines) + '\r\n'
+
+def candidate(i):
+    foundation, component = random.randrange(2 ** 32), 1
+    addr = '192.168.{}.{}'.format(random.randrange(256), random.randrange(1, 255))
+    kind = ['host', 'srflx', 'relay'][i % 3]
+    return 'candidate:{} {} UDP {} {} {} typ {}'.format(foundation, component, random.randrange(2 ** 31),
+                                                          addr, random.randrange(1024, 65536), kind)
+
+def call_messages():
+    '''
+    What a peer receives from the server during one call, as sent on the wire
+    '''
+    if options.sdp:
+        sdps = [open(path).read() for path in options.sdp]
+    else:
+        sdps = [webrtcbin_offer(), browser_answer()]
+    msgs = [json.dumps({'sdp': {'type': 'offer' if i % 2 == 0 else 'answer', 'sdp': sdp}})
+            for i, sdp in enumerate(sdps)]
+    msgs += [json.dumps({'ice': {'candidate': candidate(i), 'sdpMLineIndex': 0}})
+             for i in range(options.candidates)]
+    return [m.encode() for m in msgs]
+
+def compress_call(msgs, window_bits, mem_level, no_context_takeover):
+    '''
+    Compress and decompress @msgs as both ends of a connection would, returns
+    the number of bytes sent
+    '''
+    sent = 0
+    encoder = decoder = None
+    for msg in msgs:
+        if encoder is None or no_context_takeover:
+            encoder = zlib.compressobj(wbits=-window_bits, memLevel=mem_level)
+            decoder = zlib.decompressobj(wbits=-window_bits)
+        data = encoder.compress(msg) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(EMPTY_BLOCK):
+            data = data[:-4]
+        sent += len(data)
+        assert decoder.decompress(data + EMPTY_BLOCK) == msg
+    return sent
+
+def state_size(window_bits, mem_level):
+    '''
+    zlib's estimate of the memory held by a compressor and a decompressor
+    '''
+    return (1 << (window_bits + 2)) + (1 << (mem_level + 9)) + (1 << window_bits) + 7 * 1024
+
+def run():
+    calls = [call_messages() for _ in range(options.calls)]
+    raw = sum(len(m) for msgs in calls for m in msgs)
+    sizes = [len(m) for m in calls[0]]
+    print('{} calls of {} messages, {} to {} bytes, {} bytes per call'
+          ''.format(len(calls), len(sizes), min(sizes), max(sizes), raw // len(calls)))
+    print('{:<28} {:>10} {:>7} {:>14} {:>16}'.format('settings', 'bytes/call', 'saved', 'CPU us/call', 'state bytes/conn'))
+    configs = [(w, m, False) for w in (9, 12, 15) for m in (1, 5, 8)] + \
+              [(w, 5, True) for w in (9, 12, 15)]
+    for window_bits, mem_level, no_context_takeover in configs:
+        start = time.process_time()
+        sent = sum(compress_call(msgs, window_bits, mem_level, no_context_takeover) for msgs in calls)
+        cpu = time.process_time() - start
+        name = 'window {} mem {}{}'.format(window_bits, mem_level, ' no takeover' if no_context_takeover else '')
+        # Without context takeover, nothing is kept between messages
+        state = 0 if no_context_takeover else state_size(window_bits, mem_level)
+        print('{:<28} {:>10} {:>6.1f}% {:>14.1f} {:>16}'
+              ''.format(name, sent // len(calls), 100 * (1 - sent / raw), cpu / len(calls) * 1e6, state))
+
+run()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# Benchmark of TLS handshakes during a reconnect storm
+#
+# Connects many clients to the server once, as they would be before a
+# restart, then reconnects all of them at once and reports handshakes/s for
+# both rounds. With --resume, clients reconnect with the TLS session they got
+# the first time, as browsers do, so the second round measures resumed
+# handshakes. Each connection is a full websocket handshake followed by HELLO.
+#
+
+import os
+import sys
+import ssl
+import time
+import base64
+import socket
+import struct
+import argparse
+import threading
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
+parser.add_argument('--clients', default=10000, type=int, help='Number of clients reconnecting in the storm')
+parser.add_argument('--concurrency', default=64, type=int, help='Number of handshakes in progress at once')
+parser.add_argument('--resume', action='store_true', help='Reconnect with the TLS session of the first connection')
+parser.add_argument('--server-pid', dest='server_pid', default=None, type=int,
+                    help='Also report the CPU time the server process spent per handshake')
+
+options = parser.parse_args(sys.argv[1:])
+
+url = urllib.parse.urlparse(options.url)
+ADDR_PORT = (url.hostname, url.port or (443 if url.scheme == 'wss' else 80))
+
+sslctx = None
+if url.scheme == 'wss':
+    sslctx = ssl.create_default_context()
+    # FIXME
+    sslctx.check_hostname = False
+    sslctx.verify_mode = ssl.CERT_NONE
+
+def ws_frame(text):
+    '''
+    A masked websocket text frame, as clients must send
+    '''
+    data = text.encode()
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return struct.pack('!BB', 0x81, 0x80 | len(data)) + mask + masked
+
+def connect(n, session=None):
+    '''
+    Connect client @n and register, returns its TLS session and whether the
+    one given was reused
+    '''
+    sock = socket.create_connection(ADDR_PORT)
+    try:
+        if sslctx:
+            sock = sslctx.wrap_socket(sock, server_hostname=ADDR_PORT[0], session=session)
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall('GET / HTTP/1.1\r\nHost: {}:{}\r\nUpgrade: websocket\r\n'
+                     'Connection: Upgrade\r\nSec-WebSocket-Key: {}\r\n'
+                     'Sec-WebSocket-Version: 13\r\n\r\n'.format(*ADDR_PORT, key).encode())
+        reply = b''
+        while b'\r\n\r\n' not in reply:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError('connection closed during handshake')
+            reply += data
+        if not reply.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError(reply.split(b'\r\n', 1)[0].decode())
+        sock.sendall(ws_frame('HELLO bench-handshake-{}-{}'.format(os.getpid(), n)))
+        # The server's HELLO, which may have come with the upgrade reply
+        reply = reply.partition(b'\r\n\r\n')[2]
+        while len(reply) < 7:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError('connection closed before HELLO')
+            reply += data
+        if sslctx:
+            return sock.session, sock.session_reused
+        return None, False
+    finally:
+        sock.close()
+
+def server_cpu():
+    if options.server_pid is None:
+        return 0
+    with open('/proc/{}/stat'.format(options.server_pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def storm(name, sessions):
+    '''
+    Connect all clients at once, with @sessions to resume, returns the new
+    sessions
+    '''
+    lock = threading.Lock()
+    counts = {'failed': 0, 'reused': 0}
+    def run(n):
+        try:
+            session, reused = connect(n, sessions[n])
+        except (OSError, ConnectionError):
+            with lock:
+                counts['failed'] += 1
+            return None
+        if reused:
+            with lock:
+                counts['reused'] += 1
+        return session
+    cpu = server_cpu()
+    start = time.monotonic()
+    with ThreadPoolExecutor(options.concurrency) as pool:
+        new_sessions = list(pool.map(run, range(options.clients)))
+    elapsed = time.monotonic() - start
+    done = options.clients - counts['failed']
+    line = '{:<12} {:>6} connected {:>5} failed {:>6} resumed {:>9.0f} handshakes/s' \
+           ''.format(name, done, counts['failed'], counts['reused'], done / elapsed)
+    if options.server_pid is not None and done:
+        line += ' {:>7.0f} us server CPU/handshake'.format((server_cpu() - cpu) / done * 1e6)
+    print(line)
+    return new_sessions
+
+sessions = storm('initial', [None] * options.clients)
+if not options.resume:
+    sessions = [None] * options.clients
+storm('reconnect', sessions)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the memory used by idle connections to the signalling server
+#
+# Opens increasing numbers of idle connections that said HELLO, and reports
+# how much the resident memory of the server grew per connection, for
+# capacity planning. The server must run as a single process, and both it and
+# this benchmark need a file descriptor limit above the number of connections
+# (ulimit -n). Connections to localhost are spread over several source
+# addresses, since each one only has about 28000 ephemeral ports. With
+# --compression, connections offer permessage-deflate as browsers do, so that
+# the server keeps compression state for each of them.
+#
+
+import os
+import sys
+import ssl
+import time
+import base64
+import socket
+import struct
+import argparse
+import ipaddress
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
+parser.add_argument('--server-pid', dest='server_pid', required=True, type=int, help='Process id of the server')
+parser.add_argument('--counts', default='10000,50000,100000', help='Comma-separated numbers of connections to report at')
+parser.add_argument('--concurrency', default=64, type=int, help='Number of connections opened at once')
+parser.add_argument('--per-source', dest='per_source', default=20000, type=int,
+                    help='Connections per source address, when connecting to a loopback address')
+parser.add_argument('--compression', action='store_true', help='Offer permessage-deflate')
+
+options = parser.parse_args(sys.argv[1:])
+
+url = urllib.parse.urlparse(options.url)
+ADDR_PORT = (url.hostname, url.port or (443 if url.scheme == 'wss' else 80))
+LOOPBACK = ipaddress.ip_address(socket.gethostbyname(ADDR_PORT[0])).is_loopback
+
+EXTENSIONS = ''
+if options.compression:
+    EXTENSIONS = 'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+
+sslctx = None
+if url.scheme == 'wss':
+    sslctx = ssl.create_default_context()
+    # FIXME
+    sslctx.check_hostname = False
+    sslctx.verify_mode = ssl.CERT_NONE
+
+def ws_frame(text):
+    '''
+    A masked websocket text frame, as clients must send
+    '''
+    data = text.encode()
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return struct.pack('!BB', 0x81, 0x80 | len(data)) + mask + masked
+
+def connect(n):
+    '''
+    Open connection @n and register, returns the socket, left open
+    '''
+    source = None
+    if LOOPBACK:
+        source = ('127.0.0.{}'.format(1 + n // options.per_source), 0)
+    sock = socket.create_connection(ADDR_PORT, source_address=source)
+    if sslctx:
+        sock = sslctx.wrap_socket(sock, server_hostname=ADDR_PORT[0])
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall('GET / HTTP/1.1\r\nHost: {}:{}\r\nUpgrade: websocket\r\n'
+                 'Connection: Upgrade\r\nSec-WebSocket-Key: {}\r\n'
+                 'Sec-WebSocket-Version: 13\r\n{}\r\n'.format(*ADDR_PORT, key, EXTENSIONS).encode())
+    reply = b''
+    while b'\r\n\r\n' not in reply:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('connection closed during handshake')
+        reply += data
+    if not reply.startswith(b'HTTP/1.1 101'):
+        raise ConnectionError(reply.split(b'\r\n', 1)[0].decode())
+    sock.sendall(ws_frame('HELLO bench-memory-{}-{}'.format(os.getpid(), n)))
+    # The server's HELLO, which may have come with the upgrade reply. It is
+    # short enough for its length to fit in the second byte of the frame.
+    reply = reply.partition(b'\r\n\r\n')[2]
+    while len(reply) < 2 or len(reply) < 2 + (reply[1] & 0x7f):
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('connection closed before HELLO')
+        reply += data
+    return sock
+
+def server_rss():
+    with open('/proc/{}/status'.format(options.server_pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('no VmRSS for pid {}'.format(options.server_pid))
+
+def try_connect(n):
+    try:
+        return connect(n)
+    except OSError as e:
+        return e
+
+def run():
+    counts = sorted(int(c) for c in options.counts.split(','))
+    socks = []
+    base = server_rss()
+    print('Server RSS with no connections: {:.1f} MB'.format(base / 2 ** 20))
+    print('{:>12} {:>12} {:>16}'.format('connections', 'RSS MB', 'bytes/connection'))
+    with ThreadPoolExecutor(options.concurrency) as pool:
+        for count in counts:
+            results = list(pool.map(try_connect, range(len(socks), count)))
+            socks.extend(r for r in results if isinstance(r, socket.socket))
+            errors = [r for r in results if not isinstance(r, socket.socket)]
+            # Let the server finish with the last handshakes
+            time.sleep(2)
+            rss = server_rss()
+            print('{:>12} {:>12.1f} {:>16.0f}'.format(len(socks), rss / 2 ** 20, (rss - base) / max(len(socks), 1)))
+            if errors:
+                print('{} connections failed, stopping: {}'.format(len(errors), errors[0]))
+                break
+    for sock in socks:
+        sock.close()
+
+run()
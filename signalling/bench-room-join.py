@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Benchmark for room join latency against the signalling server
+#
+# Fills a room with N peers, then measures how long it takes for one more
+# peer to get ROOM_OK and for every existing member to see ROOM_PEER_JOINED.
+#
+
+import sys
+import ssl
+import time
+import uuid
+import asyncio
+import websockets
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
+parser.add_argument('--sizes', default='10,100,1000', help='Comma-separated list of room sizes to measure')
+parser.add_argument('--joins', default=5, type=int, help='Number of timed joins per room size')
+
+options = parser.parse_args(sys.argv[1:])
+
+SERVER_ADDR = options.url
+ROOM_SIZES = [int(n) for n in options.sizes.split(',')]
+
+sslctx = None
+if SERVER_ADDR.startswith(('wss://', 'https://')):
+    sslctx = ssl.create_default_context()
+    # FIXME
+    sslctx.check_hostname = False
+    sslctx.verify_mode = ssl.CERT_NONE
+
+class Member:
+    '''
+    A peer sitting in a room, recording when it sees each peer join
+    '''
+    def __init__(self, ws):
+        self.ws = ws
+        self.joined = dict()
+        self.waiters = dict()
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        try:
+            async for msg in self.ws:
+                if msg.startswith('ROOM_PEER_JOINED'):
+                    _, peer_id = msg.split(maxsplit=1)
+                    self.joined[peer_id] = time.perf_counter()
+                    if peer_id in self.waiters:
+                        self.waiters.pop(peer_id).set_result(None)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def wait_joined(self, peer_id):
+        if peer_id in self.joined:
+            return self.joined[peer_id]
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[peer_id] = fut
+        await fut
+        return self.joined[peer_id]
+
+async def connect(peer_id):
+    ws = await websockets.connect(SERVER_ADDR, ssl=sslctx, max_queue=None)
+    await ws.send('HELLO ' + peer_id)
+    assert(await ws.recv() == 'HELLO')
+    return ws
+
+async def join(ws, room_id):
+    await ws.send('ROOM {}'.format(room_id))
+    msg = await ws.recv()
+    assert msg.startswith('ROOM_OK'), msg
+
+async def fill_room(room_id, size):
+    members = []
+    # Connect in batches so we don't trip over the server's accept backlog
+    for i in range(0, size, 100):
+        batch = min(100, size - i)
+        wss = await asyncio.gather(*[connect('bench-' + str(uuid.uuid4())[:8])
+                                     for _ in range(batch)])
+        for ws in wss:
+            await join(ws, room_id)
+            members.append(Member(ws))
+    return members
+
+async def timed_join(room_id, members):
+    peer_id = 'bench-' + str(uuid.uuid4())[:8]
+    ws = await connect(peer_id)
+    start = time.perf_counter()
+    await join(ws, room_id)
+    room_ok = time.perf_counter() - start
+    seen = await asyncio.gather(*[m.wait_joined(peer_id) for m in members])
+    all_seen = max(seen) - start
+    return ws, room_ok, all_seen
+
+def fmt_ms(secs):
+    return '{:.2f}ms'.format(secs * 1000)
+
+async def run():
+    print('{:>6} {:>12} {:>12} {:>12}'.format('size', 'ROOM_OK', 'all JOINED', 'worst JOINED'))
+    for size in ROOM_SIZES:
+        room_id = 'bench-room-' + str(uuid.uuid4())[:8]
+        members = await fill_room(room_id, size)
+        room_oks = []
+        all_seens = []
+        for _ in range(options.joins):
+            ws, room_ok, all_seen = await timed_join(room_id, members)
+            room_oks.append(room_ok)
+            all_seens.append(all_seen)
+            # Keep the room at the requested size for the next join
+            await ws.close()
+        print('{:>6} {:>12} {:>12} {:>12}'.format(size,
+              fmt_ms(sum(room_oks) / len(room_oks)),
+              fmt_ms(sum(all_seens) / len(all_seens)),
+              fmt_ms(max(all_seens))))
+        await asyncio.gather(*[m.ws.close() for m in members])
+
+try:
+    asyncio.get_event_loop().run_until_complete(run())
+except websockets.exceptions.InvalidHandshake:
+    print('Invalid handshake: are you sure this is a websockets server?\n')
+    raise
+except ssl.SSLError:
+    print('SSL Error: are you sure the server is using TLS?\n')
+    raise
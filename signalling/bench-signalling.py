@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# Load generator and latency benchmark for the signalling server
+#
+# Connects many simulated peers that pair up in sessions or share rooms, then
+# exchange SDP and ICE sized JSON messages and time how long the server takes
+# to relay them.
+#
+
+import sys
+import ssl
+import json
+import time
+import uuid
+import random
+import asyncio
+import resource
+import websockets
+import argparse
+
+import signalling_protocol as protocol
+from signalling_client import SignallingClient
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
+parser.add_argument('--mode', default='session', choices=['session', 'room'], help='Pair peers up in sessions, or put them in rooms')
+parser.add_argument('--peers', default=1000, type=int, help='Number of simulated peers')
+parser.add_argument('--room-size', dest='room_size', default=10, type=int, help='Number of peers in each room')
+parser.add_argument('--messages', default=50, type=int, help='Number of messages sent by each peer')
+parser.add_argument('--rate', default=20, type=float, help='Messages per second sent by each peer')
+parser.add_argument('--concurrency', default=100, type=int, help='Number of connections opened at once')
+parser.add_argument('--binary', action='store_true', help='Relay messages as binary frames')
+parser.add_argument('--compression', default='deflate', choices=['deflate', 'off'], help='Offer permessage-deflate to the server')
+parser.add_argument('--deflate-window-bits', dest='deflate_window_bits', default=12, type=int, help='Compression window, as a power of two')
+parser.add_argument('--deflate-mem-level', dest='deflate_mem_level', default=5, type=int, help='zlib memory level of the compressor')
+parser.add_argument('--deflate-no-context-takeover', dest='deflate_no_context_takeover', action='store_true',
+                    help='Compress each message on its own')
+
+options = parser.parse_args(sys.argv[1:])
+
+SERVER_ADDR = options.url
+
+sslctx = None
+if SERVER_ADDR.startswith(('wss://', 'https://')):
+    sslctx = ssl.create_default_context()
+    # FIXME
+    sslctx.check_hostname = False
+    sslctx.verify_mode = ssl.CERT_NONE
+
+# Roughly what webrtcbin produces for one audio and one video stream
+SDP = '\r\n'.join(['v=0', 'o=- 1234567890 0 IN IP4 0.0.0.0', 's=-', 't=0 0'] +
+                  ['a=candidate:1 1 UDP 2015363327 192.168.1.{} 45678 typ host'.format(i)
+                   for i in range(40)] +
+                  ['a=rtpmap:{} VP8/90000'.format(96 + i) for i in range(30)])
+ICE = 'candidate:1 1 UDP 2015363327 192.168.1.10 45678 typ host generation 0'
+
+class Peer:
+    '''
+    A simulated peer, recording the relay latency of everything it receives
+    '''
+    def __init__(self, peer_id, latencies):
+        self.peer_id = peer_id
+        self.latencies = latencies
+        # No pings of our own, the server's are enough
+        self.client = SignallingClient(SERVER_ADDR, peer_id, sslctx, keepalive=None,
+                                       on_message=self.on_message, binary=options.binary,
+                                       compression=None if options.compression == 'off' else 'deflate',
+                                       window_bits=options.deflate_window_bits,
+                                       mem_level=options.deflate_mem_level,
+                                       no_context_takeover=options.deflate_no_context_takeover)
+
+    def on_message(self, msg):
+        if isinstance(msg, (protocol.PeerMsg, protocol.RoomPeerMsg)):
+            sent = json.loads(msg.data)['ts']
+            self.latencies.append(time.perf_counter() - sent)
+
+    async def send(self, msg, peer_id):
+        msg['ts'] = time.perf_counter()
+        await self.client.send(json.dumps(msg), peer_id)
+
+    async def talk(self, dest_ids, in_room):
+        '''
+        Send an SDP followed by ICE candidates at the configured rate, cycling
+        through @dest_ids
+        '''
+        for i in range(options.messages):
+            peer_id = dest_ids[i % len(dest_ids)]
+            if i < len(dest_ids):
+                msg = {'sdp': {'type': 'offer', 'sdp': SDP}}
+            else:
+                msg = {'ice': {'candidate': ICE, 'sdpMLineIndex': 0}}
+            # Messages in a session go to the other peer without a prefix
+            await self.send(msg, peer_id if in_room else None)
+            await asyncio.sleep(random.expovariate(options.rate))
+
+async def connect(latencies):
+    peer = Peer('bench-' + str(uuid.uuid4())[:8], latencies)
+    await peer.client.connect()
+    return peer
+
+async def connect_all(latencies):
+    peers = []
+    for i in range(0, options.peers, options.concurrency):
+        batch = min(options.concurrency, options.peers - i)
+        peers += await asyncio.gather(*[connect(latencies) for _ in range(batch)])
+    return peers
+
+async def setup_sessions(peers):
+    '''
+    Pair up consecutive peers, returns who each peer talks to
+    '''
+    pairs = list(zip(peers[::2], peers[1::2]))
+    await asyncio.gather(*[a.client.session(b.peer_id) for a, b in pairs])
+    talks = []
+    for a, b in pairs:
+        talks += [(a, [b.peer_id], False), (b, [a.peer_id], False)]
+    return talks
+
+async def setup_rooms(peers):
+    '''
+    Put peers in rooms of ROOM_SIZE, returns who each peer talks to
+    '''
+    talks = []
+    for i in range(0, len(peers), options.room_size):
+        members = peers[i:i + options.room_size]
+        room_id = 'bench-room-' + str(uuid.uuid4())[:8]
+        # Join one by one, so the ROOM_OKs don't cross ROOM_PEER_JOINEDs
+        for peer in members:
+            await peer.client.join_room(room_id)
+        for peer in members:
+            others = [p.peer_id for p in members if p is not peer]
+            if others:
+                talks.append((peer, others, True))
+    return talks
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def fmt_ms(secs):
+    return '{:.2f}ms'.format(secs * 1000)
+
+async def run():
+    latencies = []
+    start = time.perf_counter()
+    peers = await connect_all(latencies)
+    elapsed = time.perf_counter() - start
+    print('Connected {} peers in {:.2f}s: {:.0f} connections/s'
+          ''.format(len(peers), elapsed, len(peers) / elapsed))
+
+    if options.mode == 'session':
+        talks = await setup_sessions(peers)
+    else:
+        talks = await setup_rooms(peers)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[peer.talk(dest_ids, in_room) for peer, dest_ids, in_room in talks])
+    # Give the last messages a chance to arrive
+    expected = len(talks) * options.messages
+    for _ in range(50):
+        if len(latencies) >= expected:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+
+    print('Relayed {} of {} messages in {:.2f}s: {:.0f} messages/s'
+          ''.format(len(latencies), expected, elapsed, len(latencies) / elapsed))
+    if latencies:
+        latencies.sort()
+        print('Relay latency: p50 {}, p99 {}, p999 {}, max {}'
+              ''.format(fmt_ms(percentile(latencies, 0.5)),
+                        fmt_ms(percentile(latencies, 0.99)),
+                        fmt_ms(percentile(latencies, 0.999)),
+                        fmt_ms(latencies[-1])))
+    await asyncio.gather(*[p.client.close() for p in peers])
+
+# Every peer needs a file descriptor
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+if soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+try:
+    asyncio.get_event_loop().run_until_complete(run())
+except websockets.exceptions.InvalidHandshake:
+    print('Invalid handshake: are you sure this is a websockets server?\n')
+    raise
+except ssl.SSLError:
+    print('SSL Error: are you sure the server is using TLS?\n')
+    raise
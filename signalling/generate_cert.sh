@@ -1,3 +1,8 @@
 #! /bin/bash
 
-openssl req -x509 -newkey rsa:4096 -keyout key.pem -out cert.pem -days 365 -nodes
+if [ "$1" = "ecdsa" ]; then
+    # Used alongside the RSA certificate for the clients that support it
+    openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -keyout key-ecdsa.pem -out cert-ecdsa.pem -days 365 -nodes
+else
+    openssl req -x509 -newkey rsa:4096 -keyout key.pem -out cert.pem -days 365 -nodes
+fi
@@ -15,6 +15,9 @@ import asyncio
 import websockets
 import argparse
 
+import signalling_protocol as protocol
+from signalling_client import SignallingClient, SignallingError
+
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
 parser.add_argument('--room', default=None, help='the room to join')
@@ -28,7 +31,7 @@ if ROOM_ID is None:
     print('--room argument is required')
     sys.exit(1)
 
-sslctx = False
+sslctx = None
 if SERVER_ADDR.startswith(('wss://', 'https://')):
     sslctx = ssl.create_default_context()
     # FIXME
@@ -39,61 +42,55 @@ def get_answer_sdp(offer, peer_id):
     # Here we'd parse the incoming JSON message for ICE and SDP candidates
     print("Got: " + offer)
     sdp = json.dumps({'sdp': 'reply sdp'})
-    answer = 'ROOM_PEER_MSG {} {}'.format(peer_id, sdp)
-    print("Sent: " + answer)
-    return answer
+    print("Sent: " + protocol.room_peer_msg(peer_id, sdp))
+    return sdp
 
 def get_offer_sdp(peer_id):
     sdp = json.dumps({'sdp': 'initial sdp'})
-    offer = 'ROOM_PEER_MSG {} {}'.format(peer_id, sdp)
-    print("Sent: " + offer)
-    return offer
+    print("Sent: " + protocol.room_peer_msg(peer_id, sdp))
+    return sdp
 
 async def hello():
-    async with websockets.connect(SERVER_ADDR, ssl=sslctx) as ws:
-        await ws.send('HELLO ' + PEER_ID)
-        assert(await ws.recv() == 'HELLO')
-
-        await ws.send('ROOM {}'.format(ROOM_ID))
+    client = SignallingClient(SERVER_ADDR, PEER_ID, sslctx)
+    await client.connect()
+    try:
+        try:
+            room_peers = await client.join_room(ROOM_ID)
+        except SignallingError as e:
+            # On error, we bring down the webrtc pipeline, etc
+            print('{!r}, exiting'.format(str(e)))
+            return
+        print('Got ROOM_OK for room {!r}'.format(ROOM_ID))
 
         sent_offers = set()
+        for peer_id in room_peers:
+            print('Sending offer to {!r}'.format(peer_id))
+            # Create a peer connection for each peer and start
+            # exchanging SDP and ICE candidates
+            await client.send(get_offer_sdp(peer_id), peer_id)
+            sent_offers.add(peer_id)
+
         # Receive messages
-        while True:
-            msg = await ws.recv()
-            if msg.startswith('ERROR'):
-                # On error, we bring down the webrtc pipeline, etc
-                print('{!r}, exiting'.format(msg))
+        async for msg in client:
+            if isinstance(msg, protocol.Error):
+                print('{!r}, exiting'.format(msg.reason))
                 return
-            if msg.startswith('ROOM_OK'):
-                print('Got ROOM_OK for room {!r}'.format(ROOM_ID))
-                _, *room_peers = msg.split()
-                for peer_id in room_peers:
-                    print('Sending offer to {!r}'.format(peer_id))
-                    # Create a peer connection for each peer and start
-                    # exchanging SDP and ICE candidates
-                    await ws.send(get_offer_sdp(peer_id))
-                    sent_offers.add(peer_id)
-                continue
-            elif msg.startswith('ROOM_PEER'):
-                if msg.startswith('ROOM_PEER_JOINED'):
-                    _, peer_id = msg.split(maxsplit=1)
-                    print('Peer {!r} joined the room'.format(peer_id))
-                    # Peer will send us an offer
+            elif isinstance(msg, protocol.RoomPeerJoined):
+                print('Peer {!r} joined the room'.format(msg.peer_id))
+                # Peer will send us an offer
+            elif isinstance(msg, protocol.RoomPeerLeft):
+                print('Peer {!r} left the room'.format(msg.peer_id))
+            elif isinstance(msg, protocol.RoomPeerMsg):
+                if msg.peer_id in sent_offers:
+                    print('Got answer from {!r}: {}'.format(msg.peer_id, msg.data))
                     continue
-                if msg.startswith('ROOM_PEER_LEFT'):
-                    _, peer_id = msg.split(maxsplit=1)
-                    print('Peer {!r} left the room'.format(peer_id))
-                    continue
-                elif msg.startswith('ROOM_PEER_MSG'):
-                    _, peer_id, msg = msg.split(maxsplit=2)
-                    if peer_id in sent_offers:
-                        print('Got answer from {!r}: {}'.format(peer_id, msg))
-                        continue
-                    print('Got offer from {!r}, replying'.format(peer_id))
-                    await ws.send(get_answer_sdp(msg, peer_id))
-                    continue
-            print('Unknown msg: {!r}, exiting'.format(msg))
-            return
+                print('Got offer from {!r}, replying'.format(msg.peer_id))
+                await client.send(get_answer_sdp(msg.data, msg.peer_id), msg.peer_id)
+            else:
+                print('Unknown msg: {!r}, exiting'.format(msg))
+                return
+    finally:
+        await client.close()
 
 print('Our uid is {!r}'.format(PEER_ID))
 
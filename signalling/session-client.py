@@ -15,6 +15,9 @@ import asyncio
 import websockets
 import argparse
 
+import signalling_protocol as protocol
+from signalling_client import SignallingClient, SignallingError
+
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--url', default='wss://localhost:8443', help='URL to connect to')
 parser.add_argument('--call', default=None, help='uid of peer to call')
@@ -25,7 +28,7 @@ SERVER_ADDR = options.url
 CALLEE_ID = options.call
 PEER_ID = 'ws-test-client-' + str(uuid.uuid4())[:6]
 
-sslctx = False
+sslctx = None
 if SERVER_ADDR.startswith(('wss://', 'https://')):
     sslctx = ssl.create_default_context()
     # FIXME
@@ -45,35 +48,34 @@ def send_sdp_ice():
     return reply
 
 async def hello():
-    async with websockets.connect(SERVER_ADDR, ssl=sslctx) as ws:
-        await ws.send('HELLO ' + PEER_ID)
-        assert(await ws.recv() == 'HELLO')
-
+    client = SignallingClient(SERVER_ADDR, PEER_ID, sslctx)
+    await client.connect()
+    try:
         # Initiate call if requested
         if CALLEE_ID:
-            await ws.send('SESSION {}'.format(CALLEE_ID))
+            try:
+                await client.session(CALLEE_ID)
+            except SignallingError as e:
+                # On error, we bring down the webrtc pipeline, etc
+                print('{!r}, exiting'.format(str(e)))
+                return
+            await client.send(send_sdp_ice())
 
         # Receive messages
-        sent_sdp = False
-        while True:
-            msg = await ws.recv()
-            if msg.startswith('ERROR'):
-                # On error, we bring down the webrtc pipeline, etc
-                print('{!r}, exiting'.format(msg))
+        async for msg in client:
+            if isinstance(msg, protocol.Error):
+                print('{!r}, exiting'.format(msg.reason))
+                return
+            if not isinstance(msg, protocol.PeerMsg):
+                print('Unknown reply: {!r}, exiting'.format(msg))
                 return
-            if sent_sdp:
-                print('Got reply sdp: ' + msg)
-                return # Done
             if CALLEE_ID:
-                if msg == 'SESSION_OK':
-                    await ws.send(send_sdp_ice())
-                    sent_sdp = True
-                else:
-                    print('Unknown reply: {!r}, exiting'.format(msg))
-                    return
+                print('Got reply sdp: ' + msg.data)
             else:
-                await ws.send(reply_sdp_ice(msg))
-                return # Done
+                await client.send(reply_sdp_ice(msg.data))
+            return # Done
+    finally:
+        await client.close()
 
 print('Our uid is {!r}'.format(PEER_ID))
 
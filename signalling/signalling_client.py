@@ -0,0 +1,247 @@
+#
+# Asyncio client for the signalling server
+#
+# Wraps one websocket connection to the server: registers with HELLO, turns
+# what the server sends into the messages of signalling_protocol, matches
+# SESSION, ROOM and ROOM_PEER_LIST to their replies, and optionally
+# reconnects when the connection is lost. It only costs a task per client, so
+# that load generators can run thousands of them in one process.
+#
+
+import random
+import asyncio
+import secrets
+import collections
+import websockets
+
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+import signalling_protocol as protocol
+
+# Given to the application after a reconnection. If it was in a room, it was
+# joined again, and peer_ids are the peers in it, as with ROOM_OK. resumed is
+# set if the server kept our room or session for us across a restart, in
+# which case the other peers weren't told that we left and nothing needs to
+# be negotiated again.
+Reconnected = collections.namedtuple('Reconnected', ['peer_ids', 'resumed'])
+
+class SignallingError(Exception):
+    '''
+    The server refused a request, or the connection was lost before it
+    replied
+    '''
+
+class SignallingClient:
+    '''
+    Client for the server at @url, registered as @peer_id
+
+    Messages that aren't replies to a request are passed to @on_message when
+    set, or else can be read by iterating over the client. Iteration stops
+    once the connection is closed for good. This includes errors about
+    messages sent to other peers, which don't fail a pending request.
+
+    @keepalive: seconds between pings, None to only answer the server's
+    @reconnect: reconnect when the connection is lost, waiting between
+                @min_backoff and @max_backoff seconds between attempts
+    @resume: register with a resume token, so that the server can put us back
+             in our room or session after a restart. Needs a server run with
+             --state-file or one that knows to ignore the token.
+    @binary: send messages for other peers as binary frames if the server
+             supports it
+    @compression: 'deflate' to offer permessage-deflate with a window of
+                  2^@window_bits bytes and zlib's @mem_level, and
+                  @no_context_takeover to compress each message on its own,
+                  or None
+    '''
+    def __init__(self, url, peer_id, sslctx=None, keepalive=20, reconnect=False,
+                 min_backoff=0.5, max_backoff=30, on_message=None, max_queue=None,
+                 binary=False, compression='deflate', window_bits=12, mem_level=5,
+                 no_context_takeover=False, resume=False):
+        self.url = url
+        self.peer_id = peer_id
+        self.sslctx = sslctx
+        self.keepalive = keepalive
+        self.reconnect = reconnect
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_message = on_message
+        self.max_queue = max_queue
+        self.binary = binary
+        self.token = secrets.token_urlsafe(16) if resume else None
+        self.extensions = None
+        if compression == 'deflate':
+            self.extensions = [ClientPerMessageDeflateFactory(
+                server_no_context_takeover=no_context_takeover,
+                client_no_context_takeover=no_context_takeover,
+                server_max_window_bits=window_bits,
+                client_max_window_bits=window_bits,
+                compress_settings={'memLevel': mem_level})]
+        # Whether the server agreed to binary frames
+        self.framed = False
+        self.ws = None
+        self.reader = None
+        self.closing = False
+        # Room to join again after reconnecting
+        self.room_id = None
+        # Whether the server resumed our room or session on the last HELLO
+        self.resumed = False
+        # Requests waiting for their reply, which the server sends in order,
+        # with the reasons of the errors they may be refused with
+        # Format: deque([(reply type, future, error reasons)])
+        self.pending = collections.deque()
+        # Messages not taken by on_message, None once closed
+        self.messages = asyncio.Queue()
+
+    async def connect(self):
+        await self.open()
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def open(self):
+        '''
+        Connect and register, then join our room again if we were in one and
+        the server didn't keep it for us
+        '''
+        self.ws = await websockets.connect(self.url, ssl=self.sslctx or None,
+                                           ping_interval=self.keepalive,
+                                           ping_timeout=self.keepalive,
+                                           max_queue=self.max_queue,
+                                           compression=None, extensions=self.extensions,
+                                           subprotocols=[protocol.BINARY_SUBPROTOCOL] if self.binary else None)
+        self.framed = self.ws.subprotocol == protocol.BINARY_SUBPROTOCOL
+        await self.ws.send(protocol.hello(self.peer_id, self.token))
+        msg = protocol.parse(await self.ws.recv())
+        self.resumed = isinstance(msg, protocol.Resumed)
+        if self.resumed:
+            return msg.peer_ids
+        if not isinstance(msg, protocol.Hello):
+            raise SignallingError('unexpected reply to HELLO: {!r}'.format(msg))
+        if self.room_id is None:
+            return None
+        # Nothing else can come before the reply since we are in no room
+        await self.ws.send(protocol.room(self.room_id))
+        msg = protocol.parse(await self.ws.recv())
+        if not isinstance(msg, protocol.RoomOk):
+            raise SignallingError('could not join room {!r} again: {!r}'.format(self.room_id, msg))
+        return msg.peer_ids
+
+    async def read(self):
+        while True:
+            try:
+                async for data in self.ws:
+                    if isinstance(data, str):
+                        self.dispatch(protocol.parse(data))
+                    else:
+                        self.dispatch(protocol.parse_frame_msg(data))
+            except websockets.ConnectionClosed:
+                pass
+            while self.pending:
+                _, future, _ = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(SignallingError('connection closed'))
+            if self.closing or not self.reconnect:
+                self.messages.put_nowait(None)
+                return
+            peer_ids = await self.reopen()
+            if peer_ids is None:
+                self.messages.put_nowait(None)
+                return
+            self.dispatch(Reconnected(peer_ids, self.resumed))
+
+    async def reopen(self):
+        '''
+        Reconnect with exponential backoff and jitter, so that many clients
+        losing their connection at once don't all come back at once
+        '''
+        delay = self.min_backoff
+        while not self.closing:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                return await self.open() or []
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException, SignallingError):
+                delay = min(delay * 2, self.max_backoff)
+        return None
+
+    def dispatch(self, msg):
+        if self.pending:
+            reply_type, future, errors = self.pending[0]
+            if isinstance(msg, reply_type) or \
+               (isinstance(msg, protocol.Error) and msg.reason in errors):
+                self.pending.popleft()
+                if not future.done():
+                    future.set_result(msg)
+                return
+        if self.on_message:
+            self.on_message(msg)
+        else:
+            self.messages.put_nowait(msg)
+
+    async def request(self, text, reply_type, errors=()):
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((reply_type, future, errors))
+        await self.ws.send(text)
+        msg = await future
+        if isinstance(msg, protocol.Error):
+            raise SignallingError(msg.reason)
+        return msg
+
+    async def session(self, peer_id):
+        '''
+        Start a session with @peer_id, after which everything sent goes to it
+        '''
+        await self.request(protocol.session(peer_id), protocol.SessionOk, protocol.session_errors(peer_id))
+
+    async def join_room(self, room_id):
+        '''
+        Join @room_id, returns the ids of the peers already in it
+        '''
+        msg = await self.request(protocol.room(room_id), protocol.RoomOk, protocol.room_errors(room_id))
+        self.room_id = room_id
+        return msg.peer_ids
+
+    async def room_peers(self):
+        msg = await self.request(protocol.room_peer_list(), protocol.RoomPeerList)
+        return msg.peer_ids
+
+    async def send(self, data, peer_id=None):
+        '''
+        Send @data to the peer we're in a session with, or to @peer_id in our
+        room
+        '''
+        if self.framed:
+            if peer_id is None:
+                frame = protocol.make_frame(protocol.OP_PEER_MSG, b'', b'', data.encode())
+            else:
+                frame = protocol.make_frame(protocol.OP_ROOM_PEER_MSG, b'', peer_id.encode(), data.encode())
+            await self.ws.send(frame)
+            return
+        if peer_id is not None:
+            data = protocol.room_peer_msg(peer_id, data)
+        await self.ws.send(data)
+
+    async def send_sdp(self, type_, sdp, peer_id=None):
+        await self.send(protocol.sdp_payload(type_, sdp), peer_id)
+
+    async def send_ice(self, candidates, end=False, peer_id=None):
+        await self.send(protocol.ice_payload(candidates, end), peer_id)
+
+    async def recv(self):
+        '''
+        Next message, or None once closed
+        '''
+        return await self.messages.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.messages.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    async def close(self):
+        self.closing = True
+        if self.ws:
+            await self.ws.close()
+        if self.reader:
+            await self.reader
@@ -0,0 +1,182 @@
+#
+# Messages of the signalling protocol, see Protocol.md
+#
+# Only parsing and formatting, without any transport, so that clients can
+# share it whatever they use to talk to the server. Kept compatible with
+# Python 2.7 for webrtc-sendrecv.py.
+#
+
+import json
+import struct
+from collections import namedtuple
+
+# Sent by the server
+Hello = namedtuple('Hello', [])
+# Reply to a HELLO with a resume token, when the server put the peer back in
+# the room or the session it was in before a restart. Only one of room_id and
+# peer_id is set, and peer_ids are the other members of the room.
+Resumed = namedtuple('Resumed', ['room_id', 'peer_ids', 'peer_id'])
+SessionOk = namedtuple('SessionOk', [])
+RoomOk = namedtuple('RoomOk', ['peer_ids'])
+RoomPeerJoined = namedtuple('RoomPeerJoined', ['peer_id'])
+RoomPeerLeft = namedtuple('RoomPeerLeft', ['peer_id'])
+RoomPeerList = namedtuple('RoomPeerList', ['peer_ids'])
+RoomPeerMsg = namedtuple('RoomPeerMsg', ['peer_id', 'data'])
+Error = namedtuple('Error', ['reason'])
+# Anything else, which in a session is what the other peer sent
+PeerMsg = namedtuple('PeerMsg', ['data'])
+
+# Sent between peers, as the data of a PeerMsg or RoomPeerMsg. Candidates is
+# always a list, and end is set once the sender has gathered all of them.
+Sdp = namedtuple('Sdp', ['type', 'sdp'])
+Ice = namedtuple('Ice', ['candidates', 'end'])
+
+# Binary framing, for clients that ask for BINARY_SUBPROTOCOL when opening the
+# websocket. Messages for other peers can then be sent as binary frames: a
+# fixed header with an opcode and the lengths of the source and destination
+# ids, the ids, and the payload, which the server forwards as it is. Peers
+# leave the source empty, and the server leaves the destination empty.
+# Everything else is still sent as text.
+BINARY_SUBPROTOCOL = 'gstwebrtc-binary'
+FRAME_HEADER = struct.Struct('!BHH')
+# In a session, the destination is empty
+OP_PEER_MSG = 1
+# In a room, like ROOM_PEER_MSG
+OP_ROOM_PEER_MSG = 2
+
+def parse(text):
+    '''
+    Parse a message from the server
+    '''
+    if text == 'HELLO':
+        return Hello()
+    if text == 'SESSION_OK':
+        return SessionOk()
+    command, _, rest = text.partition(' ')
+    if command == 'HELLO':
+        kind, _, rest = rest.partition(' ')
+        if kind == 'ROOM':
+            room_id, _, peer_ids = rest.partition(' ')
+            return Resumed(room_id, peer_ids.split(), None)
+        return Resumed(None, [], rest)
+    if command == 'ROOM_OK':
+        return RoomOk(rest.split())
+    if command == 'ROOM_PEER_MSG':
+        peer_id, _, data = rest.partition(' ')
+        return RoomPeerMsg(peer_id, data)
+    if command == 'ROOM_PEER_JOINED':
+        return RoomPeerJoined(rest)
+    if command == 'ROOM_PEER_LEFT':
+        return RoomPeerLeft(rest)
+    if command == 'ROOM_PEER_LIST':
+        return RoomPeerList(rest.split())
+    if command == 'ERROR':
+        return Error(rest)
+    return PeerMsg(text)
+
+def hello(uid, token=None):
+    '''
+    With @token, the peer can resume its room or session if the server
+    restarts, by registering again with the same @uid and @token
+    '''
+    if token is None:
+        return 'HELLO {}'.format(uid)
+    return 'HELLO {} {}'.format(uid, token)
+
+def session(peer_id):
+    return 'SESSION {}'.format(peer_id)
+
+def session_errors(peer_id):
+    '''
+    Reasons of the ERROR replies the server may refuse SESSION with, to tell
+    them apart from errors about other messages
+    '''
+    return ('peer {!r} busy'.format(peer_id), 'peer {!r} not found'.format(peer_id),
+            'server is restarting', 'invalid msg, already in room')
+
+def room(room_id):
+    return 'ROOM {}'.format(room_id)
+
+def room_errors(room_id):
+    '''
+    Reasons of the ERROR replies the server may refuse ROOM with
+    '''
+    return ('invalid room id {!r}'.format(room_id), 'room {!r} is full'.format(room_id),
+            'server is restarting', 'invalid msg, already in room')
+
+def room_peer_msg(peer_id, data):
+    return 'ROOM_PEER_MSG {} {}'.format(peer_id, data)
+
+def room_peer_list():
+    return 'ROOM_PEER_LIST'
+
+def parse_payload(data):
+    '''
+    Parse the SDP or ICE JSON sent by a peer, returns None for anything else
+    '''
+    try:
+        msg = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(msg, dict):
+        return None
+    if 'sdp' in msg:
+        sdp = msg['sdp']
+        if isinstance(sdp, dict):
+            return Sdp(sdp.get('type'), sdp.get('sdp'))
+        # The test clients only send a string
+        return Sdp(None, sdp)
+    if 'ice' in msg:
+        candidates = msg['ice']
+        # Batched candidates come as a list
+        if not isinstance(candidates, list):
+            candidates = [candidates]
+        return Ice(candidates, bool(msg.get('end')))
+    return None
+
+def sdp_payload(type_, sdp):
+    return json.dumps({'sdp': {'type': type_, 'sdp': sdp}})
+
+def ice_payload(candidates, end=False):
+    '''
+    A single candidate is sent on its own, and anything else as a batch
+    '''
+    if len(candidates) == 1 and not end:
+        return json.dumps({'ice': candidates[0]})
+    msg = {'ice': candidates}
+    if end:
+        msg['end'] = True
+    return json.dumps(msg)
+
+def make_frame(opcode, src, dst, payload):
+    '''
+    Build a binary frame, with @src, @dst and @payload as bytes
+    '''
+    return b''.join([FRAME_HEADER.pack(opcode, len(src), len(dst)), src, dst, payload])
+
+def parse_frame(frame):
+    '''
+    Split a binary frame into its opcode, source and destination ids as
+    bytes, and a memoryview of its payload, which isn't copied. Raises
+    ValueError if it is truncated.
+    '''
+    try:
+        opcode, src_len, dst_len = FRAME_HEADER.unpack_from(frame)
+    except struct.error:
+        raise ValueError('truncated frame header')
+    view = memoryview(frame)
+    start = FRAME_HEADER.size
+    end = start + src_len + dst_len
+    if len(view) < end:
+        raise ValueError('truncated frame ids')
+    return opcode, view[start:start + src_len].tobytes(), view[start + src_len:end].tobytes(), view[end:]
+
+def parse_frame_msg(frame):
+    '''
+    Parse a binary frame from the server into a PeerMsg or RoomPeerMsg
+    '''
+    opcode, src, _, payload = parse_frame(frame)
+    data = payload.tobytes().decode('utf-8')
+    if opcode == OP_ROOM_PEER_MSG:
+        return RoomPeerMsg(src.decode('utf-8'), data)
+    return PeerMsg(data)
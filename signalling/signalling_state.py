@@ -0,0 +1,1036 @@
+#
+# Outbound queues and rooms of the signalling server, and the registries
+# that keep track of peers, either in process or across workers and
+# cluster nodes. See simple-server.py.
+#
+# Nothing in here parses the command line or opens a listening socket, so
+# that it can be imported by tests. The server passes its settings with
+# configure().
+#
+
+import os
+import json
+import time
+import bisect
+import hmac
+import hashlib
+import inspect
+import functools
+import logging
+import asyncio
+import websockets
+import collections
+
+from concurrent.futures._base import TimeoutError
+
+import signalling_protocol as protocol
+
+log = logging.getLogger('signalling')
+
+# Set by configure(), to the server's options. These are their defaults.
+SEND_TIMEOUT = 5
+QUEUE_SIZE = 256
+OVERFLOW_POLICY = 'disconnect'
+MAX_ROOM_SIZE = 0
+RESUME_GRACE = 60
+RECONNECT_GRACE = 10
+REPLAY_BUFFER_SIZE = 65536
+REPLAY_TTL = 30
+# The server's Metrics
+metrics = None
+
+def configure(options, server_metrics):
+    '''
+    Use the settings parsed from the command line, @options, and count
+    into @server_metrics
+    '''
+    global SEND_TIMEOUT, QUEUE_SIZE, OVERFLOW_POLICY, MAX_ROOM_SIZE, \
+        RESUME_GRACE, RECONNECT_GRACE, REPLAY_BUFFER_SIZE, REPLAY_TTL, metrics
+    SEND_TIMEOUT = options.send_timeout
+    QUEUE_SIZE = options.queue_size
+    OVERFLOW_POLICY = options.overflow_policy
+    MAX_ROOM_SIZE = options.max_room_size
+    RESUME_GRACE = options.resume_grace
+    RECONNECT_GRACE = options.reconnect_grace
+    REPLAY_BUFFER_SIZE = options.replay_buffer_size
+    REPLAY_TTL = options.replay_ttl
+    metrics = server_metrics
+
+############### Outbound queues ###############
+
+def wire_size(msg):
+    '''
+    Size of @msg as sent in a websocket frame, where text is UTF-8
+    '''
+    if isinstance(msg, str) and not msg.isascii():
+        return len(msg.encode())
+    return len(msg)
+
+def split_relayed(msg):
+    '''
+    Split a relayed message into the routing prefix added by the server and
+    the payload that came from the sending peer.
+    '''
+    if msg.startswith('ROOM_PEER_MSG '):
+        _, other_id, payload = msg.split(maxsplit=2)
+        return 'ROOM_PEER_MSG {} '.format(other_id), payload
+    return '', msg
+
+# Queue of the outboxes that have nothing to send, never appended to
+EMPTY_QUEUE = ()
+
+class Outbox:
+    '''
+    Bounded queue of messages for a single peer, drained by a writer task.
+    Relaying a message only appends it here, so a slow receiver can never
+    block the handler of the peer that sent it. Idle peers have neither a
+    queue nor a writer, they are only created while there is something to
+    send.
+    '''
+    __slots__ = ('ws', 'uid', 'queue', 'closed', 'sent', 'dropped', 'coalesced', 'writer')
+
+    def __init__(self, ws, uid):
+        self.ws = ws
+        self.uid = uid
+        self.queue = EMPTY_QUEUE
+        self.closed = False
+        # Counters, see report_outboxes()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.writer = None
+
+    def put(self, msg):
+        if self.closed:
+            return
+        if len(self.queue) >= QUEUE_SIZE and not self.overflow():
+            return
+        if self.writer is None:
+            self.queue = collections.deque()
+            self.writer = asyncio.ensure_future(self.write())
+        self.queue.append(msg)
+
+    async def send_now(self, msg):
+        '''
+        Send @msg from the calling task if nothing is queued before it, or
+        else queue it. The frame is written before the writers of other peers
+        that were just given messages get to run.
+        '''
+        if self.closed or self.writer is not None:
+            self.put(msg)
+            return
+        try:
+            await self.ws.send(msg)
+        except websockets.ConnectionClosed:
+            # The handler sees it closed
+            return
+        metrics.messages_out += 1
+        metrics.bytes_out += wire_size(msg)
+        self.sent += 1
+
+    def overflow(self):
+        '''
+        Apply OVERFLOW_POLICY to a full queue. Returns False if the new message
+        must not be queued.
+        '''
+        if OVERFLOW_POLICY == 'drop-oldest':
+            self.queue.popleft()
+            self.dropped += 1
+            return True
+        if OVERFLOW_POLICY == 'coalesce-ice' and self.coalesce_ice():
+            return True
+        self.kick('outbound queue full')
+        return False
+
+    def coalesce_ice(self):
+        '''
+        Merge consecutive ICE candidates from the same sender into a single
+        message carrying a list of candidates. A candidate is never moved past
+        an SDP from the same sender, since it can't be applied before it.
+        Returns True if any space was freed.
+        '''
+        merged = []
+        # Format: {prefix: (index into merged, candidates)}
+        # The batches that are still open
+        batches = dict()
+        for msg in self.queue:
+            if not isinstance(msg, str):
+                # A binary frame, whose sender is unknown without parsing it
+                batches.clear()
+                merged.append(msg)
+                continue
+            prefix, payload = split_relayed(msg)
+            ice = None
+            if payload.startswith('{"ice"'):
+                try:
+                    ice = json.loads(payload)['ice']
+                except (ValueError, KeyError):
+                    pass
+            if ice is None:
+                batches.pop(prefix, None)
+                merged.append(msg)
+                continue
+            if not isinstance(ice, list):
+                ice = [ice]
+            if prefix in batches:
+                i, candidates = batches[prefix]
+                candidates.extend(ice)
+                # Only rewritten once it holds several messages
+                merged[i] = (prefix, candidates)
+                self.coalesced += 1
+                continue
+            batches[prefix] = (len(merged), list(ice))
+            merged.append(msg)
+        if len(merged) == len(self.queue):
+            return False
+        self.queue = collections.deque(
+            m[0] + json.dumps({'ice': m[1]}) if isinstance(m, tuple) else m
+            for m in merged)
+        return True
+
+    def kick(self, reason):
+        metrics.slow_peer_disconnects += 1
+        log.warning('Disconnecting peer %r: %s', self.uid, reason)
+        self.close()
+        # Don't care about errors
+        asyncio.ensure_future(self.ws.close(code=1008, reason=reason))
+
+    def undelivered(self):
+        '''
+        Messages from other peers that are still queued, as text
+        '''
+        msgs = []
+        for msg in self.queue:
+            if not isinstance(msg, str):
+                opcode, src, _, payload = protocol.parse_frame(msg)
+                try:
+                    msg = payload.tobytes().decode()
+                except UnicodeDecodeError:
+                    # Can't be sent as text, it's lost
+                    continue
+                if opcode == protocol.OP_ROOM_PEER_MSG:
+                    msg = 'ROOM_PEER_MSG {} {}'.format(src.decode(), msg)
+            elif not isinstance(protocol.parse(msg), (protocol.PeerMsg, protocol.RoomPeerMsg)):
+                continue
+            msgs.append(msg)
+        return msgs
+
+    def close(self):
+        self.closed = True
+        self.dropped += len(self.queue)
+        self.queue = EMPTY_QUEUE
+        if self.writer is not None:
+            self.writer.cancel()
+
+    async def write(self):
+        while True:
+            if not self.queue:
+                self.queue = EMPTY_QUEUE
+                self.writer = None
+                return
+            msg = self.queue.popleft()
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self.ws.send(msg), SEND_TIMEOUT)
+            except TimeoutError:
+                self.kick('too slow')
+                return
+            except websockets.ConnectionClosed:
+                # The peer will be removed by its own handler, which may keep
+                # what wasn't sent for it to resume, see undelivered(). If it
+                # was closed meanwhile, the queue is already gone.
+                if self.closed:
+                    self.dropped += 1
+                else:
+                    self.queue.appendleft(msg)
+                    self.closed = True
+                self.writer = None
+                return
+            metrics.send_latency.observe(time.monotonic() - start)
+            metrics.messages_out += 1
+            metrics.bytes_out += wire_size(msg)
+            self.sent += 1
+
+############### Rooms ###############
+
+class Room:
+    '''
+    Members of a room in the order they joined, with an index of the ones
+    connected to this process. The space-separated list of members sent in
+    ROOM_OK and ROOM_PEER_LIST is cached: it is extended when a peer joins,
+    and only rebuilt after a peer leaves.
+    '''
+    __slots__ = ('members', 'local', 'listing', 'offsets')
+
+    def __init__(self):
+        # Format: {uid: None}
+        # A dict rather than a set to keep the join order
+        self.members = dict()
+        self.local = dict()
+        self.listing = ''
+        # Format: {uid: offset of uid in listing}, None if listing is stale
+        self.offsets = dict()
+
+    def __contains__(self, uid):
+        return uid in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def add(self, uid, local=False):
+        if local:
+            self.local[uid] = None
+        if uid in self.members:
+            return
+        self.members[uid] = None
+        if self.offsets is not None:
+            if self.listing:
+                self.listing += ' '
+            self.offsets[uid] = len(self.listing)
+            self.listing += uid
+
+    def remove(self, uid):
+        del self.members[uid]
+        self.local.pop(uid, None)
+        self.offsets = None
+
+    def peer_list(self, exclude=None):
+        '''
+        Space-separated list of members, except @exclude
+        '''
+        if self.offsets is None:
+            self.listing = ' '.join(self.members)
+            self.offsets = dict()
+            offset = 0
+            for uid in self.members:
+                self.offsets[uid] = offset
+                offset += len(uid) + 1
+        if exclude not in self.offsets:
+            return self.listing
+        start = self.offsets[exclude]
+        end = start + len(exclude)
+        if start == 0:
+            return self.listing[end + 1:]
+        return self.listing[:start - 1] + self.listing[end:]
+
+############### Peer registry ###############
+
+class LocalRegistry:
+    '''
+    Registry of all peers, sessions and rooms, and message bus between the
+    workers that the peers are connected to. Every worker is attached with a
+    dispatch callable that receives events as tuples:
+
+      ('msg', uid, msg)          deliver @msg to @uid
+      ('session', uid, other_id, worker)
+                                 @other_id, connected to @worker, started a
+                                 session with @uid
+      ('hangup', uid)            the session partner of @uid went away
+      ('joined', room_id, uid)   @uid joined @room_id
+      ('left', room_id, uid)     @uid left @room_id
+      ('replaced', uid)          @uid resumed on another connection
+
+    Messages for a single peer go to the worker it is connected to, room
+    events go to every worker. This is used directly when running with a
+    single worker, and is kept by the hub when running with several.
+
+    Peers that registered with a resume token and lose their connection
+    are kept away: they stay in their room or session without being
+    connected, and messages for them are kept in a ReplayBuffer, until they
+    resume or RECONNECT_GRACE runs out. With STATE_FILE, the changes to the
+    state of these peers are also written to a StateJournal, and after a
+    crash they are restored away, for RESUME_GRACE.
+    '''
+    def __init__(self):
+        # Format: {worker_id: dispatch}
+        self.workers = dict()
+        # Format: {uid: worker_id}
+        self.owners = dict()
+        # Format: {uid: other_id}
+        self.sessions = dict()
+        # Same format as the global rooms, but for all workers
+        self.rooms = dict()
+        # Format: {uid: token hash}
+        # Peers that can resume, connected or away
+        self.tokens = dict()
+        # Format: {uid: room_id or None}
+        # Peers that are away, restored from the state file or that lost
+        # their connection, and haven't resumed yet
+        self.away = dict()
+        # Format: {uid: asyncio.TimerHandle}
+        # When each of them is given up on
+        self.expiry = dict()
+        # Format: {uid: ReplayBuffer}
+        # Messages for them, only once there is one
+        self.buffers = dict()
+        self.journal = None
+
+    def record(self, entry, *uids):
+        '''
+        Journal @entry if any of @uids can resume
+        '''
+        if self.journal is not None and any(uid in self.tokens for uid in uids):
+            self.journal.append(entry)
+
+    def attach(self, worker, dispatch):
+        self.workers[worker] = dispatch
+
+    def detach(self, worker):
+        '''
+        Forget a worker that went away, along with all of its peers
+        '''
+        del self.workers[worker]
+        for uid in [uid for uid, w in self.owners.items() if w == worker]:
+            self.end_session(uid)
+            for room_id in [r for r, members in self.rooms.items() if uid in members]:
+                self.leave_room(uid, room_id)
+            self.unregister(uid, worker)
+
+    def post(self, uid, *event):
+        worker = self.owners.get(uid)
+        if worker is not None:
+            self.workers[worker](event)
+        elif event[0] == 'msg' and uid in self.away:
+            buffer = self.buffers.get(uid)
+            if buffer is None:
+                buffer = self.buffers[uid] = ReplayBuffer()
+            buffer.add(event[2])
+        return worker
+
+    def publish(self, *event):
+        for dispatch in self.workers.values():
+            dispatch(event)
+
+    def register(self, uid, token=None, worker=0):
+        '''
+        Register @uid, which can resume with @token, the hash of its resume
+        token, if set. Returns False if @uid is taken, including by a peer
+        that is away, which only resume() with its token can take back.
+        '''
+        if uid in self.owners or uid in self.away:
+            return False
+        self.owners[uid] = worker
+        if token is not None:
+            self.tokens[uid] = token
+            self.record(['register', uid, token], uid)
+        return True
+
+    def resume(self, uid, token, worker=0):
+        '''
+        Register @uid again, if @token is the hash of the token it registered
+        with. Returns None if it can't resume, or what it was doing:
+        {'session': other_id} or {'room': room_id, 'peers': peer list}, with
+        the messages to 'replay' to it and the number of them 'dropped' from
+        its buffer.
+        '''
+        if uid not in self.tokens or \
+           not hmac.compare_digest(self.tokens[uid], token):
+            return None
+        if uid in self.owners:
+            # The connection it resumes from hasn't been found lost yet. Its
+            # worker hands back what it couldn't send on it, which is kept
+            # like anything else sent while it is away.
+            self.away[uid] = next((r for r, members in self.rooms.items() if uid in members), None)
+            self.workers[self.owners.pop(uid)](('replaced', uid))
+        else:
+            self.expiry.pop(uid).cancel()
+        room_id = self.away.pop(uid)
+        self.owners[uid] = worker
+        buffer = self.buffers.pop(uid, None)
+        if buffer is None:
+            resumed = {'replay': [], 'dropped': 0}
+        else:
+            resumed = {'replay': buffer.replay(), 'dropped': buffer.dropped}
+        if uid in self.sessions:
+            resumed['session'] = self.sessions[uid]
+        elif room_id in self.rooms:
+            resumed['room'] = room_id
+            resumed['peers'] = self.rooms[room_id].peer_list(exclude=uid)
+        return resumed
+
+    def suspend(self, uid, room_id, msgs, worker=0):
+        '''
+        @uid, which is in @room_id if set, lost its connection. Keep it away
+        with @msgs, which it wasn't sent yet, until it resumes.
+        '''
+        if self.owners.get(uid) != worker or uid not in self.tokens:
+            return
+        del self.owners[uid]
+        self.keep_away(uid, room_id, RECONNECT_GRACE)
+        if msgs:
+            buffer = self.buffers[uid] = ReplayBuffer()
+            for msg in msgs:
+                buffer.add(msg)
+
+    def keep_away(self, uid, room_id, grace):
+        self.away[uid] = room_id
+        self.expiry[uid] = asyncio.get_event_loop().call_later(grace, self.expire, uid)
+
+    def unregister(self, uid, worker=0):
+        if self.owners.get(uid) == worker:
+            del self.owners[uid]
+            if uid in self.tokens:
+                self.record(['unregister', uid], uid)
+                del self.tokens[uid]
+
+    def start_session(self, uid, callee_id, worker=0):
+        if callee_id not in self.owners:
+            return False
+        self.sessions[uid] = callee_id
+        self.sessions[callee_id] = uid
+        self.record(['session', uid, callee_id], uid, callee_id)
+        self.post(callee_id, 'session', callee_id, uid, worker)
+        return True
+
+    def end_session(self, uid):
+        other_id = self.sessions.pop(uid, None)
+        if other_id is not None:
+            self.record(['hangup', uid], uid, other_id)
+        if other_id is not None and self.sessions.pop(other_id, None) == uid:
+            self.post(other_id, 'hangup', other_id)
+
+    def join_room(self, uid, room_id):
+        '''
+        Add @uid to @room_id, and return the space-separated list of peers that
+        were already in it, or None if it is full
+        '''
+        members = self.rooms.setdefault(room_id, Room())
+        if MAX_ROOM_SIZE and len(members) >= MAX_ROOM_SIZE:
+            return None
+        room_peers = members.peer_list()
+        members.add(uid)
+        self.record(['join', uid, room_id], uid)
+        self.publish('joined', room_id, uid)
+        return room_peers
+
+    def leave_room(self, uid, room_id):
+        members = self.rooms.get(room_id, ())
+        if uid not in members:
+            return
+        members.remove(uid)
+        if not members:
+            del self.rooms[room_id]
+        self.record(['leave', uid, room_id], uid)
+        self.publish('left', room_id, uid)
+
+    def deliver(self, uid, msg):
+        self.post(uid, 'msg', uid, msg)
+
+    def bounce(self, uid, msg, worker=0):
+        '''
+        Take back @msg for @uid from @worker, which no longer has it
+        connected. It is passed on if @uid is away or connected elsewhere,
+        and dropped if @worker still owns it, since it is being removed.
+        '''
+        if self.owners.get(uid) != worker:
+            self.deliver(uid, msg)
+
+    def saved_state(self):
+        '''
+        State of the peers that can resume, as kept by StateJournal
+        '''
+        return {'tokens': dict(self.tokens),
+                'rooms': {uid: room_id for room_id, members in self.rooms.items()
+                          for uid in members if uid in self.tokens},
+                'sessions': {uid: other_id for uid, other_id in self.sessions.items()
+                             if uid in self.tokens or other_id in self.tokens}}
+
+    def restore(self, state):
+        '''
+        Put the peers of @state, from saved_state(), back in their rooms and
+        sessions until they resume. Sessions are only kept if both peers can
+        resume.
+        '''
+        tokens = state['tokens']
+        for uid, room_id in state['rooms'].items():
+            if uid in tokens:
+                self.rooms.setdefault(room_id, Room()).add(uid)
+        for uid, other_id in state['sessions'].items():
+            if uid in tokens and other_id in tokens:
+                self.sessions[uid] = other_id
+        self.tokens.update(tokens)
+        for uid in tokens:
+            self.keep_away(uid, state['rooms'].get(uid), RESUME_GRACE)
+
+    def expire(self, uid):
+        '''
+        Give up on a peer that is away, its session partner is hung up on
+        and its room told that it left
+        '''
+        log.info('Peer %r did not resume', uid)
+        room_id = self.away.pop(uid)
+        self.expiry.pop(uid).cancel()
+        self.buffers.pop(uid, None)
+        self.end_session(uid)
+        if room_id is not None:
+            self.leave_room(uid, room_id)
+        self.record(['unregister', uid], uid)
+        del self.tokens[uid]
+
+class ReplayBuffer:
+    '''
+    Messages for a peer that is away, to be sent when it resumes. Holds at
+    most REPLAY_BUFFER_SIZE bytes, dropping the oldest messages first, and
+    messages older than REPLAY_TTL are dropped.
+    '''
+    __slots__ = ('msgs', 'size', 'dropped')
+
+    def __init__(self):
+        # Format: deque([(time received, msg)])
+        self.msgs = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def add(self, msg):
+        now = time.monotonic()
+        self.msgs.append((now, msg))
+        self.size += len(msg)
+        while self.msgs and (self.size > REPLAY_BUFFER_SIZE or self.msgs[0][0] < now - REPLAY_TTL):
+            self.size -= len(self.msgs.popleft()[1])
+            self.dropped += 1
+
+    def replay(self):
+        '''
+        The messages that haven't expired yet, oldest first
+        '''
+        deadline = time.monotonic() - REPLAY_TTL
+        while self.msgs and self.msgs[0][0] < deadline:
+            self.msgs.popleft()
+            self.dropped += 1
+        return [msg for _, msg in self.msgs]
+
+# Longest line accepted on a worker's connection to the hub, must fit any
+# JSON-encoded websocket message
+HUB_LINE_LIMIT = 2 ** 23
+
+class HubRegistry:
+    '''
+    Worker-side proxy for a LocalRegistry kept by the hub in the parent
+    process, reached over a local socket with one JSON object per line.
+    Calls that need an answer are matched to their reply by id, everything
+    else is fire-and-forget. Events from the hub are passed to @dispatch.
+
+    Every worker also has a direct link to each of the others, @links, in the
+    same format. Once both sides of a session know which worker their
+    partner is connected to, they send it their messages over that link, so
+    that the hub only sees session setup and teardown. Messages for a
+    partner that moved or went away are sent back through the hub by the
+    worker that gets them, see LocalRegistry.bounce().
+    '''
+    def __init__(self, sock, dispatch, links=None):
+        self.sock = sock
+        self.dispatch = dispatch
+        self.replies = dict()
+        self.next_id = 0
+        # Format: {worker_id: socket}, replaced by a StreamWriter once
+        # connected
+        self.links = dict(links or {})
+        # Format: {uid: other_id}
+        # Session partners of the peers connected to this worker
+        self.sessions = dict()
+        # Format: {other_id: worker_id}
+        self.locations = dict()
+
+    async def connect(self):
+        self.reader, self.writer = \
+            await asyncio.open_unix_connection(sock=self.sock, limit=HUB_LINE_LIMIT)
+        asyncio.ensure_future(self.read())
+        for worker, sock in list(self.links.items()):
+            reader, self.links[worker] = \
+                await asyncio.open_unix_connection(sock=sock, limit=HUB_LINE_LIMIT)
+            asyncio.ensure_future(self.read_link(worker, reader))
+
+    async def read_link(self, worker, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.on_event(tuple(json.loads(line.decode())['event']))
+        # The hub removes its peers, and deliver() goes through it from now on
+        log.warning('Lost the link to worker %d', worker)
+        del self.links[worker]
+
+    def on_event(self, event):
+        kind = event[0]
+        if kind == 'session':
+            _, uid, other_id, worker = event
+            self.sessions[uid] = other_id
+            self.locations[other_id] = worker
+            event = event[:3]
+        elif kind == 'hangup':
+            other_id = self.sessions.pop(event[1], None)
+            self.locations.pop(other_id, None)
+        self.dispatch(event)
+
+    async def read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                log.error('Lost connection to the hub, exiting')
+                os._exit(1)
+            msg = json.loads(line.decode())
+            if 'event' in msg:
+                self.on_event(tuple(msg['event']))
+            else:
+                self.replies.pop(msg['id']).set_result(msg['result'])
+
+    def cast(self, op, *args):
+        line = json.dumps({'op': op, 'args': args}) + '\n'
+        self.writer.write(line.encode())
+
+    def call(self, op, *args):
+        self.next_id += 1
+        fut = asyncio.get_event_loop().create_future()
+        self.replies[self.next_id] = fut
+        line = json.dumps({'id': self.next_id, 'op': op, 'args': args}) + '\n'
+        self.writer.write(line.encode())
+        return fut
+
+    def register(self, uid, token=None):
+        return self.call('register', uid, token)
+
+    def resume(self, uid, token):
+        return self.call('resume', uid, token)
+
+    def suspend(self, uid, room_id, msgs):
+        self.cast('suspend', uid, room_id, msgs)
+
+    def unregister(self, uid):
+        self.cast('unregister', uid)
+
+    async def start_session(self, uid, callee_id):
+        # The hub answers with the callee's worker
+        worker = await self.call('start_session', uid, callee_id)
+        if worker is None:
+            return False
+        self.sessions[uid] = callee_id
+        self.locations[callee_id] = worker
+        return True
+
+    def end_session(self, uid):
+        other_id = self.sessions.pop(uid, None)
+        self.locations.pop(other_id, None)
+        self.cast('end_session', uid)
+
+    def join_room(self, uid, room_id):
+        return self.call('join_room', uid, room_id)
+
+    def leave_room(self, uid, room_id):
+        self.cast('leave_room', uid, room_id)
+
+    def deliver(self, uid, msg):
+        link = self.links.get(self.locations.get(uid))
+        if link is None:
+            self.cast('deliver', uid, msg)
+        else:
+            link.write((json.dumps({'event': ['msg', uid, msg]}) + '\n').encode())
+
+    def bounce(self, uid, msg):
+        self.cast('bounce', uid, msg)
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+    '''
+    Consistent hash ring placing keys on nodes. Each node owns @replicas points
+    on the ring, so adding or removing a node only moves the keys next to its
+    points.
+    '''
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        self.points = sorted((hash_key('{}#{}'.format(node, i)), node)
+                             for node in self.nodes for i in range(replicas))
+        self.hashes = [h for h, _ in self.points]
+
+    def lookup(self, key):
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.points[i][1]
+
+class ClusterRegistry:
+    '''
+    Registry sharded over several nodes. Each peer id and room id is placed on
+    a node with consistent hashing, and is kept in that node's LocalRegistry
+    shard, in which the attached workers are the nodes themselves.
+
+    Every node has a single TCP connection to each of the others, carrying its
+    requests, replies and events in order, with one JSON object per line.
+    Messages for a peer go through the node its id is placed on, except in a
+    session where both sides learn where their partner is connected and send
+    to that node directly.
+    '''
+    def __init__(self, node, nodes, dispatch):
+        self.node = node
+        self.ring = HashRing(nodes)
+        self.dispatch = dispatch
+        self.shard = LocalRegistry()
+        self.shard.attach(node, self.on_event)
+        # Format: {node: StreamWriter}
+        self.writers = dict()
+        # Format: {node: [line, ...]}
+        # Lines waiting for the connection to a node
+        self.pending = dict()
+        self.replies = dict()
+        self.next_id = 0
+        # Format: {uid: other_id}
+        # Session partners of the peers connected to this node
+        self.sessions = dict()
+        # Format: {other_id: node}
+        self.locations = dict()
+        for other in self.ring.nodes:
+            if other != node:
+                self.shard.attach(other, functools.partial(self.post_to, other))
+
+    async def start(self):
+        host, port = self.node.rsplit(':', 1)
+        await asyncio.start_server(self.serve_link, host, int(port), limit=HUB_LINE_LIMIT)
+        for node in self.ring.nodes:
+            if node != self.node:
+                asyncio.ensure_future(self.connect(node))
+
+    async def connect(self, node):
+        host, port = node.rsplit(':', 1)
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, int(port))
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            writer.write((json.dumps({'node': self.node}) + '\n').encode())
+            for line in self.pending.pop(node, []):
+                writer.write(line)
+            self.writers[node] = writer
+            log.info('Connected to cluster node %s', node)
+            # Nothing is ever sent back on this connection, wait for it to close
+            await reader.read()
+            del self.writers[node]
+            log.warning('Lost connection to cluster node %s', node)
+
+    async def serve_link(self, reader, writer):
+        node = json.loads((await reader.readline()).decode())['node']
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = json.loads(line.decode())
+            if 'event' in msg:
+                self.on_event(tuple(msg['event']))
+            elif 'op' in msg:
+                result = self.handle(node, msg['op'], msg['args'])
+                if 'id' in msg:
+                    self.send(node, {'id': msg['id'], 'result': result})
+            else:
+                self.replies.pop(msg['id']).set_result(msg['result'])
+        log.warning('Cluster node %s went away', node)
+        self.shard.detach(node)
+        self.shard.attach(node, functools.partial(self.post_to, node))
+        for uid, other_id in list(self.sessions.items()):
+            if self.locations.get(other_id) == node:
+                self.on_event(('hangup', uid))
+
+    def send(self, node, msg):
+        line = (json.dumps(msg) + '\n').encode()
+        if node in self.writers:
+            self.writers[node].write(line)
+        else:
+            self.pending.setdefault(node, []).append(line)
+
+    def post_to(self, node, event):
+        if node == self.node:
+            self.on_event(event)
+        else:
+            self.send(node, {'event': event})
+
+    def handle(self, node, op, args):
+        '''
+        Run @op, requested by @node, on our shard
+        '''
+        if op == 'locate':
+            return self.shard.owners.get(args[0])
+        if op == 'post':
+            uid, event = args
+            return self.shard.post(uid, *event)
+        if op in ('register', 'unregister'):
+            return getattr(self.shard, op)(*args, worker=node)
+        return getattr(self.shard, op)(*args)
+
+    def request(self, key, op, *args):
+        '''
+        Run @op on the shard @key is placed on, returns a future if that is on
+        another node
+        '''
+        node = self.ring.lookup(key)
+        if node == self.node:
+            return self.handle(node, op, list(args))
+        self.next_id += 1
+        fut = asyncio.get_event_loop().create_future()
+        self.replies[self.next_id] = fut
+        self.send(node, {'id': self.next_id, 'op': op, 'args': args})
+        return fut
+
+    def cast(self, key, op, *args):
+        node = self.ring.lookup(key)
+        if node == self.node:
+            self.handle(node, op, list(args))
+        else:
+            self.send(node, {'op': op, 'args': args})
+
+    def on_event(self, event):
+        kind = event[0]
+        if kind == 'session':
+            _, uid, other_id, node = event
+            self.sessions[uid] = other_id
+            self.locations[other_id] = node
+            event = event[:3]
+        elif kind == 'hangup':
+            other_id = self.sessions.pop(event[1], None)
+            self.locations.pop(other_id, None)
+        self.dispatch(event)
+
+    def register(self, uid):
+        return self.request('peer:' + uid, 'register', uid)
+
+    def unregister(self, uid):
+        self.cast('peer:' + uid, 'unregister', uid)
+
+    async def start_session(self, uid, callee_id):
+        node = await registry_call(self.request('peer:' + callee_id, 'locate', callee_id))
+        if node is None:
+            return False
+        self.sessions[uid] = callee_id
+        self.locations[callee_id] = node
+        # Sent on the same connection as the messages that will follow it
+        self.post_to(node, ('session', callee_id, uid, self.node))
+        return True
+
+    def end_session(self, uid):
+        other_id = self.sessions.pop(uid, None)
+        if other_id is not None:
+            self.post_to(self.locations.pop(other_id), ('hangup', other_id))
+
+    def join_room(self, uid, room_id):
+        return self.request('room:' + room_id, 'join_room', uid, room_id)
+
+    def leave_room(self, uid, room_id):
+        self.cast('room:' + room_id, 'leave_room', uid, room_id)
+
+    def deliver(self, uid, msg):
+        if uid in self.locations:
+            self.post_to(self.locations[uid], ('msg', uid, msg))
+        else:
+            self.cast('peer:' + uid, 'post', uid, ('msg', uid, msg))
+
+async def registry_call(result):
+    '''
+    Wait for the result of a registry call that may or may not be awaitable,
+    depending on the backend
+    '''
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+############### State journal ###############
+
+def apply_record(state, record):
+    '''
+    Apply a @record of StateJournal to @state, in the format of
+    LocalRegistry.saved_state()
+    '''
+    kind, uid = record[:2]
+    if kind == 'register':
+        state['tokens'][uid] = record[2]
+    elif kind == 'unregister':
+        state['tokens'].pop(uid, None)
+        state['rooms'].pop(uid, None)
+    elif kind == 'join':
+        state['rooms'][uid] = record[2]
+    elif kind == 'leave':
+        if state['rooms'].get(uid) == record[2]:
+            del state['rooms'][uid]
+    elif kind == 'session':
+        state['sessions'][uid] = record[2]
+        state['sessions'][record[2]] = uid
+    if kind in ('hangup', 'unregister'):
+        other_id = state['sessions'].pop(uid, None)
+        if state['sessions'].get(other_id) == uid:
+            del state['sessions'][other_id]
+
+class StateJournal:
+    '''
+    Append-only journal of the changes made by a LocalRegistry, in @path,
+    compacted into a snapshot of its state in @path.snapshot. Records are
+    JSON lists, one per line, and are written once per iteration of the
+    event loop, so a crash of the server loses none that were made before
+    the last iteration. Only a crash of the machine can lose the ones that
+    the OS hasn't written to disk yet.
+
+    Compacting writes the snapshot to a new file, renames it over the old
+    one and truncates the journal. A crash between the rename and the
+    truncation replays records that are already in the snapshot, which
+    leaves it as it was since each record sets the state of its peers.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.file = None
+        self.pending = []
+        # Records written since the last compaction
+        self.records = 0
+
+    def load(self):
+        '''
+        State saved by the last process that used @path
+        '''
+        state = {'tokens': {}, 'rooms': {}, 'sessions': {}}
+        try:
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash, nothing can follow it
+                        break
+                    apply_record(state, record)
+        except FileNotFoundError:
+            pass
+        return state
+
+    def open(self):
+        self.file = open(self.path, 'a')
+
+    def append(self, record):
+        if not self.pending:
+            asyncio.get_event_loop().call_soon(self.flush)
+        self.pending.append(json.dumps(record))
+
+    def flush(self):
+        if not self.pending or self.file is None:
+            return
+        self.file.write('\n'.join(self.pending) + '\n')
+        self.file.flush()
+        self.records += len(self.pending)
+        self.pending.clear()
+
+    def compact(self, state):
+        self.flush()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.file.truncate(0)
+        self.records = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.file = None
@@ -9,239 +9,1328 @@
 
 import os
 import sys
+import atexit
 import ssl
+import json
+import time
+import queue
+import random
+import bisect
+import signal
+import socket
+import threading
+import traceback
+import http
+import hashlib
 import logging
+import logging.handlers
 import asyncio
+import asyncio.sslproto
 import websockets
 import argparse
+import collections
+
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 from concurrent.futures._base import TimeoutError
 
+import signalling_protocol as protocol
+import signalling_state
+from signalling_state import wire_size, Outbox, Room, LocalRegistry, \
+    HUB_LINE_LIMIT, HubRegistry, ClusterRegistry, registry_call, StateJournal
+
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--addr', default='0.0.0.0', help='Address to listen on')
 parser.add_argument('--port', default=8443, type=int, help='Port to listen on')
-parser.add_argument('--keepalive-timeout', dest='keepalive_timeout', default=30, type=int, help='Timeout for keepalive (in seconds)')
+parser.add_argument('--keepalive-timeout', dest='keepalive_timeout', default=30, type=int, help='Ping peers that have sent nothing for this long (in seconds)')
+parser.add_argument('--hello-timeout', dest='hello_timeout', default=10, type=float, help='Disconnect peers that don\'t send HELLO within this time of connecting (in seconds)')
+parser.add_argument('--pong-timeout', dest='pong_timeout', default=10, type=int, help='Disconnect peers that don\'t answer a keepalive ping within this time (in seconds)')
+parser.add_argument('--send-timeout', dest='send_timeout', default=5, type=float, help='Disconnect peers that take longer than this to accept a message (in seconds)')
+parser.add_argument('--queue-size', dest='queue_size', default=256, type=int, help='Maximum number of messages queued for sending to a single peer')
+parser.add_argument('--max-message-size', dest='max_message_size', default=65536, type=int,
+                    help='Disconnect peers that send a larger message (in bytes)')
+parser.add_argument('--max-queue', dest='max_queue', default=8, type=int,
+                    help='Maximum number of messages read from a peer ahead of the handler, so that at most this many times --max-message-size is buffered per peer')
+parser.add_argument('--read-limit', dest='read_limit', default=32768, type=int,
+                    help='Stop reading from a peer\'s socket while this many bytes are buffered')
+parser.add_argument('--write-limit', dest='write_limit', default=32768, type=int,
+                    help='Wait before sending more to a peer while this many bytes are buffered for it')
+parser.add_argument('--tls-buffer-size', dest='tls_buffer_size', default=16384, type=int,
+                    help='Size of the buffer that TLS records are read into, allocated for every connection')
+parser.add_argument('--overflow-policy', dest='overflow_policy', default='disconnect',
+                    choices=['drop-oldest', 'coalesce-ice', 'disconnect'],
+                    help='What to do when a peer\'s outbound queue is full')
+parser.add_argument('--stats-interval', dest='stats_interval', default=0, type=int, help='Print outbound queue statistics this often (in seconds, 0 to disable)')
+parser.add_argument('--workers', default=1, type=int, help='Number of worker processes accepting connections on the same port')
+parser.add_argument('--cluster-addr', dest='cluster_addr', default=None, help='HOST:PORT this node listens on for other cluster nodes, enables cluster mode')
+parser.add_argument('--cluster-nodes', dest='cluster_nodes', default='', help='Comma-separated HOST:PORT of all cluster nodes, including this one')
+parser.add_argument('--log-level', dest='log_level', default='info',
+                    choices=['debug', 'info', 'warning', 'error'],
+                    help='Log level, relayed messages are only logged at debug')
+parser.add_argument('--log-payload', dest='log_payload', default=64, type=int, help='Truncate logged messages to this many characters')
+parser.add_argument('--log-sample', dest='log_sample', default=1, type=int, help='Only log one in this many relayed messages at debug level, 0 to log none but those of traced peers')
+parser.add_argument('--trace-file', dest='trace_file', default=None, help='File listing uids whose relayed messages are always logged, reloaded on SIGUSR2')
+parser.add_argument('--event-loop', dest='event_loop', default='asyncio', choices=['asyncio', 'uvloop'],
+                    help='Event loop implementation. uvloop is faster, and falls back to asyncio\'s if it isn\'t installed.')
+parser.add_argument('--lag-interval', dest='lag_interval', default=0.1, type=float,
+                    help='How often to measure how late the event loop runs callbacks (in seconds, 0 to disable)')
+parser.add_argument('--slow-callback', dest='slow_callback', default=0.1, type=float,
+                    help='Log where the event loop is stuck when it is blocked for longer than this (in seconds, 0 to disable). Needs --lag-interval.')
+parser.add_argument('--metrics-port', dest='metrics_port', default=0, type=int, help='Port to serve Prometheus metrics on, 0 to disable. Each worker uses the next one.')
+parser.add_argument('--compression', default='deflate', choices=['deflate', 'off'],
+                    help='Compress websocket messages with permessage-deflate, for peers that support it')
+parser.add_argument('--deflate-window-bits', dest='deflate_window_bits', default=12, type=int,
+                    choices=range(9, 16), metavar='{9..15}',
+                    help='Size of the compression window, as a power of two')
+parser.add_argument('--deflate-mem-level', dest='deflate_mem_level', default=5, type=int,
+                    choices=range(1, 10), metavar='{1..9}',
+                    help='zlib memory level of the compressor, lower uses less memory but compresses less')
+parser.add_argument('--deflate-no-context-takeover', dest='deflate_no_context_takeover', action='store_true',
+                    help='Compress each message on its own, so that no compression state is kept between messages')
+parser.add_argument('--max-connections', dest='max_connections', default=0, type=int,
+                    help='Refuse connections as soon as they are accepted while this many are open, per worker. 0 for no limit.')
+parser.add_argument('--ip-rate', dest='ip_rate', default=0, type=float,
+                    help='Connections per second accepted from a single address, 0 for no limit')
+parser.add_argument('--ip-burst', dest='ip_burst', default=20, type=int,
+                    help='Connections accepted at once from a single address, within --ip-rate')
+parser.add_argument('--peer-rate', dest='peer_rate', default=0, type=float,
+                    help='Messages per second accepted from a single peer, 0 for no limit')
+parser.add_argument('--peer-burst', dest='peer_burst', default=100, type=int,
+                    help='Messages accepted at once from a single peer, within --peer-rate')
+parser.add_argument('--max-room-size', dest='max_room_size', default=0, type=int,
+                    help='Maximum number of peers in a room, 0 for no limit')
 parser.add_argument('--cert-path', default=os.path.dirname(__file__))
 parser.add_argument('--disable-ssl', default=False, help='Disable ssl', action='store_true')
+parser.add_argument('--tls-tickets', dest='tls_tickets', default=2, type=int,
+                    help='Number of TLS 1.3 session tickets sent to clients after a full handshake, for resuming their session when reconnecting. 0 disables tickets.')
+parser.add_argument('--drain-timeout', dest='drain_timeout', default=300, type=int,
+                    help='When draining, longest time to wait for sessions to end (in seconds)')
+parser.add_argument('--drain-spread', dest='drain_spread', default=10, type=int,
+                    help='When draining, close peers that aren\'t in a session over this many seconds, so that they don\'t all reconnect at once')
+parser.add_argument('--handoff-socket', dest='handoff_socket', default=None,
+                    help='Unix socket on which a new server process can take over the listening socket, then this one drains')
+parser.add_argument('--handoff-state', dest='handoff_state', action='store_true',
+                    help='Also hand rooms over, so that the new process puts peers back in their room when they reconnect')
+parser.add_argument('--handoff-grace', dest='handoff_grace', default=60, type=int,
+                    help='How long the new process keeps the rooms handed over for peers to reconnect (in seconds)')
+parser.add_argument('--state-file', dest='state_file', default=None,
+                    help='Journal the rooms and sessions of peers that registered with a resume token to this file, so that they can resume them after a crash')
+parser.add_argument('--state-compact-interval', dest='state_compact_interval', default=60, type=int,
+                    help='How often to compact the state journal into a snapshot (in seconds)')
+parser.add_argument('--resume-grace', dest='resume_grace', default=60, type=int,
+                    help='How long peers restored from --state-file are kept for them to resume (in seconds)')
+parser.add_argument('--reconnect-grace', dest='reconnect_grace', default=10, type=int,
+                    help='How long peers that registered with a resume token are kept in their room or session after losing their connection, for them to resume (in seconds, 0 to disable)')
+parser.add_argument('--replay-buffer-size', dest='replay_buffer_size', default=65536, type=int,
+                    help='Most bytes of messages kept for a peer that is away, to be sent when it resumes. The oldest ones are dropped first.')
+parser.add_argument('--replay-ttl', dest='replay_ttl', default=30, type=int,
+                    help='Messages kept for a peer that is away are dropped after this long (in seconds)')
+parser.add_argument('--unix-socket', dest='unix_socket', default=None,
+                    help='Accept plaintext connections from a local TLS proxy on this Unix socket instead of --addr and --port')
 
 options = parser.parse_args(sys.argv[1:])
 
 ADDR_PORT = (options.addr, options.port)
 KEEPALIVE_TIMEOUT = options.keepalive_timeout
+HELLO_TIMEOUT = options.hello_timeout
+PONG_TIMEOUT = options.pong_timeout
+MAX_MESSAGE_SIZE = options.max_message_size
+MAX_QUEUE = options.max_queue
+READ_LIMIT = options.read_limit
+WRITE_LIMIT = options.write_limit
+TLS_BUFFER_SIZE = options.tls_buffer_size
+STATS_INTERVAL = options.stats_interval
+WORKERS = options.workers
+CLUSTER_ADDR = options.cluster_addr
+CLUSTER_NODES = [n for n in options.cluster_nodes.split(',') if n]
+LOG_PAYLOAD = options.log_payload
+LOG_SAMPLE = options.log_sample
+TRACE_FILE = options.trace_file
+METRICS_PORT = options.metrics_port
+COMPRESSION = options.compression
+DEFLATE_WINDOW_BITS = options.deflate_window_bits
+DEFLATE_MEM_LEVEL = options.deflate_mem_level
+DEFLATE_NO_CONTEXT_TAKEOVER = options.deflate_no_context_takeover
+TLS_TICKETS = options.tls_tickets
+UNIX_SOCKET = options.unix_socket
+DRAIN_TIMEOUT = options.drain_timeout
+DRAIN_SPREAD = options.drain_spread
+HANDOFF_SOCKET = options.handoff_socket
+HANDOFF_STATE = options.handoff_state
+HANDOFF_GRACE = options.handoff_grace
+MAX_CONNECTIONS = options.max_connections
+IP_RATE = options.ip_rate
+IP_BURST = options.ip_burst
+PEER_RATE = options.peer_rate
+PEER_BURST = options.peer_burst
+STATE_FILE = options.state_file
+STATE_COMPACT_INTERVAL = options.state_compact_interval
+RESUME_GRACE = options.resume_grace
+RECONNECT_GRACE = options.reconnect_grace
+# Cluster nodes don't keep peers that are away
+RESUME_TOKENS = bool(STATE_FILE or RECONNECT_GRACE) and not CLUSTER_ADDR
+LAG_INTERVAL = options.lag_interval
+SLOW_CALLBACK = options.slow_callback
 
 ############### Global data ###############
 
-# Format: {uid: (Peer WebSocketServerProtocol,
-#                remote_address,
-#                <'session'|room_id|None>)}
+# Format: {uid: Peer}
+# Peers connected to this process
 peers = dict()
-# Format: {caller_uid: callee_uid,
-#          callee_uid: caller_uid}
-# Bidirectional mapping between the two peers
-sessions = dict()
-# Format: {room_id: {peer1_id, peer2_id, peer3_id, ...}}
-# Room dict with a set of peers in each room
+# Format: {room_id: Room}
+# Rooms with members connected to this process, including their members
+# connected to other workers. Kept up to date by registry_event()
 rooms = dict()
+# Format: {uid, ...}
+# Peers whose relayed messages are logged regardless of the log level
+traced = set()
+# Number of relayed messages considered for logging, for sampling
+relay_count = 0
+# Registry shared by all worker processes or cluster nodes, see LocalRegistry,
+# HubRegistry and ClusterRegistry
+registry = None
+# Pings idle peers, see KeepaliveWheel
+keepalive = None
+# Set once we stopped accepting connections, see drain()
+draining = False
+# Format: {uid: room_id}
+# Rooms handed over by the process we took over from, to put their members
+# back in when they reconnect until restored_until, see take_over()
+restored_rooms = dict()
+restored_until = 0
+# Websocket connections that completed their TLS handshake, see
+# MetricsProtocol
+open_connections = 0
+# Format: {address: TokenBucket}
+# Connection rate of each source address, see admit()
+ip_buckets = dict()
+# Last time monitor_lag() ran, read by the watch_loop() thread
+loop_heartbeat = 0
+
+############### Logging ###############
+
+log = logging.getLogger('signalling')
+log.setLevel(options.log_level.upper())
+# Relayed messages, switched between debug and info at runtime with SIGUSR1
+relay_log = logging.getLogger('signalling.relay')
+
+def start_logging():
+    '''
+    Write log records to stdout from a separate thread, so that a slow
+    terminal or pipe can't block the event loop. Must be called again in
+    forked processes, which don't inherit the thread.
+    '''
+    records = queue.Queue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    log.handlers = [logging.handlers.QueueHandler(records)]
+    log.propagate = False
+    listener.start()
+    # Write what is left when exiting after a drain
+    atexit.register(listener.stop)
+
+def toggle_relay_log():
+    # Traced peers are logged at info level, and stay logged
+    if relay_log.isEnabledFor(logging.DEBUG):
+        relay_log.setLevel(logging.INFO)
+    else:
+        relay_log.setLevel(logging.DEBUG)
+    log.warning('Logging of relayed messages %s',
+                'enabled' if relay_log.isEnabledFor(logging.DEBUG) else 'disabled')
+
+def load_traced():
+    global traced
+    try:
+        with open(TRACE_FILE) as f:
+            traced = set(f.read().split())
+    except OSError as e:
+        log.error('Could not read trace file: %s', e)
+        return
+    log.warning('Tracing %d peers', len(traced))
+
+class Payload:
+    '''
+    Message to be logged, only truncated and formatted if the record is
+    actually emitted
+    '''
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        if not isinstance(self.msg, str):
+            return '<binary frame, {} bytes>'.format(len(self.msg))
+        if len(self.msg) <= LOG_PAYLOAD:
+            return self.msg
+        return '{}... ({} chars)'.format(self.msg[:LOG_PAYLOAD], len(self.msg))
+
+def relay_level(uid, other_id):
+    '''
+    Level to log a message relayed from @uid to @other_id at, or None if it
+    must not be logged. Traced peers are always logged, everything else only
+    at debug level and sampled.
+    '''
+    global relay_count
+    if traced and (uid in traced or other_id in traced):
+        return logging.INFO
+    if not relay_log.isEnabledFor(logging.DEBUG):
+        return None
+    if not LOG_SAMPLE:
+        return None
+    relay_count += 1
+    if relay_count % LOG_SAMPLE:
+        return None
+    return logging.DEBUG
+
+############### Metrics ###############
+
+class Histogram:
+    '''
+    Prometheus-style histogram with fixed bucket upper bounds
+    '''
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One more for +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def expose(self, name):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, total))
+        return lines
+
+class Metrics:
+    '''
+    Counters updated on the hot path. Each update is a single attribute or
+    dict increment, anything more expensive is computed when scraped.
+    '''
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.keepalive_pings = 0
+        self.keepalive_timeouts = 0
+        self.slow_peer_disconnects = 0
+        # Peers that resumed after losing their connection or a restart
+        self.resumed_peers = 0
+        self.replayed_messages = 0
+        self.replay_dropped_messages = 0
+        # Format: {command: count}
+        self.commands = collections.Counter()
+        # Format: {(route, payload): count}
+        self.relayed = collections.Counter()
+        # Format: {stage: count}
+        self.handshake_failures = collections.Counter()
+        # Format: {limit: count}
+        self.limit_hits = collections.Counter()
+        self.send_latency = Histogram([0.0001, 0.0005, 0.001, 0.005, 0.01,
+                                       0.05, 0.1, 0.5, 1, 5])
+        self.loop_lag = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
+        # Updated by the watch_loop() thread
+        self.loop_stalls = 0
+
+metrics = Metrics()
+signalling_state.configure(options, metrics)
+
+def payload_kind(msg):
+    '''
+    Classify a relayed message by the JSON key it starts with, without
+    parsing it
+    '''
+    head = msg[:8]
+    if '"sdp"' in head:
+        return 'sdp'
+    if '"ice"' in head:
+        return 'ice'
+    return 'other'
+
+def render_metrics():
+    lines = []
+    def add(name, kind, help_, samples):
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(samples)
+    add('signalling_connections', 'gauge', 'Open websocket connections, including the ones that haven\'t said HELLO',
+        ['signalling_connections {}'.format(open_connections)])
+    add('signalling_peers', 'gauge', 'Connected peers',
+        ['signalling_peers {}'.format(len(peers))])
+    add('signalling_session_peers', 'gauge', 'Connected peers that are in a session',
+        ['signalling_session_peers {}'.format(sum(p.partner is not None for p in peers.values()))])
+    add('signalling_rooms', 'gauge', 'Rooms with connected members',
+        ['signalling_rooms {}'.format(len(rooms))])
+    room_sizes = Histogram([2, 5, 10, 20, 50, 100, 500, 1000])
+    for members in rooms.values():
+        room_sizes.observe(len(members))
+    add('signalling_room_size', 'histogram', 'Number of members per room',
+        room_sizes.expose('signalling_room_size'))
+    add('signalling_outbox_messages', 'gauge', 'Messages queued for sending to peers',
+        ['signalling_outbox_messages {}'.format(sum(len(p.outbox.queue) for p in peers.values()))])
+    add('signalling_commands_total', 'counter', 'Commands received from peers',
+        ['signalling_commands_total{{command="{}"}} {}'.format(c, n)
+         for c, n in sorted(metrics.commands.items())])
+    add('signalling_relayed_messages_total', 'counter', 'Messages relayed between peers',
+        ['signalling_relayed_messages_total{{route="{}",payload="{}"}} {}'.format(r, p, n)
+         for (r, p), n in sorted(metrics.relayed.items())])
+    add('signalling_received_messages_total', 'counter', 'Messages received from peers',
+        ['signalling_received_messages_total {}'.format(metrics.messages_in)])
+    add('signalling_received_bytes_total', 'counter', 'Bytes received from peers',
+        ['signalling_received_bytes_total {}'.format(metrics.bytes_in)])
+    add('signalling_sent_messages_total', 'counter', 'Messages sent to peers',
+        ['signalling_sent_messages_total {}'.format(metrics.messages_out)])
+    add('signalling_sent_bytes_total', 'counter', 'Bytes sent to peers',
+        ['signalling_sent_bytes_total {}'.format(metrics.bytes_out)])
+    add('signalling_send_seconds', 'histogram', 'Time taken to hand a message to a peer\'s connection',
+        metrics.send_latency.expose('signalling_send_seconds'))
+    add('signalling_keepalive_pings_total', 'counter', 'Keepalive pings sent',
+        ['signalling_keepalive_pings_total {}'.format(metrics.keepalive_pings)])
+    add('signalling_keepalive_timeouts_total', 'counter', 'Peers disconnected for not answering a keepalive ping',
+        ['signalling_keepalive_timeouts_total {}'.format(metrics.keepalive_timeouts)])
+    add('signalling_slow_peer_disconnects_total', 'counter', 'Peers disconnected for not keeping up',
+        ['signalling_slow_peer_disconnects_total {}'.format(metrics.slow_peer_disconnects)])
+    add('signalling_resumed_peers_total', 'counter', 'Peers put back in their room or session after losing their connection or a restart',
+        ['signalling_resumed_peers_total {}'.format(metrics.resumed_peers)])
+    add('signalling_replayed_messages_total', 'counter', 'Messages kept for peers while they were away, sent when they resumed',
+        ['signalling_replayed_messages_total {}'.format(metrics.replayed_messages)])
+    add('signalling_replay_dropped_messages_total', 'counter', 'Messages for peers that were away, dropped for their size or age',
+        ['signalling_replay_dropped_messages_total {}'.format(metrics.replay_dropped_messages)])
+    add('signalling_handshake_failures_total', 'counter', 'Failed websocket or HELLO handshakes',
+        ['signalling_handshake_failures_total{{stage="{}"}} {}'.format(s, n)
+         for s, n in sorted(metrics.handshake_failures.items())])
+    add('signalling_limit_hits_total', 'counter', 'Connections, messages and room joins refused by admission control',
+        ['signalling_limit_hits_total{{limit="{}"}} {}'.format(l, n)
+         for l, n in sorted(metrics.limit_hits.items())])
+    add('signalling_event_loop_info', 'gauge', 'Event loop implementation in use',
+        ['signalling_event_loop_info{{loop="{}"}} 1'.format(EVENT_LOOP)])
+    add('signalling_event_loop_lag_seconds', 'histogram', 'How late the event loop ran a timer, which callbacks ready at the same time also waited',
+        metrics.loop_lag.expose('signalling_event_loop_lag_seconds'))
+    add('signalling_event_loop_stalls_total', 'counter', 'Times the event loop was blocked for longer than --slow-callback',
+        ['signalling_event_loop_stalls_total {}'.format(metrics.loop_stalls)])
+    if sslctx is not None:
+        # Counted by OpenSSL, resumed handshakes are included in the total
+        tls = sslctx.session_stats()
+        add('signalling_tls_handshakes_total', 'counter', 'Completed TLS handshakes',
+            ['signalling_tls_handshakes_total {}'.format(tls['accept_good'])])
+        add('signalling_tls_resumed_handshakes_total', 'counter', 'TLS handshakes that resumed a session',
+            ['signalling_tls_resumed_handshakes_total {}'.format(tls['hits'])])
+    return '\n'.join(lines) + '\n'
+
+async def serve_metrics(reader, writer):
+    '''
+    Minimal HTTP server for Prometheus scrapes
+    '''
+    try:
+        request = await reader.readline()
+        # Skip headers
+        while (await reader.readline()).strip():
+            pass
+    except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        return
+    if request.split()[:2] == [b'GET', b'/metrics']:
+        status = '200 OK'
+        body = render_metrics().encode()
+    else:
+        status = '404 Not Found'
+        body = b'Not found\n'
+    writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                 'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode() + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+class MetricsProtocol(websockets.WebSocketServerProtocol):
+    '''
+    Counts websocket handshakes that fail before our handler is called. With
+    uvloop, which accepts connections without AdmissionSocket, also counts
+    open connections, and refuses the ones admit() doesn't want.
+    '''
+    refused = False
+
+    def connection_made(self, transport):
+        global open_connections
+        if EVENT_LOOP == 'uvloop':
+            if (MAX_CONNECTIONS or IP_RATE) and \
+               not admit(transport.get_extra_info('peername')):
+                self.refused = True
+                transport.abort()
+                return
+            open_connections += 1
+        super().connection_made(transport)
+
+    def connection_lost(self, exc):
+        global open_connections
+        if self.refused:
+            return
+        if EVENT_LOOP == 'uvloop':
+            open_connections -= 1
+        super().connection_lost(exc)
+
+    async def handshake(self, *args, **kwargs):
+        try:
+            return await super().handshake(*args, **kwargs)
+        except Exception:
+            metrics.handshake_failures['websocket'] += 1
+            raise
+
+    async def process_request(self, path, request_headers):
+        # Behind a TLS proxy, the address of the client is only known now
+        if UNIX_SOCKET and IP_RATE:
+            if not admit_address(request_headers.get('X-Forwarded-For', 'unix')):
+                return (http.HTTPStatus.TOO_MANY_REQUESTS, [], b'Too many connections\n')
+        return None
+
+############### Admission control ###############
+
+class TokenBucket:
+    '''
+    Allows a number of events per second on average, in bursts. Events
+    beyond the limit are owed, down to minus the burst, so that a client
+    that keeps going over it stays refused until it slows down.
+    '''
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, rate, burst, now):
+        '''
+        Take a token, returns False if there were none left
+        '''
+        self.tokens = max(-burst, min(burst, self.tokens + (now - self.stamp) * rate) - 1)
+        self.stamp = now
+        return self.tokens >= 0
+
+def admit_address(addr):
+    '''
+    Whether to accept another connection from @addr, within IP_RATE
+    '''
+    now = time.monotonic()
+    bucket = ip_buckets.get(addr)
+    if bucket is None:
+        bucket = ip_buckets[addr] = TokenBucket(IP_BURST, now)
+    if bucket.take(IP_RATE, IP_BURST, now):
+        return True
+    metrics.limit_hits['ip'] += 1
+    return False
+
+def admit(addr):
+    '''
+    Whether to keep a connection just accepted from @addr, before its TLS or
+    websocket handshake
+    '''
+    if MAX_CONNECTIONS and open_connections >= MAX_CONNECTIONS:
+        metrics.limit_hits['connections'] += 1
+        return False
+    # Behind a TLS proxy, see MetricsProtocol.process_request()
+    if IP_RATE and not UNIX_SOCKET:
+        return admit_address(addr[0])
+    return True
+
+class AdmissionSocket(socket.socket):
+    '''
+    Listening socket that closes the connections refused by admit() as soon
+    as they are accepted, so that they cost neither a TLS handshake nor a
+    protocol instance. The others are counted in open_connections from now
+    on, TLS handshake included, see AdmittedSocket.
+    '''
+    def accept(self):
+        global open_connections
+        while True:
+            conn, addr = super().accept()
+            if admit(addr):
+                open_connections += 1
+                return AdmittedSocket(conn.family, conn.type, conn.proto, fileno=conn.detach()), addr
+            conn.close()
+
+class AdmittedSocket(socket.socket):
+    '''
+    Connection accepted by AdmissionSocket, which its transport closes when
+    it is lost, whether or not the TLS handshake went through
+    '''
+    def close(self):
+        global open_connections
+        if self.fileno() != -1:
+            open_connections -= 1
+        super().close()
+
+async def prune_ip_buckets():
+    '''
+    Forget addresses that have been quiet long enough for their bucket to be
+    full again
+    '''
+    idle = 2 * IP_BURST / IP_RATE
+    while True:
+        await asyncio.sleep(max(idle, 10))
+        now = time.monotonic()
+        for addr in [a for a, b in ip_buckets.items() if now - b.stamp > idle]:
+            del ip_buckets[addr]
+
+############### Peers and rooms ###############
+
+def remote_address(ws):
+    '''
+    Address of the client at the other end of @ws, as given by the TLS proxy
+    in X-Forwarded-For when we are behind one
+    '''
+    if UNIX_SOCKET:
+        return ws.request_headers.get('X-Forwarded-For', 'unix')
+    return ws.remote_address
+
+class Peer:
+    '''
+    A peer connected to this process
+    '''
+    __slots__ = ('uid', 'ws', 'raddr', 'status', 'partner', 'outbox', 'binary',
+                 'active', 'pong', 'keepalive_slot', 'bucket', 'resumable')
+
+    def __init__(self, uid, ws):
+        self.uid = uid
+        self.ws = ws
+        self.raddr = remote_address(ws)
+        # Whether it can take binary frames, see relay_frame()
+        self.binary = ws.subprotocol == protocol.BINARY_SUBPROTOCOL
+        # <'session'|room_id|None>
+        self.status = None
+        # Session partner, which may be connected to another worker
+        self.partner = None
+        self.outbox = Outbox(ws, uid)
+        # Keepalive state, see KeepaliveWheel. Set whenever a message is
+        # received from the peer.
+        self.active = True
+        # Task sending the last ping, which returns the future of its pong
+        self.pong = None
+        self.keepalive_slot = None
+        # Message rate, see PEER_RATE
+        self.bucket = TokenBucket(PEER_BURST, time.monotonic()) if PEER_RATE else None
+        # Whether it registered with a resume token
+        self.resumable = False
+
+############### Peer registry ###############
+
+async def serve_hub_worker(hub, worker, sock):
+    '''
+    Serve the requests of a single worker against the LocalRegistry @hub
+    '''
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=HUB_LINE_LIMIT)
+    def dispatch(event):
+        writer.write((json.dumps({'event': event}) + '\n').encode())
+    hub.attach(worker, dispatch)
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        msg = json.loads(line.decode())
+        op = msg['op']
+        args = msg['args']
+        if op in ('register', 'resume', 'suspend', 'unregister', 'bounce', 'start_session'):
+            result = getattr(hub, op)(*args, worker=worker)
+        else:
+            result = getattr(hub, op)(*args)
+        if op == 'start_session':
+            # Where to send the callee's messages directly
+            result = hub.owners[args[1]] if result else None
+        if 'id' in msg:
+            writer.write((json.dumps({'id': msg['id'], 'result': result}) + '\n').encode())
+    if draining:
+        log.info('Worker %d drained', worker)
+    else:
+        log.error('Worker %d went away', worker)
+    hub.detach(worker)
+
+def registry_event(event):
+    '''
+    Apply an event from the registry to the peers connected to this process
+    '''
+    kind = event[0]
+    if kind == 'msg':
+        _, uid, msg = event
+        if uid in peers:
+            peers[uid].outbox.put(msg)
+        elif RESUME_TOKENS:
+            # Sent before the registry knew that @uid lost its connection or
+            # resumed elsewhere, give it back to be kept or passed on
+            registry.bounce(uid, msg)
+    elif kind == 'session':
+        # The partner's worker, if any, is only for the registry backend
+        _, uid, other_id = event[:3]
+        if uid in peers:
+            peer = peers[uid]
+            peer.status = 'session'
+            peer.partner = other_id
+    elif kind == 'hangup':
+        _, uid = event
+        hang_up(uid)
+    elif kind == 'joined':
+        _, room_id, uid = event
+        # Only rooms with members connected to this process are kept
+        if room_id not in rooms and uid not in peers:
+            return
+        rooms.setdefault(room_id, Room()).add(uid, uid in peers)
+        broadcast_room(room_id, uid, 'ROOM_PEER_JOINED {}'.format(uid))
+    elif kind == 'replaced':
+        _, uid = event
+        replace_peer(uid)
+    elif kind == 'left':
+        _, room_id, uid = event
+        room = rooms.get(room_id)
+        if room is None or uid not in room:
+            return
+        room.remove(uid)
+        broadcast_room(room_id, uid, 'ROOM_PEER_LEFT {}'.format(uid))
+        if not room.local:
+            del rooms[room_id]
+
+############### State journal ###############
+
+async def compact_state(reg):
+    while reg.journal is not None:
+        await asyncio.sleep(STATE_COMPACT_INTERVAL)
+        journal = reg.journal
+        if journal is None or not journal.records:
+            continue
+        start = time.monotonic()
+        journal.compact(reg.saved_state())
+        log.info('Compacted the state journal in %.3fs', time.monotonic() - start)
+
+def open_state(reg):
+    '''
+    Restore the state saved in STATE_FILE into the LocalRegistry @reg, and
+    journal its changes from now on
+    '''
+    journal = StateJournal(STATE_FILE)
+    start = time.monotonic()
+    state = journal.load()
+    reg.restore(state)
+    journal.open()
+    journal.compact(reg.saved_state())
+    reg.journal = journal
+    log.warning('Restored %d peers from %s in %.3fs, waiting %ds for them to resume',
+                len(reg.away), STATE_FILE, time.monotonic() - start, RESUME_GRACE)
+    asyncio.ensure_future(compact_state(reg))
+
+############### Keepalive ###############
+
+async def send_ping(ws):
+    '''
+    Returns the future of the pong, or None if the connection is closed
+    '''
+    try:
+        return await ws.ping()
+    except websockets.ConnectionClosed:
+        return None
+
+def pong_received(pong):
+    if not pong.done():
+        return False
+    waiter = pong.result()
+    return waiter is not None and waiter.done()
+
+class KeepaliveWheel:
+    '''
+    Keeps connections to idle peers alive, so that bad routers don't close
+    them, and disconnects peers that stopped answering. Peers are kept in a
+    timer wheel with one slot per @tick seconds, which a single task advances
+    for all of them. Receiving a message only sets a flag on the peer, and a
+    peer found idle when its slot comes up is pinged, so it has been idle for
+    between KEEPALIVE_TIMEOUT and twice that. If the pong hasn't come
+    PONG_TIMEOUT seconds later, the connection is failed.
+    '''
+    def __init__(self, tick=1):
+        self.tick = tick
+        # Format: [{Peer, ...}]
+        # Peers to check when the cursor reaches each slot
+        self.slots = [set() for _ in range(max(KEEPALIVE_TIMEOUT, PONG_TIMEOUT) // tick + 2)]
+        self.cursor = 0
+        self.task = asyncio.ensure_future(self.run())
+
+    def schedule(self, peer, delay):
+        slot = (self.cursor + max(1, -(-delay // self.tick))) % len(self.slots)
+        self.slots[slot].add(peer)
+        peer.keepalive_slot = slot
+
+    def cancel(self, peer):
+        '''
+        Stop keeping @peer alive, once it is disconnected
+        '''
+        if peer.keepalive_slot is not None:
+            self.slots[peer.keepalive_slot].discard(peer)
+            peer.keepalive_slot = None
+        pong, peer.pong = peer.pong, None
+        if pong is None:
+            return
+        # Cancelling the future of the pong has no effect on the connection,
+        # but keeps asyncio from logging the exception it gets on closing
+        if not pong.done():
+            pong.cancel()
+        elif pong.result() is not None:
+            pong.result().cancel()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        while True:
+            # Ticks don't drift with the time taken to process them
+            deadline += self.tick
+            await asyncio.sleep(deadline - loop.time())
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            due, self.slots[self.cursor] = self.slots[self.cursor], set()
+            for peer in due:
+                peer.keepalive_slot = None
+                self.check(peer)
+
+    def check(self, peer):
+        if peer.pong is not None:
+            if not pong_received(peer.pong):
+                log.info('Keepalive ping to peer %r at %r timed out', peer.uid, peer.raddr)
+                metrics.keepalive_timeouts += 1
+                # The handler sees the connection closed and removes the peer
+                peer.ws.fail_connection(1011, 'keepalive ping timeout')
+                return
+            peer.pong = None
+        elif peer.active:
+            peer.active = False
+        else:
+            log.debug('Sending keepalive ping to %r', peer.raddr)
+            metrics.keepalive_pings += 1
+            peer.pong = asyncio.ensure_future(send_ping(peer.ws))
+            self.schedule(peer, PONG_TIMEOUT)
+            return
+        self.schedule(peer, KEEPALIVE_TIMEOUT)
+
+############### Event loop ###############
+
+async def monitor_lag():
+    '''
+    Measure how late the event loop wakes up a task sleeping for
+    LAG_INTERVAL, which is how long the callbacks that were ready at the same
+    time waited for the ones before them
+    '''
+    global loop_heartbeat
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        loop_heartbeat = time.monotonic()
+        metrics.loop_lag.observe(max(0, loop.time() - start - LAG_INTERVAL))
+
+def blocked_in(frame):
+    '''
+    Where the event loop is stuck, given the current @frame of its thread.
+    Returns the function of the server that the loop called, the peer that
+    it was handling if any, and the stack from there.
+    '''
+    frames = []
+    while frame is not None and frame.f_code is not serve.__code__:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    # Skip the event loop's own frames, down to the callback it runs
+    ours = [f for f in frames if f.f_code.co_filename in (__file__, signalling_state.__file__)]
+    if not ours:
+        return None, None, ''
+    frames = frames[frames.index(ours[0]):]
+    uid = None
+    for f in reversed(frames):
+        # Reading the locals of another thread's frame is safe with the GIL
+        # held, and only happens once per stall
+        local_vars = f.f_locals
+        if isinstance(local_vars.get('self'), Outbox):
+            uid = local_vars['self'].uid
+            break
+        if isinstance(local_vars.get('peer'), Peer):
+            uid = local_vars['peer'].uid
+            break
+        if isinstance(local_vars.get('uid'), str):
+            uid = local_vars['uid']
+            break
+    stack = traceback.StackSummary.extract((f, f.f_lineno) for f in frames)
+    code = ours[0].f_code
+    # co_qualname is new in Python 3.11
+    return getattr(code, 'co_qualname', code.co_name), uid, ''.join(stack.format())
+
+def watch_loop(thread_id):
+    '''
+    Runs in its own thread, and logs where the event loop running in
+    @thread_id is stuck whenever monitor_lag() hasn't run for SLOW_CALLBACK
+    longer than it should have, once per stall. Callbacks that block in C
+    code holding the GIL only show in the lag histogram.
+    '''
+    reported = None
+    while True:
+        time.sleep(SLOW_CALLBACK / 2)
+        heartbeat = loop_heartbeat
+        blocked = time.monotonic() - heartbeat - LAG_INTERVAL
+        if blocked < SLOW_CALLBACK or heartbeat == reported:
+            continue
+        reported = heartbeat
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return
+        metrics.loop_stalls += 1
+        where, uid, stack = blocked_in(frame)
+        del frame
+        log.warning('Event loop stalled for %.3fs so far, running %s for peer %r:\n%s',
+                    blocked, where, uid, stack.rstrip())
+
+def start_monitoring_loop():
+    global loop_heartbeat
+    if LAG_INTERVAL <= 0:
+        return
+    loop_heartbeat = time.monotonic()
+    asyncio.ensure_future(monitor_lag())
+    if SLOW_CALLBACK > 0:
+        threading.Thread(target=watch_loop, args=(threading.get_ident(),),
+                         name='loop-watchdog', daemon=True).start()
 
 ############### Helper functions ###############
 
-async def recv_msg_ping(ws, raddr):
+def relay_frame(peer, frame):
     '''
-    Wait for a message forever, and send a regular ping to prevent bad routers
-    from closing the connection.
+    Relay a binary frame from @peer, which negotiated binary framing. It is
+    routed by its header alone, and the payload is only decoded for peers
+    that use text, or are connected to another worker.
     '''
-    msg = None
-    while msg is None:
+    uid = peer.uid
+    try:
+        opcode, _, dst, payload = protocol.parse_frame(frame)
+    except ValueError as e:
+        send_peer(uid, 'ERROR invalid frame: {}'.format(e))
+        return
+    if opcode == protocol.OP_PEER_MSG and peer.status == 'session':
+        route = 'session'
+        other_id = peer.partner
+    elif opcode == protocol.OP_ROOM_PEER_MSG and peer.status not in (None, 'session'):
+        route = 'room'
         try:
-            msg = await asyncio.wait_for(ws.recv(), KEEPALIVE_TIMEOUT)
-        except TimeoutError:
-            print('Sending keepalive ping to {!r} in recv'.format(raddr))
-            await ws.ping()
-    return msg
-
-async def disconnect(ws, peer_id):
-    '''
-    Remove @peer_id from the list of sessions and close our connection to it.
-    This informs the peer that the session and all calls have ended, and it
-    must reconnect.
-    '''
-    global sessions
-    if peer_id in sessions:
-        del sessions[peer_id]
-    # Close connection
-    if ws and ws.open:
-        # Don't care about errors
-        asyncio.ensure_future(ws.close(reason='hangup'))
-
-async def cleanup_session(uid):
-    if uid in sessions:
-        other_id = sessions[uid]
-        del sessions[uid]
-        print("Cleaned up {} session".format(uid))
-        if other_id in sessions:
-            del sessions[other_id]
-            print("Also cleaned up {} session".format(other_id))
-            # If there was a session with this peer, also
-            # close the connection to reset its state.
-            if other_id in peers:
-                print("Closing connection to {}".format(other_id))
-                wso, oaddr, _ = peers[other_id]
-                del peers[other_id]
-                await wso.close()
+            other_id = dst.decode()
+        except UnicodeDecodeError:
+            send_peer(uid, 'ERROR invalid frame: peer id is not UTF-8')
+            return
+        if other_id not in rooms[peer.status]:
+            send_peer(uid, 'ERROR peer {!r} is not in the room'.format(other_id))
+            return
+    else:
+        send_peer(uid, 'ERROR invalid frame, not in a session or room')
+        return
+    metrics.relayed[route, 'binary'] += 1
+    level = relay_level(uid, other_id)
+    if level:
+        relay_log.log(level, '%s %s -> %s: %s', route, uid, other_id, Payload(frame))
+    other = peers.get(other_id)
+    if other is not None and other.binary:
+        other.outbox.put(protocol.make_frame(opcode, uid.encode(), b'', payload))
+        return
+    try:
+        msg = payload.tobytes().decode()
+    except UnicodeDecodeError:
+        send_peer(uid, 'ERROR invalid payload')
+        return
+    if route == 'room':
+        msg = 'ROOM_PEER_MSG {} {}'.format(uid, msg)
+    send_peer(other_id, msg)
+
+def send_peer(uid, msg):
+    '''
+    Queue @msg for sending to the registered peer @uid, handing it to the
+    registry if the peer is connected to another worker
+    '''
+    if uid in peers:
+        peers[uid].outbox.put(msg)
+    else:
+        registry.deliver(uid, msg)
+
+def broadcast_room(room_id, uid, msg):
+    '''
+    Queue @msg for every peer in @room_id that is connected to this process,
+    except @uid. Each member has its own writer, so slow members don't delay
+    the others. Other workers do the same for their own peers.
+    '''
+    for pid in rooms[room_id].local:
+        if pid == uid:
+            continue
+        level = relay_level(uid, pid)
+        if level:
+            relay_log.log(level, 'room %s: %s -> %s: %s', room_id, uid, pid, Payload(msg))
+        send_peer(pid, msg)
+
+async def report_outboxes():
+    '''
+    Periodically log the peers that are falling behind
+    '''
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        outboxes = [p.outbox for p in peers.values()]
+        queued = sum(len(o.queue) for o in outboxes)
+        log.info('Outbound queues: %d peers, %d messages queued', len(outboxes), queued)
+        lagging = [o for o in outboxes if o.queue or o.dropped or o.coalesced]
+        lagging.sort(key=lambda o: (len(o.queue), o.dropped), reverse=True)
+        for o in lagging[:10]:
+            log.info('  %r: depth %d, sent %d, dropped %d, coalesced %d',
+                     o.uid, len(o.queue), o.sent, o.dropped, o.coalesced)
+
+def hang_up(uid):
+    '''
+    The session partner of @uid went away, close the connection to @uid to
+    reset its state
+    '''
+    peer = peers.get(uid)
+    if peer is None or peer.partner is None:
+        return
+    peer.partner = None
+    log.info('Also cleaned up %s session', uid)
+    log.info('Closing connection to %s', uid)
+    del peers[uid]
+    registry.unregister(uid)
+    keepalive.cancel(peer)
+    peer.outbox.close()
+    # Don't care about errors
+    asyncio.ensure_future(peer.ws.close())
+
+async def cleanup_session(peer):
+    if peer.partner is not None:
+        peer.partner = None
+        log.info('Cleaned up %s session', peer.uid)
+        registry.end_session(peer.uid)
 
 async def cleanup_room(uid, room_id):
-    room_peers = rooms[room_id]
-    if uid not in room_peers:
+    if uid not in rooms.get(room_id, ()):
         return
-    room_peers.remove(uid)
-    for pid in room_peers:
-        wsp, paddr, _ = peers[pid]
-        msg = 'ROOM_PEER_LEFT {}'.format(uid)
-        print('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-        await wsp.send(msg)
-
-async def remove_peer(uid):
-    await cleanup_session(uid)
-    if uid in peers:
-        ws, raddr, status = peers[uid]
-        if status and status != 'session':
-            await cleanup_room(uid, status)
-        del peers[uid]
-        await ws.close()
-        print("Disconnected from peer {!r} at {!r}".format(uid, raddr))
+    registry.leave_room(uid, room_id)
+
+def lost_connection(ws):
+    '''
+    Whether the connection @ws was closed by the network rather than by
+    either side, counting keepalive timeouts
+    '''
+    return ws.close_rcvd is None and (ws.close_sent is None or ws.close_sent.code == 1011)
+
+def leave_local_room(peer):
+    '''
+    Stop counting @peer as connected here in its room, if it is in one,
+    while it stays a member for the others. Returns the room id.
+    '''
+    if not peer.status or peer.status == 'session':
+        return None
+    room_id = peer.status
+    room = rooms[room_id]
+    room.local.pop(peer.uid, None)
+    if not room.local:
+        del rooms[room_id]
+    return room_id
+
+def suspend_peer(peer):
+    '''
+    Keep @peer, which lost its connection, in its room or session until it
+    resumes, along with what it wasn't sent yet
+    '''
+    room_id = leave_local_room(peer)
+    registry.suspend(peer.uid, room_id, peer.outbox.undelivered())
+    peer.outbox.close()
+    log.info('Lost connection to peer %r at %r, waiting %ds for it to resume',
+             peer.uid, peer.raddr, RECONNECT_GRACE)
+
+def replace_peer(uid):
+    '''
+    @uid resumed on a new connection before we found its old one lost. Close
+    the old one, and hand what it wasn't sent back to the registry for the
+    new one.
+    '''
+    peer = peers.pop(uid, None)
+    if peer is None:
+        return
+    keepalive.cancel(peer)
+    leave_local_room(peer)
+    for msg in peer.outbox.undelivered():
+        registry.deliver(uid, msg)
+    peer.outbox.close()
+    log.info('Peer %r at %r resumed on another connection', uid, peer.raddr)
+    asyncio.ensure_future(peer.ws.close(code=1000, reason='resumed on another connection'))
+
+async def remove_peer(peer, lost=False):
+    '''
+    Remove @peer once its connection is closed, @lost if it wasn't closed
+    on purpose
+    '''
+    uid = peer.uid
+    if peers.get(uid) is not peer:
+        # Already removed by hang_up() or replace_peer(), and @uid may belong
+        # to a new connection by now
+        return
+    del peers[uid]
+    keepalive.cancel(peer)
+    if lost and peer.resumable and RECONNECT_GRACE and not draining:
+        suspend_peer(peer)
+        return
+    await cleanup_session(peer)
+    if peer.status and peer.status != 'session':
+        await cleanup_room(uid, peer.status)
+    # Before waiting for the close, so that nothing is sent to @uid while it
+    # is half gone
+    registry.unregister(uid)
+    peer.outbox.close()
+    await peer.ws.close()
+    log.info('Disconnected from peer %r at %r', uid, peer.raddr)
 
 ############### Handler functions ###############
 
 async def connection_handler(ws, uid):
-    global peers, sessions, rooms
-    raddr = ws.remote_address
-    peer_status = None
-    peers[uid] = [ws, raddr, peer_status]
-    print("Registered peer {!r} at {!r}".format(uid, raddr))
+    raddr = remote_address(ws)
+    peer = peers[uid]
+    log.info('Registered peer %r at %r', uid, raddr)
     while True:
         # Receive command, wait forever if necessary
-        msg = await recv_msg_ping(ws, raddr)
+        msg = await ws.recv()
+        peer.active = True
+        if peer.bucket and not peer.bucket.take(PEER_RATE, PEER_BURST, time.monotonic()):
+            # Dropped, and the peer is disconnected if it keeps going
+            metrics.limit_hits['peer'] += 1
+            if peer.bucket.tokens <= -PEER_BURST:
+                log.warning('Disconnecting peer %r at %r for sending too fast', uid, raddr)
+                ws.fail_connection(1008, 'rate limit exceeded')
+                return
+            continue
+        metrics.messages_in += 1
+        metrics.bytes_in += wire_size(msg)
+        if not isinstance(msg, str):
+            relay_frame(peer, msg)
+            continue
         # Update current status
-        peer_status = peers[uid][2]
+        peer_status = peer.status
         # We are in a session or a room, messages must be relayed
         if peer_status is not None:
             # We're in a session, route message to connected peer
             if peer_status == 'session':
-                other_id = sessions[uid]
-                wso, oaddr, status = peers[other_id]
-                assert(status == 'session')
-                print("{} -> {}: {}".format(uid, other_id, msg))
-                await wso.send(msg)
+                other_id = peer.partner
+                metrics.relayed['session', payload_kind(msg)] += 1
+                level = relay_level(uid, other_id)
+                if level:
+                    relay_log.log(level, '%s -> %s: %s', uid, other_id, Payload(msg))
+                send_peer(other_id, msg)
             # We're in a room, accept room-specific commands
             elif peer_status:
+                room_id = peer_status
                 # ROOM_PEER_MSG peer_id MSG
                 if msg.startswith('ROOM_PEER_MSG'):
                     _, other_id, msg = msg.split(maxsplit=2)
-                    if other_id not in peers:
-                        await ws.send('ERROR peer {!r} not found'
-                                      ''.format(other_id))
-                        continue
-                    wso, oaddr, status = peers[other_id]
-                    if status != room_id:
-                        await ws.send('ERROR peer {!r} is not in the room'
-                                      ''.format(other_id))
+                    # Peers on other workers are only known through the room
+                    if other_id not in rooms[room_id]:
+                        send_peer(uid, 'ERROR peer {!r} is not in the room'
+                                       ''.format(other_id))
                         continue
+                    metrics.relayed['room', payload_kind(msg)] += 1
                     msg = 'ROOM_PEER_MSG {} {}'.format(uid, msg)
-                    print('room {}: {} -> {}: {}'.format(room_id, uid, other_id, msg))
-                    await wso.send(msg)
+                    level = relay_level(uid, other_id)
+                    if level:
+                        relay_log.log(level, 'room %s: %s -> %s: %s',
+                                      room_id, uid, other_id, Payload(msg))
+                    send_peer(other_id, msg)
                 elif msg == 'ROOM_PEER_LIST':
-                    room_id = peers[peer_id][2]
-                    room_peers = ' '.join([pid for pid in rooms[room_id] if pid != peer_id])
-                    msg = 'ROOM_PEER_LIST {}'.format(room_peers)
-                    print('room {}: -> {}: {}'.format(room_id, uid, msg))
-                    await ws.send(msg)
+                    metrics.commands['ROOM_PEER_LIST'] += 1
+                    msg = 'ROOM_PEER_LIST {}'.format(rooms[room_id].peer_list(exclude=uid))
+                    log.debug('room %s: -> %s: %s', room_id, uid, Payload(msg))
+                    send_peer(uid, msg)
+                elif msg == 'ROOM ' + room_id:
+                    # Peers put back in their room after a restart may not
+                    # know that they are in it
+                    metrics.commands['ROOM'] += 1
+                    send_peer(uid, 'ROOM_OK {}'.format(rooms[room_id].peer_list(exclude=uid)))
                 else:
-                    await ws.send('ERROR invalid msg, already in room')
+                    send_peer(uid, 'ERROR invalid msg, already in room')
                     continue
             else:
                 raise AssertionError('Unknown peer status {!r}'.format(peer_status))
         # Requested a session with a specific peer
         elif msg.startswith('SESSION'):
-            print("{!r} command {!r}".format(uid, msg))
+            metrics.commands['SESSION'] += 1
+            log.info('%r command %r', uid, msg)
             _, callee_id = msg.split(maxsplit=1)
-            if callee_id not in peers:
-                await ws.send('ERROR peer {!r} not found'.format(callee_id))
-                continue
             if peer_status is not None:
-                await ws.send('ERROR peer {!r} busy'.format(callee_id))
+                send_peer(uid, 'ERROR peer {!r} busy'.format(callee_id))
+                continue
+            if draining:
+                send_peer(uid, 'ERROR server is restarting')
+                continue
+            # Register session, the callee's worker is told by the registry
+            if not await registry_call(registry.start_session(uid, callee_id)):
+                send_peer(uid, 'ERROR peer {!r} not found'.format(callee_id))
                 continue
-            await ws.send('SESSION_OK')
-            wsc = peers[callee_id][0]
-            print('Session from {!r} ({!r}) to {!r} ({!r})'
-                  ''.format(uid, raddr, callee_id, wsc.remote_address))
-            # Register session
-            peers[uid][2] = peer_status = 'session'
-            sessions[uid] = callee_id
-            peers[callee_id][2] = 'session'
-            sessions[callee_id] = uid
+            send_peer(uid, 'SESSION_OK')
+            log.info('Session from %r (%r) to %r', uid, raddr, callee_id)
+            peer.status = 'session'
+            peer.partner = callee_id
         # Requested joining or creation of a room
         elif msg.startswith('ROOM'):
-            print('{!r} command {!r}'.format(uid, msg))
+            metrics.commands['ROOM'] += 1
+            log.info('%r command %r', uid, msg)
             _, room_id = msg.split(maxsplit=1)
             # Room name cannot be 'session', empty, or contain whitespace
             if room_id == 'session' or room_id.split() != [room_id]:
-                await ws.send('ERROR invalid room id {!r}'.format(room_id))
+                send_peer(uid, 'ERROR invalid room id {!r}'.format(room_id))
                 continue
-            if room_id in rooms:
-                if uid in rooms[room_id]:
-                    raise AssertionError('How did we accept a ROOM command '
-                                         'despite already being in a room?')
-            else:
-                # Create room if required
-                rooms[room_id] = set()
-            room_peers = ' '.join([pid for pid in rooms[room_id]])
-            await ws.send('ROOM_OK {}'.format(room_peers))
-            # Enter room
-            peers[uid][2] = peer_status = room_id
-            rooms[room_id].add(uid)
-            for pid in rooms[room_id]:
-                if pid == uid:
-                    continue
-                wsp, paddr, _ = peers[pid]
-                msg = 'ROOM_PEER_JOINED {}'.format(uid)
-                print('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-                await wsp.send(msg)
+            if uid in rooms.get(room_id, ()):
+                raise AssertionError('How did we accept a ROOM command '
+                                     'despite already being in a room?')
+            if draining:
+                send_peer(uid, 'ERROR server is restarting')
+                continue
+            room_peers = await join_room(peer, room_id)
+            if room_peers is None:
+                send_peer(uid, 'ERROR room {!r} is full'.format(room_id))
+                continue
+            # Not behind the ROOM_PEER_JOINED just queued for every member
+            await peer.outbox.send_now('ROOM_OK {}'.format(room_peers))
         else:
-            print('Ignoring unknown message {!r} from {!r}'.format(msg, uid))
+            log.warning('Ignoring unknown message %s from %r', Payload(msg), uid)
+
+async def join_room(peer, room_id):
+    '''
+    Add @peer to @room_id, creating it if required, and return the
+    space-separated list of peers that were already in it, or None if it is
+    full. Members are told by the registry.
+    '''
+    known = room_id in rooms
+    room_peers = await registry_call(registry.join_room(peer.uid, room_id))
+    if room_peers is None:
+        metrics.limit_hits['room'] += 1
+        return None
+    if not known:
+        # First member connected to this process, we only know about
+        # ourselves from the registry's join event
+        room = rooms[room_id] = Room()
+        for pid in room_peers.split():
+            room.add(pid)
+        room.add(peer.uid, local=True)
+    peer.status = room_id
+    return room_peers
 
 async def hello_peer(ws):
     '''
-    Exchange hello, register peer
+    Exchange hello, register peer. Returns its uid, or None if we are
+    draining or it didn't say HELLO in time.
     '''
-    raddr = ws.remote_address
-    hello = await ws.recv()
+    raddr = remote_address(ws)
+    try:
+        # Peers are only kept alive once registered, so one that never says
+        # HELLO would hold its connection forever
+        hello = await asyncio.wait_for(ws.recv(), HELLO_TIMEOUT)
+    except TimeoutError:
+        metrics.handshake_failures['hello'] += 1
+        log.info('No HELLO from %r, disconnecting', raddr)
+        await ws.close(code=1008, reason='no HELLO')
+        return None
     hello, uid = hello.split(maxsplit=1)
     if hello != 'HELLO':
+        metrics.handshake_failures['hello'] += 1
         await ws.close(code=1002, reason='invalid protocol')
         raise Exception("Invalid hello from {!r}".format(raddr))
-    if not uid or uid in peers or uid.split() != [uid]: # no whitespace
+    if draining:
+        # Accepted just before we stopped listening
+        await ws.close(code=1012, reason='server restarting')
+        return None
+    # Peers that want to resume after losing their connection or a restart
+    # add a token, which is ignored if we can't resume them
+    uid, _, token = uid.partition(' ')
+    resumed = None
+    if not uid or uid.split() != [uid] or token.split() != ([token] if token else []):
+        registered = False
+    elif token and RESUME_TOKENS:
+        # Only a hash of the token is kept, in memory and on disk
+        token = hashlib.sha256(token.encode()).hexdigest()
+        resumed = await registry_call(registry.resume(uid, token))
+        registered = resumed is not None or await registry_call(registry.register(uid, token))
+    else:
+        registered = await registry_call(registry.register(uid)) # unique
+    if not registered:
+        metrics.handshake_failures['hello'] += 1
         await ws.close(code=1002, reason='invalid peer uid')
         raise Exception("Invalid uid {!r} from {!r}".format(uid, raddr))
-    # Send back a HELLO
-    await ws.send('HELLO')
+    # Registered with the registry, so we must be able to take events for it
+    # from now on
+    peer = peers[uid] = Peer(uid, ws)
+    peer.resumable = bool(token and RESUME_TOKENS)
+    keepalive.schedule(peer, KEEPALIVE_TIMEOUT)
+    if resumed is not None:
+        resume_peer(peer, resumed)
+    else:
+        # Send back a HELLO
+        send_peer(uid, 'HELLO')
+    room_id = restored_rooms.pop(uid, None)
+    if room_id is not None and peer.status is None and time.monotonic() < restored_until:
+        log.info('Putting %r back in room %r', uid, room_id)
+        await join_room(peer, room_id)
     return uid
 
+def resume_peer(peer, resumed):
+    '''
+    Put @peer back in the session or room it was in before it lost its
+    connection or the server restarted, as returned by
+    LocalRegistry.resume(), tell it with its HELLO, and send it the messages
+    kept for it meanwhile. The other peers never saw it leave, so they aren't
+    told.
+    '''
+    uid = peer.uid
+    metrics.resumed_peers += 1
+    metrics.replayed_messages += len(resumed['replay'])
+    metrics.replay_dropped_messages += resumed['dropped']
+    if 'session' in resumed:
+        peer.status = 'session'
+        peer.partner = resumed['session']
+        log.info('Peer %r resumed its session with %r', uid, peer.partner)
+        send_peer(uid, 'HELLO SESSION {}'.format(peer.partner))
+    elif 'room' in resumed:
+        room_id = resumed['room']
+        room = rooms.get(room_id)
+        if room is None:
+            room = rooms[room_id] = Room()
+            for pid in resumed['peers'].split():
+                room.add(pid)
+        room.add(uid, local=True)
+        peer.status = room_id
+        log.info('Peer %r resumed in room %r', uid, room_id)
+        send_peer(uid, 'HELLO ROOM {} {}'.format(room_id, resumed['peers']))
+    else:
+        send_peer(uid, 'HELLO')
+    for msg in resumed['replay']:
+        send_peer(uid, msg)
+
 async def handler(ws, path):
     '''
     All incoming messages are handled here. @path is unused.
     '''
-    raddr = ws.remote_address
-    print("Connected to {!r}".format(raddr))
+    raddr = remote_address(ws)
+    log.info('Connected to %r', raddr)
     peer_id = await hello_peer(ws)
+    if peer_id is None:
+        return
+    peer = peers[peer_id]
+    lost = False
     try:
         await connection_handler(ws, peer_id)
     except websockets.ConnectionClosed:
-        print("Connection to peer {!r} closed, exiting handler".format(raddr))
+        log.info('Connection to peer %r closed, exiting handler', raddr)
+        lost = lost_connection(ws)
     finally:
-        await remove_peer(peer_id)
+        await remove_peer(peer, lost)
 
 sslctx = None
-if not options.disable_ssl:
+if not options.disable_ssl and not UNIX_SOCKET:
     # Create an SSL context to be used by the websocket server
     certpath = options.cert_path
     print('Using TLS with keys in {!r}'.format(certpath))
@@ -252,28 +1341,362 @@ if not options.disable_ssl:
         chain_pem = os.path.join(certpath, 'cert.pem')
         key_pem = os.path.join(certpath, 'key.pem')
 
-    sslctx = ssl.create_default_context()
+    sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     try:
         sslctx.load_cert_chain(chain_pem, keyfile=key_pem)
     except FileNotFoundError:
         print("Certificates not found, did you run generate_cert.sh?")
         sys.exit(1)
-    # FIXME
-    sslctx.check_hostname = False
-    sslctx.verify_mode = ssl.CERT_NONE
-
-print("Listening on https://{}:{}".format(*ADDR_PORT))
-# Websocket server
-wsd = websockets.serve(handler, *ADDR_PORT, ssl=sslctx,
-                       # Maximum number of messages that websockets will pop
-                       # off the asyncio and OS buffers per connection. See:
-                       # https://websockets.readthedocs.io/en/stable/api.html#websockets.protocol.WebSocketCommonProtocol
-                       max_queue=16)
+    # An ECDSA certificate next to the RSA one is used for the clients that
+    # support it, which is nearly all of them. Signing with it is much
+    # cheaper than with RSA, which dominates the cost of a full handshake.
+    ecdsa_chain_pem = os.path.join(certpath, 'cert-ecdsa.pem')
+    ecdsa_key_pem = os.path.join(certpath, 'key-ecdsa.pem')
+    if os.path.exists(ecdsa_chain_pem):
+        sslctx.load_cert_chain(ecdsa_chain_pem, keyfile=ecdsa_key_pem)
+        print('Using ECDSA certificate {!r}'.format(ecdsa_chain_pem))
+    # Reconnecting clients resume their session with a ticket and skip the
+    # key exchange and signature. Ticket keys are created with the context,
+    # so workers forked from this process share them, but cluster nodes
+    # don't.
+    if TLS_TICKETS > 0:
+        sslctx.num_tickets = TLS_TICKETS
+    else:
+        sslctx.num_tickets = 0
+        sslctx.options |= ssl.OP_NO_TICKET
+    # asyncio allocates a 256KB buffer for every TLS connection since Python
+    # 3.11, which is most of the memory used by an idle peer. A TLS record is
+    # at most 16KB, so a smaller one only means more reads for large
+    # messages.
+    if hasattr(asyncio.sslproto.SSLProtocol, 'max_size'):
+        asyncio.sslproto.SSLProtocol.max_size = TLS_BUFFER_SIZE
+
+EVENT_LOOP = options.event_loop
+if EVENT_LOOP == 'uvloop':
+    try:
+        import uvloop
+    except ImportError:
+        print('uvloop is not installed, using the asyncio event loop')
+        EVENT_LOOP = 'asyncio'
+    else:
+        # Workers create their own loop after forking, also with uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        # The policy doesn't create one on the first get_event_loop()
+        asyncio.set_event_loop(asyncio.new_event_loop())
 
 logger = logging.getLogger('websockets.server')
 
 logger.setLevel(logging.ERROR)
 logger.addHandler(logging.StreamHandler())
 
-asyncio.get_event_loop().run_until_complete(wsd)
-asyncio.get_event_loop().run_forever()
+def compression_args():
+    '''
+    Arguments to websockets.serve() for the configured compression. Each
+    connection keeps about 2^(window bits + 2) + 2^(mem level + 9) bytes of
+    compressor state, and 2^(window bits) + 7KB of decompressor state, unless
+    there is no context takeover, in which case they only exist while a
+    message is being compressed or decompressed.
+    '''
+    if COMPRESSION == 'off':
+        return dict(compression=None)
+    factory = ServerPerMessageDeflateFactory(
+        server_no_context_takeover=DEFLATE_NO_CONTEXT_TAKEOVER,
+        client_no_context_takeover=DEFLATE_NO_CONTEXT_TAKEOVER,
+        server_max_window_bits=DEFLATE_WINDOW_BITS,
+        client_max_window_bits=DEFLATE_WINDOW_BITS,
+        compress_settings={'memLevel': DEFLATE_MEM_LEVEL})
+    return dict(compression=None, extensions=[factory])
+
+############### Draining and handoff ###############
+
+def close_peer(uid):
+    peer = peers.get(uid)
+    if peer is not None:
+        # The handler sees the connection closed and removes the peer
+        asyncio.ensure_future(peer.ws.close(code=1012, reason='server restarting'))
+
+async def drain(server):
+    '''
+    Stop accepting connections, and send peers to the process that took
+    over, or to other servers. Peers that aren't in a session are closed over
+    DRAIN_SPREAD seconds, so that they don't all reconnect at once, and
+    sessions are given up to DRAIN_TIMEOUT seconds to end. Stops the event
+    loop once all peers are gone.
+    '''
+    global draining
+    draining = True
+    # Only stops listening, connections already accepted are kept
+    server.server.close()
+    loop = asyncio.get_event_loop()
+    movable = [uid for uid, peer in peers.items() if peer.status != 'session']
+    random.shuffle(movable)
+    log.warning('Draining, closing %d peers and waiting for %d in sessions',
+                len(movable), len(peers) - len(movable))
+    for i, uid in enumerate(movable):
+        loop.call_later(DRAIN_SPREAD * i / len(movable), close_peer, uid)
+    deadline = loop.time() + DRAIN_TIMEOUT
+    while peers and loop.time() < deadline:
+        await asyncio.sleep(1)
+    if peers:
+        log.warning('Drain timeout, closing %d peers', len(peers))
+        for uid in list(peers):
+            close_peer(uid)
+        while peers:
+            await asyncio.sleep(0.1)
+    log.warning('Drained')
+    loop.stop()
+
+def start_drain(server):
+    if not draining:
+        asyncio.ensure_future(drain(server))
+
+async def drain_workers(pids):
+    '''
+    Drain all workers, and stop the event loop of the hub once they exited
+    '''
+    global draining
+    draining = True
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
+    while pids:
+        await asyncio.sleep(1)
+        pids = [pid for pid in pids if os.waitpid(pid, os.WNOHANG) == (0, 0)]
+    asyncio.get_event_loop().stop()
+
+def start_drain_workers(pids):
+    if not draining:
+        asyncio.ensure_future(drain_workers(pids))
+
+def handoff_state(reg):
+    '''
+    What a new process needs from the LocalRegistry @reg to restore peers
+    when they reconnect, as JSON
+    '''
+    if not HANDOFF_STATE:
+        return {}
+    return {'rooms': {room_id: list(members) for room_id, members in reg.rooms.items()}}
+
+def listen_handoff(sock, reg, on_handoff):
+    '''
+    Wait for a new process on HANDOFF_SOCKET, give it the listening socket
+    @sock and the state of @reg, then call @on_handoff. The socket is passed
+    with SCM_RIGHTS, followed by a line with the length of the state, and the
+    state as JSON.
+    '''
+    try:
+        os.unlink(HANDOFF_SOCKET)
+    except FileNotFoundError:
+        pass
+    ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ctl.bind(HANDOFF_SOCKET)
+    ctl.listen(1)
+    ctl.setblocking(False)
+    loop = asyncio.get_event_loop()
+    def accept():
+        conn, _ = ctl.accept()
+        # The new process now owns HANDOFF_SOCKET
+        loop.remove_reader(ctl)
+        ctl.close()
+        # And STATE_FILE, which it reads once it has the listening socket.
+        # Peers that we still have are restored there, and resume when we
+        # close them.
+        if reg.journal is not None:
+            reg.journal.close()
+            reg.journal = None
+        state = json.dumps(handoff_state(reg)).encode()
+        log.warning('Handing the listening socket over, with %d bytes of state', len(state))
+        with conn:
+            conn.setblocking(True)
+            socket.send_fds(conn, [b'%d\n' % len(state)], [sock.fileno()])
+            conn.sendall(state)
+        on_handoff()
+    loop.add_reader(ctl, accept)
+
+def take_over():
+    '''
+    Take the listening socket and state over from the server on
+    HANDOFF_SOCKET, returns None if there isn't one running
+    '''
+    global restored_until
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(HANDOFF_SOCKET)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    with conn:
+        data, fds, _, _ = socket.recv_fds(conn, 4096, 1)
+        if not fds:
+            raise ConnectionError('no socket received from {}'.format(HANDOFF_SOCKET))
+        size, _, data = data.partition(b'\n')
+        size = int(size)
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('truncated state from {}'.format(HANDOFF_SOCKET))
+            data += chunk
+    state = json.loads(data.decode())
+    for room_id, members in state.get('rooms', {}).items():
+        for uid in members:
+            restored_rooms[uid] = room_id
+    restored_until = time.monotonic() + HANDOFF_GRACE
+    print('Took over from the server on {}, with {} peers to put back in their '
+          'rooms'.format(HANDOFF_SOCKET, len(restored_rooms)))
+    sock = socket.socket(fileno=fds[0])
+    sock.setblocking(False)
+    return sock
+
+def listen_socket():
+    '''
+    Listening socket on ADDR_PORT, or on UNIX_SOCKET for a TLS proxy, unless
+    we take it over from the server running on HANDOFF_SOCKET
+    '''
+    if HANDOFF_SOCKET:
+        sock = take_over()
+        if sock is not None:
+            return sock
+    if UNIX_SOCKET:
+        try:
+            os.unlink(UNIX_SOCKET)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(UNIX_SOCKET)
+    else:
+        family, type_, proto, _, sockaddr = socket.getaddrinfo(*ADDR_PORT,
+            type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+def serve(sock=None, worker=0):
+    '''
+    Run the websocket server, either on its own listening socket or on the
+    socket @sock shared with other workers, until drained
+    '''
+    global keepalive
+    own_sock = sock is None
+    if own_sock:
+        sock = listen_socket()
+        # Only once a server we take over from stopped writing to it
+        if STATE_FILE:
+            open_state(registry)
+    # uvloop accepts connections without calling accept(), see MetricsProtocol
+    if EVENT_LOOP == 'asyncio':
+        sock = AdmissionSocket(sock.family, sock.type, sock.proto, fileno=sock.detach())
+    keepalive = KeepaliveWheel()
+    # Websocket server
+    wsd = websockets.serve(handler, ssl=sslctx, sock=sock,
+                           # Maximum number of messages that websockets will pop
+                           # off the asyncio and OS buffers per connection. See:
+                           # https://websockets.readthedocs.io/en/stable/api.html#websockets.protocol.WebSocketCommonProtocol
+                           max_queue=MAX_QUEUE, max_size=MAX_MESSAGE_SIZE,
+                           read_limit=READ_LIMIT, write_limit=WRITE_LIMIT,
+                           create_protocol=MetricsProtocol,
+                           # Keepalive is done by KeepaliveWheel for all peers
+                           ping_interval=None,
+                           # Peers that ask for it can send binary frames
+                           subprotocols=[protocol.BINARY_SUBPROTOCOL],
+                           **compression_args())
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(wsd)
+    loop.add_signal_handler(signal.SIGTERM, start_drain, server)
+    if own_sock and HANDOFF_SOCKET:
+        listen_handoff(sock, registry, lambda: start_drain(server))
+    if METRICS_PORT:
+        port = METRICS_PORT + worker
+        loop.run_until_complete(asyncio.start_server(serve_metrics, ADDR_PORT[0], port))
+        log.info('Serving metrics on http://%s:%d/metrics', ADDR_PORT[0], port)
+    loop.add_signal_handler(signal.SIGUSR1, toggle_relay_log)
+    if TRACE_FILE:
+        load_traced()
+        loop.add_signal_handler(signal.SIGUSR2, load_traced)
+    if STATS_INTERVAL > 0:
+        asyncio.ensure_future(report_outboxes())
+    if IP_RATE:
+        asyncio.ensure_future(prune_ip_buckets())
+    start_monitoring_loop()
+    asyncio.get_event_loop().run_forever()
+
+def fork_workers():
+    '''
+    Pre-fork WORKERS processes that all accept connections on the same
+    listening socket, and run the hub that connects them in this process
+    '''
+    global registry
+    sock = listen_socket()
+    hub_socks = []
+    pids = []
+    # Format: {(worker_id, other_id): socket}
+    # Both ends of the direct link between every pair of workers
+    link_socks = dict()
+    for worker in range(WORKERS):
+        for other in range(worker + 1, WORKERS):
+            link_socks[worker, other], link_socks[other, worker] = socket.socketpair()
+    for worker in range(WORKERS):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            for hub_sock in hub_socks:
+                hub_sock.close()
+            parent_sock.close()
+            links = {other: link_socks.pop((worker, other)) for other in range(WORKERS) if other != worker}
+            for link_sock in link_socks.values():
+                link_sock.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            start_logging()
+            registry = HubRegistry(child_sock, registry_event, links)
+            asyncio.get_event_loop().run_until_complete(registry.connect())
+            log.info('Worker %d running as pid %d', worker, os.getpid())
+            serve(sock, worker)
+            os._exit(0)
+        child_sock.close()
+        hub_socks.append(parent_sock)
+        pids.append(pid)
+    for link_sock in link_socks.values():
+        link_sock.close()
+    start_logging()
+    hub = LocalRegistry()
+    if STATE_FILE:
+        open_state(hub)
+    for worker, hub_sock in enumerate(hub_socks):
+        asyncio.ensure_future(serve_hub_worker(hub, worker, hub_sock))
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, start_drain_workers, pids)
+    if HANDOFF_SOCKET:
+        listen_handoff(sock, hub, lambda: start_drain_workers(pids))
+    else:
+        sock.close()
+    loop.run_forever()
+
+if UNIX_SOCKET:
+    print("Listening on unix:{}".format(UNIX_SOCKET))
+else:
+    print("Listening on https://{}:{}".format(*ADDR_PORT))
+if CLUSTER_ADDR:
+    if WORKERS > 1:
+        print('--workers cannot be used with --cluster-addr, run more nodes instead')
+        sys.exit(1)
+    if HANDOFF_SOCKET:
+        print('--handoff-socket cannot be used with --cluster-addr, drain nodes one at a time instead')
+        sys.exit(1)
+    if STATE_FILE:
+        print('--state-file cannot be used with --cluster-addr')
+        sys.exit(1)
+    if CLUSTER_ADDR not in CLUSTER_NODES:
+        print('--cluster-nodes must include our own --cluster-addr')
+        sys.exit(1)
+    start_logging()
+    registry = ClusterRegistry(CLUSTER_ADDR, CLUSTER_NODES, registry_event)
+    asyncio.get_event_loop().run_until_complete(registry.start())
+    print('Cluster node {} of {}'.format(CLUSTER_ADDR, ', '.join(CLUSTER_NODES)))
+    serve()
+elif WORKERS > 1:
+    fork_workers()
+else:
+    start_logging()
+    registry = LocalRegistry()
+    registry.attach(0, registry_event)
+    serve()
@@ -0,0 +1,395 @@
+#
+# Tests of the registries and outbound queues of the signalling server, run
+# from this directory with: python3 -m unittest
+#
+
+import os
+import json
+import socket
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import signalling_state
+import signalling_protocol as protocol
+from signalling_state import Outbox, Room, LocalRegistry, ReplayBuffer, HubRegistry, \
+    registry_call, StateJournal
+
+class FakeWebsocket:
+    '''
+    Records what is sent, for Outbox
+    '''
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send(self, msg):
+        self.sent.append(msg)
+
+    async def close(self, code=1000, reason=''):
+        self.close_code = code
+
+class LocalRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = LocalRegistry()
+        # Format: {worker_id: [event]}
+        self.events = {0: [], 1: []}
+        for worker, events in self.events.items():
+            self.registry.attach(worker, events.append)
+
+    def test_register(self):
+        self.assertTrue(self.registry.register('a', worker=0))
+        self.assertFalse(self.registry.register('a', worker=1))
+        # Only the worker the peer is connected to can unregister it
+        self.registry.unregister('a', worker=1)
+        self.assertFalse(self.registry.register('a', worker=1))
+        self.registry.unregister('a', worker=0)
+        self.assertTrue(self.registry.register('a', worker=1))
+
+    def test_deliver(self):
+        self.registry.register('a', worker=1)
+        self.registry.deliver('a', 'hi')
+        self.registry.deliver('b', 'hi')
+        self.assertEqual(self.events, {0: [], 1: [('msg', 'a', 'hi')]})
+
+    def test_session(self):
+        self.registry.register('a', worker=0)
+        self.registry.register('b', worker=1)
+        self.assertFalse(self.registry.start_session('a', 'c', worker=0))
+        self.assertTrue(self.registry.start_session('a', 'b', worker=0))
+        # The callee learns who called it, and from which worker
+        self.assertEqual(self.events[1], [('session', 'b', 'a', 0)])
+        self.registry.end_session('a')
+        self.assertEqual(self.events[1][-1], ('hangup', 'b'))
+        self.assertEqual(self.registry.sessions, {})
+
+    def test_room(self):
+        self.registry.register('a', worker=0)
+        self.registry.register('b', worker=1)
+        self.assertEqual(self.registry.join_room('a', 'r'), '')
+        self.assertEqual(self.registry.join_room('b', 'r'), 'a')
+        self.registry.leave_room('a', 'r')
+        self.registry.leave_room('b', 'r')
+        self.assertEqual(self.registry.rooms, {})
+        # Room events go to every worker
+        for events in self.events.values():
+            self.assertEqual(events, [('joined', 'r', 'a'), ('joined', 'r', 'b'),
+                                      ('left', 'r', 'a'), ('left', 'r', 'b')])
+
+    def test_room_size(self):
+        with mock.patch.object(signalling_state, 'MAX_ROOM_SIZE', 2):
+            self.assertEqual(self.registry.join_room('a', 'r'), '')
+            self.assertEqual(self.registry.join_room('b', 'r'), 'a')
+            self.assertIsNone(self.registry.join_room('c', 'r'))
+        self.assertEqual(list(self.registry.rooms['r']), ['a', 'b'])
+
+    def test_detach(self):
+        self.registry.register('a', worker=0)
+        self.registry.register('b', worker=1)
+        self.registry.start_session('a', 'b', worker=0)
+        self.registry.join_room('a', 'r')
+        self.registry.join_room('b', 'r')
+        del self.events[1][:]
+        self.registry.detach(0)
+        self.assertEqual(self.registry.owners, {'b': 1})
+        self.assertEqual(self.events[1], [('hangup', 'b'), ('left', 'r', 'a')])
+        self.assertEqual(self.registry.join_room('c', 'r'), 'b')
+
+class RoomTest(unittest.TestCase):
+    def test_peer_list(self):
+        room = Room()
+        for uid in ('a', 'bb', 'c'):
+            room.add(uid)
+        self.assertEqual(room.peer_list(), 'a bb c')
+        self.assertEqual(room.peer_list(exclude='a'), 'bb c')
+        self.assertEqual(room.peer_list(exclude='bb'), 'a c')
+        self.assertEqual(room.peer_list(exclude='c'), 'a bb')
+        room.remove('bb')
+        room.add('d', local=True)
+        self.assertEqual(room.peer_list(exclude='c'), 'a d')
+        self.assertEqual(list(room.local), ['d'])
+        self.assertEqual(len(room), 3)
+
+class StateJournalTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'state')
+
+    def start(self):
+        '''
+        A registry restored from the journal, as open_state() does when the
+        server starts
+        '''
+        journal = StateJournal(self.path)
+        registry = LocalRegistry()
+        registry.restore(journal.load())
+        journal.open()
+        journal.compact(registry.saved_state())
+        registry.journal = journal
+        self.addCleanup(journal.close)
+        events = []
+        registry.attach(0, events.append)
+        return registry, events
+
+    async def test_resume(self):
+        patcher = mock.patch.object(signalling_state, 'RESUME_GRACE', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        registry, _ = self.start()
+        for uid in ('a', 'b', 'c', 'd'):
+            registry.register(uid, 'token-' + uid)
+        registry.register('e')
+        registry.register('f', 'token-f')
+        registry.unregister('f')
+        registry.join_room('a', 'r')
+        registry.join_room('e', 'r')
+        registry.start_session('c', 'd')
+        # Written once the event loop gets to it
+        await asyncio.sleep(0)
+
+        # After a crash, only the peers with a token are back
+        registry, events = self.start()
+        self.assertEqual(sorted(registry.away), ['a', 'b', 'c', 'd'])
+        self.assertIsNone(registry.resume('a', 'token-b'))
+        self.assertEqual(registry.resume('a', 'token-a'),
+                         {'replay': [], 'dropped': 0, 'room': 'r', 'peers': ''})
+        self.assertEqual(registry.resume('b', 'token-b'), {'replay': [], 'dropped': 0})
+        self.assertEqual(registry.resume('c', 'token-c'),
+                         {'replay': [], 'dropped': 0, 'session': 'd'})
+        # Its partner never came back
+        with self.assertLogs('signalling', 'INFO'):
+            await asyncio.sleep(0.05)
+        self.assertEqual(events, [('hangup', 'c')])
+        self.assertEqual(registry.saved_state(), {
+            'tokens': {'a': 'token-a', 'b': 'token-b', 'c': 'token-c'},
+            'rooms': {'a': 'r'},
+            'sessions': {}})
+
+    def test_truncated(self):
+        # A crash while writing the last record
+        with open(self.path, 'w') as f:
+            f.write('["register", "a", "token-a"]\n["register", "b", "tok')
+        self.assertEqual(StateJournal(self.path).load()['tokens'], {'a': 'token-a'})
+
+class ReplayTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.registry = LocalRegistry()
+        # Format: {worker_id: [event]}
+        self.events = {0: [], 1: []}
+        for worker, events in self.events.items():
+            self.registry.attach(worker, events.append)
+
+    async def test_suspend(self):
+        self.registry.register('a', 'token-a')
+        self.registry.register('b')
+        self.registry.join_room('a', 'r')
+        self.registry.join_room('b', 'r')
+        # With what its outbox hadn't sent
+        self.registry.suspend('a', 'r', ['ROOM_PEER_MSG b 1'])
+        self.registry.deliver('a', 'ROOM_PEER_MSG b 2')
+        # Its uid is kept for it
+        self.assertFalse(self.registry.register('a'))
+        self.assertEqual(self.registry.resume('a', 'token-a', worker=1), {
+            'replay': ['ROOM_PEER_MSG b 1', 'ROOM_PEER_MSG b 2'], 'dropped': 0,
+            'room': 'r', 'peers': 'b'})
+        # The room was never told it left
+        self.assertEqual(self.events[0], [('joined', 'r', 'a'), ('joined', 'r', 'b')])
+        self.registry.deliver('a', 'ROOM_PEER_MSG b 3')
+        self.assertEqual(self.events[1][-1], ('msg', 'a', 'ROOM_PEER_MSG b 3'))
+
+    async def test_grace(self):
+        self.registry.register('a', 'token-a')
+        self.registry.register('b')
+        self.registry.start_session('b', 'a')
+        with mock.patch.object(signalling_state, 'RECONNECT_GRACE', 0.01):
+            self.registry.suspend('a', None, [])
+        with self.assertLogs('signalling', 'INFO'):
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.events[0][-1], ('hangup', 'b'))
+        self.assertIsNone(self.registry.resume('a', 'token-a'))
+        self.assertTrue(self.registry.register('a'))
+
+    async def test_replace(self):
+        # Resuming before the old connection is found lost
+        self.registry.register('a', 'token-a')
+        self.assertEqual(self.registry.resume('a', 'token-a', worker=1),
+                         {'replay': [], 'dropped': 0})
+        self.assertEqual(self.events[0], [('replaced', 'a')])
+        self.assertEqual(self.registry.owners, {'a': 1})
+
+    def test_bounce(self):
+        self.registry.register('a', worker=0)
+        # Dropped, the worker that has it is removing it
+        self.registry.bounce('a', 'hi', worker=0)
+        self.registry.bounce('a', 'hi', worker=1)
+        self.assertEqual(self.events, {0: [('msg', 'a', 'hi')], 1: []})
+
+    def test_replay_buffer(self):
+        buffer = ReplayBuffer()
+        with mock.patch.object(signalling_state, 'REPLAY_BUFFER_SIZE', 10):
+            for msg in ('aaaa', 'bbbb', 'cccc'):
+                buffer.add(msg)
+        self.assertEqual(buffer.replay(), ['bbbb', 'cccc'])
+        self.assertEqual(buffer.dropped, 1)
+        with mock.patch.object(signalling_state, 'REPLAY_TTL', -1):
+            self.assertEqual(buffer.replay(), [])
+        self.assertEqual(buffer.dropped, 3)
+
+class HubRegistryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        hub_socks = [socket.socketpair() for worker in range(2)]
+        link = socket.socketpair()
+        # Format: [[event]], by worker
+        self.events = [[], []]
+        self.workers = [HubRegistry(hub_socks[worker][0], self.events[worker].append,
+                                    {1 - worker: link[worker]})
+                        for worker in range(2)]
+        for registry in self.workers:
+            await registry.connect()
+        # The hub's side of the connection of each worker
+        self.hub = [await asyncio.open_unix_connection(sock=pair[1])
+                    for pair in hub_socks]
+
+    async def asyncTearDown(self):
+        # A worker that loses the hub exits, so stop reading first
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        for registry in self.workers:
+            registry.writer.close()
+            for link in registry.links.values():
+                link.close()
+        for _, writer in self.hub:
+            writer.close()
+
+    async def hub_reads(self, worker):
+        line = await asyncio.wait_for(self.hub[worker][0].readline(), 1)
+        return json.loads(line.decode())
+
+    async def test_call(self):
+        result = asyncio.ensure_future(self.workers[0].register('a'))
+        request = await self.hub_reads(0)
+        self.assertEqual(request, {'id': request['id'], 'op': 'register', 'args': ['a', None]})
+        reply = {'id': request['id'], 'result': True}
+        self.hub[0][1].write((json.dumps(reply) + '\n').encode())
+        self.assertTrue(await asyncio.wait_for(result, 1))
+
+    async def test_deliver(self):
+        # Without a session, messages go through the hub
+        self.workers[0].deliver('b', 'hi')
+        self.assertEqual(await self.hub_reads(0), {'op': 'deliver', 'args': ['b', 'hi']})
+        # Once the hub said that the partner is on worker 1, they go straight
+        # there over the link
+        event = {'event': ['session', 'a', 'b', 1]}
+        self.hub[0][1].write((json.dumps(event) + '\n').encode())
+        for i in range(100):
+            if self.events[0]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.events[0], [('session', 'a', 'b')])
+        self.workers[0].deliver('b', 'hi')
+        for i in range(100):
+            if self.events[1]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.events[1], [('msg', 'b', 'hi')])
+
+class RegistryCallTest(unittest.IsolatedAsyncioTestCase):
+    async def test_registry_call(self):
+        self.assertEqual(await registry_call(['a']), ['a'])
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(['b'])
+        self.assertEqual(await registry_call(future), ['b'])
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ws = FakeWebsocket()
+        for name, value in (('QUEUE_SIZE', 3), ('metrics', mock.MagicMock())):
+            patcher = mock.patch.object(signalling_state, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def outbox(self, policy):
+        patcher = mock.patch.object(signalling_state, 'OVERFLOW_POLICY', policy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return Outbox(self.ws, 'a')
+
+    async def test_write(self):
+        outbox = self.outbox('disconnect')
+        for msg in ('1', '2', '3'):
+            outbox.put(msg)
+        # Until the writer is done
+        while outbox.writer is not None:
+            await asyncio.sleep(0)
+        self.assertEqual(self.ws.sent, ['1', '2', '3'])
+        self.assertEqual(outbox.sent, 3)
+        # Idle outboxes have neither a queue nor a writer
+        self.assertIs(outbox.queue, signalling_state.EMPTY_QUEUE)
+
+    async def test_disconnect(self):
+        outbox = self.outbox('disconnect')
+        with self.assertLogs('signalling', 'WARNING'):
+            for msg in ('1', '2', '3', '4'):
+                outbox.put(msg)
+        self.assertTrue(outbox.closed)
+        await asyncio.sleep(0)
+        self.assertEqual(self.ws.close_code, 1008)
+
+    async def test_drop_oldest(self):
+        outbox = self.outbox('drop-oldest')
+        for msg in ('1', '2', '3', '4'):
+            outbox.put(msg)
+        self.assertEqual(list(outbox.queue), ['2', '3', '4'])
+        self.assertEqual(outbox.dropped, 1)
+        outbox.close()
+
+    async def test_coalesce_ice(self):
+        outbox = self.outbox('coalesce-ice')
+        ice = [json.dumps({'ice': {'candidate': str(i), 'sdpMLineIndex': 0}})
+               for i in range(3)]
+        outbox.put('ROOM_PEER_MSG b ' + ice[0])
+        outbox.put('ROOM_PEER_MSG c ' + ice[1])
+        outbox.put('ROOM_PEER_MSG b ' + ice[2])
+        outbox.put('ROOM_PEER_MSG c {"sdp": {}}')
+        self.assertFalse(outbox.closed)
+        self.assertEqual(outbox.coalesced, 1)
+        # Only the candidates that were merged are rewritten
+        candidates = [json.loads(m)['ice'] for m in ice]
+        self.assertEqual(list(outbox.queue), [
+            'ROOM_PEER_MSG b ' + json.dumps({'ice': [candidates[0], candidates[2]]}),
+            'ROOM_PEER_MSG c ' + ice[1],
+            'ROOM_PEER_MSG c {"sdp": {}}'])
+        outbox.close()
+
+    async def test_undelivered(self):
+        outbox = self.outbox('disconnect')
+        outbox.put('ROOM_PEER_LIST a b')
+        outbox.put('ROOM_PEER_MSG b hi')
+        outbox.put(protocol.make_frame(protocol.OP_ROOM_PEER_MSG, b'b', b'', b'\xff'))
+        # Only messages from other peers that can be sent as text
+        self.assertEqual(outbox.undelivered(), ['ROOM_PEER_MSG b hi'])
+        outbox.close()
+
+    async def test_coalesce_ice_binary(self):
+        outbox = self.outbox('coalesce-ice')
+        ice = json.dumps({'ice': {'candidate': '0', 'sdpMLineIndex': 0}})
+        frame = protocol.make_frame(protocol.OP_ROOM_PEER_MSG, b'b', b'', ice.encode())
+        outbox.put('ROOM_PEER_MSG b ' + ice)
+        outbox.put('ROOM_PEER_MSG b ' + ice)
+        outbox.put(frame)
+        outbox.put('ROOM_PEER_MSG b ' + ice)
+        self.assertFalse(outbox.closed)
+        # Binary frames are left as they are, and end the batch of their
+        # sender since they aren't parsed
+        candidate = json.loads(ice)['ice']
+        self.assertEqual(list(outbox.queue), [
+            'ROOM_PEER_MSG b ' + json.dumps({'ice': [candidate, candidate]}),
+            frame,
+            'ROOM_PEER_MSG b ' + ice])
+        outbox.close()
+
+if __name__ == '__main__':
+    unittest.main()